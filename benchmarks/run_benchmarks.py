@@ -0,0 +1,346 @@
+#!/usr/bin/python3
+#
+# run_benchmarks.py
+#
+# Benchmarks for the config, activation and polling hot paths.  Runs without hardware
+# or a system bus: the node graphs are synthetic, the BMCs are local stand-ins with a
+# fixed response time, and the PDUs are the real ApcDriver talking to stand-ins for the
+# pysnmp calls, so building the requests and parsing the replies is timed.
+#
+#   run_benchmarks.py                          # run everything, print json
+#   run_benchmarks.py -o results.json          # also write the results
+#   run_benchmarks.py -b baseline.json         # compare against an earlier run
+#   run_benchmarks.py -k vartab                # only benchmarks with 'vartab' in the name
+#
+# With a baseline the exit status is 1 when any benchmark got slower than the threshold.
+# Benchmark groups whose modules can't be imported here (e.g. ipmi.py without pyipmi)
+# are reported as skipped; the others still run.
+#
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from copy import deepcopy
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "upscontrol"))
+
+from UpsControlConfig import *
+from UpsControlVartab import *
+from UpsControlDependency import *
+from UpsControlScheduler import *
+
+GRAPH_SIZES = (10, 100, 1000, 5000)
+
+# Response time of the fake BMCs and PDUs
+DEVICE_LATENCY = 0.001
+
+# Outlets per fake PDU
+PDU_OUTLETS = 24
+
+class Skip(Exception):
+    pass
+
+# Return the per-call times (seconds) of func() over 'repeat' rounds of 'number' calls
+def measure(func, number, repeat):
+    func()
+    times = []
+    for round in range(repeat):
+        started = time.perf_counter()
+        for call in range(number):
+            func()
+        times.append((time.perf_counter() - started) / number)
+    return times
+
+def config_table():
+    config = VarTab()
+    data = deepcopy(DEFAULT_NODE_CONFIG)
+    data.update(deepcopy(DEFAULT_SYSTEM_CONFIG))
+    data['bench'] = {
+        'host': "ups1",
+        'port': 161,
+        'uri': "snmp://${bench.host}:${bench.port}",
+        'nested': "${bench.uri}/outlets",
+        'eval': "$eval{var('bench.port') * 2}",
+    }
+    config.SetAllValues(data)
+    return config
+
+# Nodes in layers of 10; each node requires one and wants another of the layer below
+def synthetic_nodes(count):
+    nodes = []
+    for number in range(count):
+        layer = number // 10
+        below = [ "n%d" % ((layer - 1) * 10 + (number * 7 + offset) % 10) for offset in (0, 3) ] if layer else []
+        nodes.append({
+            'name': "n%d" % number,
+            'uri': "APC%d:%d" % (number // 24 + 1, number % 24 + 1),
+            'requires': below[:1],
+            'wants': below[1:],
+            'start': "",
+            'stop': "",
+            'showmain': layer % 5 == 4,
+        })
+    return nodes
+
+def vartab_benchmarks():
+    config = config_table()
+    counter = [ 0 ]
+
+    def set_value():
+        counter[0] += 1
+        config.SetValue("bench.port", counter[0] % 1000 + 1)
+
+    def set_and_get_macro():
+        set_value()
+        config.GetValue("bench.nested")
+
+    snapshot = config.GetSnapshot()
+
+    return {
+        'vartab_get_plain': (lambda: config.GetValue("bench.host"), 20000),
+        'vartab_get_macro': (lambda: config.GetValue("bench.nested"), 20000),
+        'vartab_get_eval': (lambda: config.GetValue("bench.eval"), 5000),
+        'vartab_get_table': (lambda: config.GetValue("nodes.data"), 20000),
+        'vartab_set': (set_value, 5000),
+        'vartab_set_then_get_macro': (set_and_get_macro, 5000),
+        'vartab_getallvalues_deepcopy': (lambda: deepcopy(config.GetAllValues()), 200),
+        'getconfig_json_dumps': (lambda: json.dumps(config.GetAllValues()), 500),
+        'getconfig_json_snapshot': (lambda: snapshot.Json(), 20000),
+    }
+
+def activation_benchmarks():
+    benchmarks = {}
+
+    for size in GRAPH_SIZES:
+        nodes = synthetic_nodes(size)
+        index = DependencyIndex(nodes)
+        scheduler = ActivationScheduler(lambda node, activate: True, max_workers=8)
+        top = [ node['name'] for node in nodes[-10:] ]
+        number = max(1, 2000 // size)
+
+        benchmarks['dependency_index_%d' % size] = (lambda nodes=nodes: DependencyIndex(nodes), number)
+        benchmarks['activation_plan_%d' % size] = (lambda index=index, top=top: scheduler.Plan(index, top, True), number)
+        benchmarks['activation_run_%d' % size] = (lambda index=index, top=top, scheduler=scheduler: scheduler.Run(index, top, True), number)
+        benchmarks['deactivation_run_%d' % size] = (lambda index=index, top=[ "n0" ], scheduler=scheduler: scheduler.Run(index, top, False), number)
+
+    return benchmarks
+
+# Stand-in for a pyipmi connection
+class FakeBmc():
+    class Status():
+        power_on = True
+
+    class Session():
+        def close(self):
+            pass
+
+    def __init__(self):
+        self.session = self.Session()
+
+    def get_chassis_status(self):
+        time.sleep(DEVICE_LATENCY)
+        return self.Status()
+
+# Made up oids for the objects ApcDriver uses
+APC_OBJECTS = {
+    'upsBasicOutputStatus': ((1, 1), {}),
+    'upsBasicBatteryStatus': ((1, 2), {}),
+    'upsAdvBatteryCapacity': ((1, 3), {}),
+    'upsAdvBatteryRunTimeRemaining': ((1, 4), {}),
+    'upsAdvOutputLoad': ((1, 5), {}),
+    'rPDUOutletStatusOutletState': ((2, 1), { 'outletStatusOn': 1, 'outletStatusOff': 2 }),
+    'rPDUOutletControlOutletCommand': ((2, 2), { 'immediateOn': 1, 'immediateOff': 2 }),
+}
+
+# Stand-in for MibIndex
+class FakeMib():
+    def Oid(self, name):
+        base, sep, index = name.partition(".")
+        oid = APC_OBJECTS[base][0]
+        return oid + (int(index),) if sep else oid
+
+    def Lookup(self, name):
+        return { 'enums': APC_OBJECTS[name][1] }
+
+# Stand-ins for the pysnmp calls ApcDriver makes; replies come back as pysnmp would
+# hand them over, so the driver's own request building and reply parsing run in full
+class FakeSnmp():
+    class Engine():
+        class Dispatcher():
+            def runDispatcher(self):
+                pass
+
+        def __init__(self):
+            self.transportDispatcher = self.Dispatcher()
+
+    def __init__(self, latency=DEVICE_LATENCY):
+        self.__latency = latency
+        self.__table = [ [ (APC_OBJECTS[name][0] + (0,), value) for name, value in
+                           (('upsBasicOutputStatus', 2), ('upsBasicBatteryStatus', 2), ('upsAdvBatteryCapacity', 100),
+                            ('upsAdvBatteryRunTimeRemaining', 360000), ('upsAdvOutputLoad', 40)) ] ]
+        self.__table += [ [ (APC_OBJECTS['rPDUOutletStatusOutletState'][0] + (outlet,), 1) ]
+                          for outlet in range(1, PDU_OUTLETS + 1) ]
+
+    def bulkCmd(self, engine, community, target, context, non_repeaters, max_repetitions, *objects, cbFun):
+        time.sleep(self.__latency)
+        cbFun(engine, 1, None, 0, 0, self.__table, None)
+
+    def setCmd(self, engine, community, target, context, *bindings):
+        time.sleep(self.__latency)
+        yield (None, 0, 0, bindings)
+
+    def patch(self, module):
+        return mock.patch.multiple(module, create=True,
+                                   SnmpEngine=self.Engine,
+                                   CommunityData=lambda community: community,
+                                   UdpTransportTarget=lambda address, timeout, retries: address,
+                                   ContextData=lambda: None,
+                                   ObjectType=lambda *args: args,
+                                   ObjectIdentity=lambda oid: oid,
+                                   Integer=int,
+                                   bulkCmd=self.bulkCmd,
+                                   setCmd=self.setCmd)
+
+# Pollers and pysnmp patches started by the benchmark groups, undone at the end
+pollers = []
+patches = []
+
+def apc_driver(count, latency=DEVICE_LATENCY):
+    import UpsControlApc
+
+    patch = FakeSnmp(latency).patch(UpsControlApc)
+    patch.start()
+    patches.append(patch)
+
+    pdus = [ { 'name': "APC%d" % number, 'address': "10.0.0.%d" % number, 'community': "private" }
+             for number in range(1, count + 1) ]
+    return UpsControlApc.ApcDriver(FakeMib(), lambda: pdus), [ pdu['name'] for pdu in pdus ]
+
+# No device latency here: these time the driver's own request building and reply parsing
+def pdu_benchmarks():
+    driver, names = apc_driver(1, latency=0)
+    batch = dict((outlet, outlet % 2 == 0) for outlet in range(1, PDU_OUTLETS + 1))
+
+    return {
+        'apc_poll': (lambda: driver.Poll(names[0]), 2000),
+        'apc_set_outlets_1': (lambda: driver.SetOutlets(names[0], { 1: True }), 2000),
+        'apc_set_outlets_%d' % PDU_OUTLETS: (lambda: driver.SetOutlets(names[0], batch), 2000),
+    }
+
+def polling_benchmarks():
+    try:
+        from ipmi import IPMI_SessionPool, IPMI_Control
+        from UpsControlPoller import NodePoller
+    except ImportError as e:
+        raise Skip(str(e))
+
+    pool = IPMI_SessionPool(factory=lambda control: FakeBmc())
+    control = IPMI_Control(host_address="bmc1", pool=pool)
+
+    benchmarks = {
+        'ipmi_pool_power_state': (control.is_power_on, 500),
+    }
+
+    for size in (10, 100):
+        nodes = synthetic_nodes(size)
+        for node in nodes:
+            node['uri'] = "IPMI:%s" % node['name']
+        driver, names = apc_driver(size // 10)
+        # Long interval: the poll thread does its first round and then leaves PollOnce to us
+        poller = NodePoller(interval=3600, sensors=False, pool=pool)
+        poller.SetNodes(DependencyIndex(nodes))
+        poller.SetPdus(driver, names)
+        poller.Start()
+        pollers.append(poller)
+        benchmarks['poll_once_%d' % size] = (poller.PollOnce, 20)
+
+    return benchmarks
+
+BENCHMARK_GROUPS = (
+    ('vartab', vartab_benchmarks),
+    ('activation', activation_benchmarks),
+    ('pdu', pdu_benchmarks),
+    ('polling', polling_benchmarks),
+)
+
+def run(name, func, number, repeat):
+    times = measure(func, number, repeat)
+
+    return {
+        'best_us': min(times) * 1e6,
+        'median_us': statistics.median(times) * 1e6,
+        'number': number,
+        'repeat': repeat,
+    }
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get('results', {}).get(name)
+        if base is None or 'median_us' not in base or 'median_us' not in result:
+            continue
+        ratio = result['median_us'] / base['median_us']
+        result['baseline_median_us'] = base['median_us']
+        result['ratio'] = ratio
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="UpsControl benchmarks")
+    parser.add_argument("-k", "--filter", default="", help="only run benchmarks containing this string")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="rounds per benchmark")
+    parser.add_argument("-o", "--output", help="write json results to this file")
+    parser.add_argument("-b", "--baseline", help="compare against json results of an earlier run")
+    parser.add_argument("-t", "--threshold", type=float, default=0.10, help="slowdown counted as regression (0.10 = 10%%)")
+    args = parser.parse_args()
+
+    results = {}
+    for group, benchmarks in BENCHMARK_GROUPS:
+        try:
+            items = benchmarks()
+        except Skip as e:
+            results[group] = { 'skipped': str(e) }
+            continue
+
+        for name, (func, number) in items.items():
+            if args.filter in name:
+                results[name] = run(name, func, number, args.repeat)
+                print("%-36s %12.2f us" % (name, results[name]['median_us']), file=sys.stderr)
+
+    for poller in pollers:
+        poller.Stop()
+    for patch in patches:
+        patch.stop()
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'time': time.time(),
+        'results': results,
+    }
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        report['regressions'] = regressions
+        for name in regressions:
+            print("REGRESSION %-25s %.2fx" % (name, results[name]['ratio']), file=sys.stderr)
+        status = 1 if regressions else 0
+
+    text = json.dumps(report, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
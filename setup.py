@@ -23,6 +23,7 @@ setup(
     data_files        = [
         ('/usr/sbin',                   ['upscontrol/upscontrol' ]),
         ('share/upscontrol',            [ 'extra/COPYING', ] ),
+        ('share/upscontrol/mibs',       [ 'mibs/PowerNet-MIB.txt', ] ),
     ],
     cmdclass = { 'install': post_install },
 )
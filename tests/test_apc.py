@@ -0,0 +1,142 @@
+#
+# test_apc.py
+#
+# ApcDriver's GETBULK poll and batched SET against stand-ins for pysnmp and the MIB
+# index, so neither pysnmp, the PowerNet MIB nor a PDU is needed.
+#
+#   python3 -m unittest discover tests
+#
+
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "upscontrol"))
+
+import UpsControlApc
+from UpsControlApc import *
+
+# The objects ApcDriver uses, under made up oids
+OBJECTS = {
+    'upsBasicOutputStatus': ((1, 1), {}),
+    'upsBasicBatteryStatus': ((1, 2), {}),
+    'upsAdvBatteryCapacity': ((1, 3), {}),
+    'upsAdvBatteryRunTimeRemaining': ((1, 4), {}),
+    'upsAdvOutputLoad': ((1, 5), {}),
+    'rPDUOutletStatusOutletState': ((2, 1), { 'outletStatusOn': 1, 'outletStatusOff': 2 }),
+    'rPDUOutletControlOutletCommand': ((2, 2), { 'immediateOn': 1, 'immediateOff': 2 }),
+}
+
+class FakeMib():
+    # Accepts "name" and "name.<index>"
+    def Oid(self, name):
+        base, sep, index = name.partition(".")
+        oid = OBJECTS[base][0]
+        return oid + (int(index),) if sep else oid
+
+    def Lookup(self, name):
+        return { 'enums': OBJECTS[name][1] }
+
+class FakeEngine():
+    class Dispatcher():
+        def runDispatcher(self):
+            pass
+
+    def __init__(self):
+        self.transportDispatcher = self.Dispatcher()
+
+class FakeSnmp():
+    def __init__(self, outlets, ups):
+        self.outlets = outlets          # { outlet: 1 (on) or 2 (off) }
+        self.ups = ups                  # { object name: value }
+        self.bulk_requests = []
+        self.set_requests = []
+        self.error = None
+
+    def bulkCmd(self, engine, community, target, context, non_repeaters, max_repetitions, *objects, cbFun):
+        self.bulk_requests.append((community, target, non_repeaters, max_repetitions, objects))
+        row = [ (OBJECTS[name][0] + (0,), value) for name, value in self.ups.items() ]
+        table = [ row ] + [ [ (OBJECTS['rPDUOutletStatusOutletState'][0] + (outlet,), state) ]
+                            for outlet, state in sorted(self.outlets.items()) ]
+        cbFun(engine, 1, self.error, 0, 0, table, None)
+
+    def setCmd(self, engine, community, target, context, *bindings):
+        self.set_requests.append(bindings)
+        yield (self.error, 0, 0, bindings)
+
+    def patch(self):
+        return mock.patch.multiple(UpsControlApc, create=True,
+                                   SnmpEngine=FakeEngine,
+                                   CommunityData=lambda community: ('community', community),
+                                   UdpTransportTarget=lambda address, timeout, retries: ('target', address),
+                                   ContextData=lambda: None,
+                                   ObjectType=lambda *args: args,
+                                   ObjectIdentity=lambda oid: oid,
+                                   Integer=int,
+                                   bulkCmd=self.bulkCmd,
+                                   setCmd=self.setCmd)
+
+PDUS = [ { 'name': "APC1", 'address': "127.0.0.1", 'port': 1161, 'community': "secret" } ]
+
+class ApcDriverTest(unittest.TestCase):
+    def setUp(self):
+        self.snmp = FakeSnmp(outlets={ 1: 1, 2: 2, 3: 1 },
+                             ups={ 'upsBasicOutputStatus': 2, 'upsAdvOutputLoad': 40,
+                                   'upsAdvBatteryRunTimeRemaining': 360000 })
+        patcher = self.snmp.patch()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.driver = ApcDriver(FakeMib(), lambda: PDUS)
+
+    def test_parse_uri(self):
+        self.assertEqual(ApcDriver.ParseUri("APC1:6"), ("APC1", 6))
+        self.assertIsNone(ApcDriver.ParseUri("APC1:x"))
+        self.assertIsNone(ApcDriver.ParseUri("IPMI:host"))
+
+    def test_poll(self):
+        state = self.driver.Poll("APC1")
+
+        self.assertEqual(state['outlets'], { 1: True, 2: False, 3: True })
+        # TimeTicks to seconds
+        self.assertEqual(state['ups'], { 'upsBasicOutputStatus': 2, 'upsAdvOutputLoad': 40,
+                                         'upsAdvBatteryRunTimeRemaining': 3600 })
+
+        # One GETBULK: the UPS scalars as non-repeaters, then the outlet state column
+        self.assertEqual(len(self.snmp.bulk_requests), 1)
+        community, target, non_repeaters, max_repetitions, objects = self.snmp.bulk_requests[0]
+        self.assertEqual(community, ('community', "secret"))
+        self.assertEqual(target, ('target', ("127.0.0.1", 1161)))
+        self.assertEqual(non_repeaters, len(UPS_OBJECTS))
+        self.assertEqual(objects[-1], ((2, 1),))
+
+    def test_poll_error(self):
+        self.snmp.error = "No SNMP response received before timeout"
+        self.assertRaises(ApcException, self.driver.Poll, "APC1")
+        self.assertRaises(ApcException, self.driver.Poll, "APC9")
+
+    def test_set_outlets(self):
+        self.driver.SetOutlets("APC1", { 3: False, 1: True })
+        self.assertEqual(self.snmp.set_requests, [ (((2, 2, 1), 1), ((2, 2, 3), 2)) ])
+
+    def test_switch_batches(self):
+        results = []
+        threads = [ threading.Thread(target=lambda uri=uri: results.append(self.driver.Switch(uri, True)))
+                    for uri in ("APC1:1", "APC1:2", "APC1:4") ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [ True ] * 3)
+        # All three went out in one SET
+        self.assertEqual(self.snmp.set_requests, [ (((2, 2, 1), 1), ((2, 2, 2), 1), ((2, 2, 4), 1)) ])
+
+    def test_switch_error(self):
+        self.snmp.error = "No SNMP response received before timeout"
+        self.assertRaises(ApcException, self.driver.Switch, "APC1:1", False)
+        self.assertRaises(ApcException, self.driver.Switch, "IPMI:host", False)
+
+if __name__ == "__main__":
+    unittest.main()
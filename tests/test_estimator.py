@@ -0,0 +1,72 @@
+#
+# test_estimator.py
+#
+# BatteryEstimator against synthetic discharges with a known Peukert law.
+#
+#   python3 -m unittest discover tests
+#
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "upscontrol"))
+
+try:
+    import numpy
+    from UpsControlEstimator import *
+except ImportError:
+    numpy = None
+
+A = 0.0004
+K = 1.3
+
+# Samples every 10 seconds at a constant load from 'charge' down to 'until' percent,
+# with the charge reported in whole percents
+def discharge(start, load, charge=100.0, until=60.0):
+    times, loads, charges = [], [], []
+    rate = A * load ** K
+    when = start
+    level = charge
+    while level > until:
+        times.append(when)
+        loads.append(load)
+        charges.append(float(int(level)))
+        when += 10
+        level -= rate * 10
+    return times, loads, charges
+
+@unittest.skipIf(numpy is None, "numpy not available")
+class BatteryEstimatorTest(unittest.TestCase):
+    def setUp(self):
+        self.estimator = BatteryEstimator(settled=600)
+        self.estimator.Update("ups1", *discharge(1000000, 40))
+        self.estimator.Update("ups1", *discharge(1100000, 80))
+
+    def test_fit(self):
+        status = self.estimator.Status("ups1")
+        self.assertAlmostEqual(status['k'], K, delta=0.1)
+        self.assertTrue(status['settled'])
+
+    def test_runtime(self):
+        expected = 50.0 / (A * 60 ** K)
+        self.assertAlmostEqual(float(self.estimator.Runtime("ups1", 60, 50)), expected, delta=expected * 0.1)
+
+    def test_runtime_after_end_discharge(self):
+        times, loads, charges = discharge(1200000, 50, until=70)
+        self.estimator.Update("ups1", times, loads, charges)
+        during = float(self.estimator.Runtime("ups1"))
+        self.estimator.EndDischarge("ups1")
+
+        # Falls back to the load and charge last seen on battery
+        self.assertEqual(float(self.estimator.Runtime("ups1")), during)
+        self.assertGreater(float(self.estimator.Runtime("ups1", 50, 100)), during)
+
+    def test_no_samples(self):
+        estimator = BatteryEstimator()
+        self.assertRaises(EstimatorException, estimator.Runtime, "ups2")
+        estimator.EndDischarge("ups2")
+        self.assertRaises(EstimatorException, estimator.Runtime, "ups2")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+#
+# test_scheduler.py
+#
+# ActivationScheduler waves, timeouts and inrush slots, with actions that record when
+# they started.
+#
+#   python3 -m unittest discover tests
+#
+
+import os
+import sys
+import time
+import unittest
+from threading import Lock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "upscontrol"))
+
+from UpsControlDependency import *
+from UpsControlInrush import *
+from UpsControlScheduler import *
+
+SLOT = 0.1
+
+def node(name, requires=(), wants=(), uri=""):
+    return { 'name': name, 'requires': list(requires), 'wants': list(wants), 'uri': uri }
+
+class Recorder():
+    def __init__(self, duration=0.0, fail=()):
+        self.duration = duration
+        self.fail = fail
+        self.lock = Lock()
+        self.starts = {}
+        self.origin = time.monotonic()
+
+    def __call__(self, node, activate):
+        with self.lock:
+            self.starts[node['name']] = time.monotonic() - self.origin
+        time.sleep(self.duration)
+        return node['name'] not in self.fail
+
+class ActivationSchedulerTest(unittest.TestCase):
+    def test_waves(self):
+        index = DependencyIndex([ node("a"), node("b"), node("c", requires=[ "a" ], wants=[ "b" ]), node("d", requires=[ "c" ]) ])
+        scheduler = ActivationScheduler(Recorder())
+        self.assertEqual(scheduler.Plan(index, [ "d" ]), [ [ "a", "b" ], [ "c" ], [ "d" ] ])
+        self.assertEqual(scheduler.Plan(index, [ "a" ], False), [ [ "d" ], [ "c" ], [ "a" ] ])
+
+    def test_failed_requirement_skips(self):
+        index = DependencyIndex([ node("a"), node("b"), node("c", requires=[ "a" ], wants=[ "b" ]) ])
+        results = ActivationScheduler(Recorder(fail=[ "a" ])).Run(index, [ "c" ])
+        self.assertEqual(results, { 'a': "failed", 'b': "ok", 'c': "skipped" })
+
+        # A failed 'want' doesn't block
+        results = ActivationScheduler(Recorder(fail=[ "b" ])).Run(index, [ "c" ])
+        self.assertEqual(results, { 'a': "ok", 'b': "failed", 'c': "ok" })
+
+    # A name that isn't (or no longer is) in the index doesn't stop the rest of the batch
+    def test_undefined_name(self):
+        index = DependencyIndex([ node("a"), node("b", requires=[ "a" ]) ])
+        recorder = Recorder()
+        results = ActivationScheduler(recorder).Run(index, [ "b", "Bogus" ])
+        self.assertEqual(results, { 'a': "ok", 'b': "ok", 'Bogus': "skipped" })
+        self.assertEqual(set(recorder.starts), set([ "a", "b" ]))
+
+    # 'between' runs before every later wave; the names it returns are left alone
+    def test_between_waves(self):
+        index = DependencyIndex([ node("a"), node("b", requires=[ "a" ]), node("c", requires=[ "b" ]) ])
+        recorder = Recorder()
+        calls = []
+
+        def between():
+            calls.append(sorted(recorder.starts))
+            return [ "b" ] if len(calls) == 1 else []
+
+        results = ActivationScheduler(recorder).Run(index, [ "c" ], between=between)
+        self.assertEqual(calls, [ [ "a" ], [ "a" ] ])
+        self.assertEqual(results, { 'a': "ok", 'b': "skipped", 'c': "skipped" })
+
+    def test_node_timeout(self):
+        index = DependencyIndex([ node("a"), node("b") ])
+        recorder = Recorder(duration=0.5)
+        started = time.monotonic()
+        results = ActivationScheduler(recorder, node_timeout=0.2).Run(index, [ "a", "b" ])
+        self.assertEqual(results, { 'a': "timeout", 'b': "timeout" })
+        self.assertLess(time.monotonic() - started, 0.45)
+
+    # Four 6A outlets on one PDU with a 10A budget: no two may start within a slot time,
+    # not even across waves (a, b -> c -> d)
+    def test_inrush_across_waves(self):
+        nodes = [ node("a", uri="APC1:1"), node("b", uri="APC1:2"),
+                  node("c", requires=[ "a", "b" ], uri="APC1:3"), node("d", requires=[ "c" ], uri="APC1:4") ]
+        index = DependencyIndex(nodes)
+        stagger = InrushPlanner(lambda node: "APC1", slot=SLOT, default_inrush=6.0, default_budget=10.0)
+        recorder = Recorder()
+
+        results = ActivationScheduler(recorder, stagger=stagger).Run(index, [ "d" ])
+
+        self.assertEqual(set(results.values()), set([ "ok" ]))
+        starts = sorted(recorder.starts.values())
+        self.assertEqual(len(starts), 4)
+        for earlier, later in zip(starts, starts[1:]):
+            self.assertGreaterEqual(later - earlier, SLOT * 0.95)
+
+    # More nodes in a slot than workers: the next slot waits until all of them started
+    def test_slot_bigger_than_pool(self):
+        nodes = [ node("n%d" % number, uri="APC1:%d" % number) for number in range(6) ]
+        index = DependencyIndex(nodes)
+        stagger = InrushPlanner(lambda node: "APC1", slot=SLOT, default_inrush=2.0, default_budget=10.0)
+        recorder = Recorder(duration=0.2)
+
+        ActivationScheduler(recorder, max_workers=4, stagger=stagger).Run(index, [ node['name'] for node in nodes ])
+
+        slots = stagger.Slots(index, [ node['name'] for node in nodes ])
+        last_of_first = max(recorder.starts[name] for name in slots[0])
+        for name in slots[1]:
+            self.assertGreaterEqual(recorder.starts[name] - last_of_first, SLOT * 0.95)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+#
+# test_schema.py
+#
+# Table and 'global' settings checks.
+#
+#   python3 -m unittest discover tests
+#
+
+import os
+import sys
+import unittest
+from copy import deepcopy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "upscontrol"))
+
+from UpsControlConfig import *
+from UpsControlSchema import *
+
+GLOBAL = DEFAULT_SYSTEM_CONFIG['global']
+
+class ValidateSettingsTest(unittest.TestCase):
+    def check(self, section, key, value):
+        settings = deepcopy(GLOBAL)
+        settings[section][key] = value
+        ValidateSettings("global", settings, GLOBAL)
+
+    def test_defaults(self):
+        ValidateSettings("global", GLOBAL, GLOBAL)
+        # Missing settings are filled in from the defaults
+        ValidateSettings("global", { 'signals': { 'window': 0.5 } }, GLOBAL)
+
+    def test_good_values(self):
+        self.check('signals', 'window', 1)
+        self.check('signals', 'max_rates', { 'activation': 2 })
+        self.check('inrush', 'outlets', { "APC1:3": 4.5 })
+        self.check('shedding', 'enabled', False)
+        self.check('metrics', 'text_file', "/run/upscontrol.prom")
+
+    def test_bad_values(self):
+        for section, key, value in (('signals', 'window', "fast"),
+                                    ('signals', 'window', -1),
+                                    ('signals', 'priority', "on-battery"),
+                                    ('signals', 'max_rates', { 'activation': "2" }),
+                                    ('inrush', 'slot', None),
+                                    ('inrush', 'budgets', [ 10 ]),
+                                    ('shedding', 'shed_below', True),
+                                    ('shedding', 'enabled', "yes"),
+                                    ('archive', 'retention_days', "35"),
+                                    ('archive', 'path', 5)):
+            self.assertRaises(SchemaException, self.check, section, key, value)
+
+        self.assertRaises(SchemaException, ValidateSettings, "global", [], GLOBAL)
+
+class ValidateTableTest(unittest.TestCase):
+    def test_default_nodes(self):
+        ValidateTable('nodes', DEFAULT_NODE_CONFIG['nodes'])
+
+    def test_duplicate_name(self):
+        table = deepcopy(DEFAULT_NODE_CONFIG['nodes'])
+        table['data'].append(dict(table['data'][0]))
+        self.assertRaises(SchemaException, ValidateTable, 'nodes', table)
+
+if __name__ == "__main__":
+    unittest.main()
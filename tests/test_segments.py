@@ -0,0 +1,85 @@
+#
+# test_segments.py
+#
+# SegmentArchive writes, indexes and queries in a temporary directory.
+#
+#   python3 -m unittest discover tests
+#
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "upscontrol"))
+
+from UpsControlSegments import *
+
+class SegmentArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        # Three hours of samples every 10 seconds, ending now
+        self.end = time.time()
+        self.start = self.end - 3 * SEGMENT_SECONDS
+        self.samples = [ (self.start + offset, float(offset % 100)) for offset in range(0, 3 * SEGMENT_SECONDS, 10) ]
+
+    def fill(self, metrics):
+        archive = SegmentArchive(self.directory)
+        archive.Start()
+        for when, value in self.samples:
+            archive.Append(when, dict((metric, value) for metric in metrics))
+        archive.Close()
+        return archive
+
+    def expected(self, step):
+        buckets = {}
+        for when, value in self.samples:
+            buckets.setdefault(int(when // step) * step, []).append(value)
+        return [ [ bucket, sum(values) / len(values), min(values), max(values) ] for bucket, values in sorted(buckets.items()) ]
+
+    def test_series(self):
+        archive = self.fill([ "pdu.APC1.ups.upsAdvOutputLoad" ])
+        for step in (10, 60, 700):
+            points = archive.Series("pdu.APC1.ups.upsAdvOutputLoad", self.start, self.end + 1, step)['points']
+            self.assertEqual(len(points), len(self.expected(step)))
+            for point, expected in zip(points, self.expected(step)):
+                self.assertAlmostEqual(point[0], expected[0])
+                self.assertAlmostEqual(point[1], expected[1])
+                self.assertEqual(point[2:], expected[2:])
+
+    def test_hourly_series_from_indexes(self):
+        archive = self.fill([ "load" ])
+        metric_dir = os.path.join(self.directory, "load")
+        self.assertTrue(any(name.endswith(".idx") for name in os.listdir(metric_dir)))
+
+        points = archive.Series("load", self.start, self.end + 1, SEGMENT_SECONDS)['points']
+        self.assertEqual(len(points), len(self.expected(SEGMENT_SECONDS)))
+
+    def test_metric_names_stay_inside(self):
+        self.fill([ "..", "../escape", ".hidden", "node.a b/c" ])
+        self.assertEqual(sorted(os.listdir(self.directory)), [ "_..", "_.._escape", "_.hidden", "node.a_b_c" ])
+        self.assertEqual(metric_dir_name(""), "_")
+
+    # Many metrics don't keep files open between batches
+    def test_no_open_files(self):
+        if not os.path.isdir("/proc/self/fd"):
+            self.skipTest("no /proc")
+        before = len(os.listdir("/proc/self/fd"))
+
+        archive = SegmentArchive(self.directory)
+        archive.Start()
+        now = time.time()
+        for second in range(3):
+            archive.Append(now + second, dict(("metric%d" % number, number) for number in range(300)))
+        time.sleep(1.5)
+        during = len(os.listdir("/proc/self/fd"))
+        archive.Close()
+
+        self.assertLess(during - before, 10)
+        self.assertEqual(len(os.listdir(self.directory)), 300)
+
+if __name__ == "__main__":
+    unittest.main()
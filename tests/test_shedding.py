@@ -0,0 +1,55 @@
+#
+# test_shedding.py
+#
+# LoadShedder plans and steps on the default node table.
+#
+#   python3 -m unittest discover tests
+#
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "upscontrol"))
+
+from UpsControlConfig import *
+from UpsControlDependency import *
+from UpsControlShedding import *
+
+class LoadShedderTest(unittest.TestCase):
+    def setUp(self):
+        self.shed = []
+        self.restored = []
+        self.shedder = LoadShedder(self.shed.append, self.restored.append, shed_below=900, hold=0)
+        self.shedder.SetIndex(DependencyIndex(DEFAULT_NODE_CONFIG['nodes']['data']))
+
+    def test_default_plan(self):
+        plan = self.shedder.Plan()
+        # Wanted-only nodes first, then what Gatekeeper requires; the main page nodes and
+        # what they require stay up
+        self.assertEqual(set(plan[:3]), set([ "Nas1", "Nas2", "Gatekeeper" ]))
+        self.assertEqual(set(plan[3:]), set([ "DmzSwitch", "NasSwitch" ]))
+        self.assertLess(plan.index("Gatekeeper"), plan.index("DmzSwitch"))
+
+    def test_shed_and_restore(self):
+        shed = self.shedder.Sample(300, load=50, on_battery=True, source="APC1")
+        self.assertNotEqual(shed, [])
+        self.assertEqual(shed, self.shedder.Plan()[:len(shed)])
+        self.assertEqual(self.shed, [ shed ])
+
+        # Enough runtime: nothing more
+        self.assertEqual(self.shedder.Sample(2000, load=20, on_battery=True, source="APC1"), [])
+
+        restored = self.shedder.Sample(None, load=20, on_battery=False, source="APC1")
+        self.assertEqual(restored, list(reversed(shed)))
+        self.assertEqual(self.shedder.Shed(), [])
+
+    def test_worst_ups(self):
+        shed = self.shedder.Sample(300, load=50, on_battery=True, source="APC1")
+        # Another UPS on line doesn't restore while APC1 is still on battery
+        self.assertEqual(self.shedder.Sample(None, load=20, on_battery=False, source="APC2"), [])
+        self.assertEqual(self.shedder.Shed(), shed)
+        self.assertEqual(self.restored, [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -16,15 +16,37 @@ from dbus.mainloop.glib import DBusGMainLoop
 from threading import Thread, RLock, Lock, Timer
 # import RPi.GPIO as GPIO
 import time
-from queue import Queue
 import syslog
 import logging
 import os
 import tempfile
+from copy import deepcopy
 from timeit import default_timer as elapsed_time
 
 from UpsControlConfig import *
 from UpsControlVartab import *
+from UpsControlScheduler import *
+from UpsControlDependency import *
+from UpsControlStorage import *
+from UpsControlPoller import *
+from UpsControlApc import *
+from UpsControlState import *
+from UpsControlSignals import *
+from UpsControlSchema import *
+from UpsControlDispatch import *
+from UpsControlActions import *
+from UpsControlQueue import *
+from UpsControlShedding import *
+from UpsControlInrush import *
+from UpsControlTelemetry import *
+from UpsControlSegments import *
+from UpsControlMetrics import *
+
+# The battery estimator needs numpy; without it the UPS's own runtime figure is used
+try:
+    from UpsControlEstimator import *
+except ImportError:
+    BatteryEstimator = None
 
 def syslog_json(name, value):
     prefix = "%s:  " % name
@@ -33,32 +55,35 @@ def syslog_json(name, value):
         syslog.syslog("%s%s" % (prefix, line))
         prefix = ""
 
-#####################################
-# Import a 'sync' function
-try:
-    # Try to use the one in the os module
-    os_sync = os.sync
-    # Test it
-    os_sync()
-    syslog.syslog("os_sync is os.sync()")
-
-except:
-    try:
-        # Try to use the one in libc
-        import ctypes
-        os_sync = ctypes.CDLL("libc.so.6").sync
-        # Test it
-        os_sync()
-        syslog.syslog("os_sync is libc.sync()")
-
-    except:
-        # If we don't find that, use a system() call
-        os_sync = lambda: os.system("sync")
-        syslog.syslog("os_sync is system('sync')")
+# Return 'value' with anything missing from it filled in from 'default' (recursively for
+# dictionaries); values already present are kept
+def merge_defaults(value, default):
+    if type(value) is dict and type(default) is dict:
+        merged = dict(value)
+        for key, item in default.items():
+            merged[key] = merge_defaults(value[key], item) if key in value else deepcopy(item)
+        return merged
+
+    return deepcopy(default) if value is None else value
 
 _BUSNAME = "com.robosity.upscontrol.control"
 _SERVICENAME = "/com/robosity/upscontrol/control"
 
+# User adjustable settings within the config
+_GLOBAL_PATH = "global"
+
+# Path of the node table within the config
+_NODES_PATH = "nodes.data"
+
+# Path of the SNMP PDU table within the config
+_PDUS_PATH = "pdus.data"
+
+# upsBasicOutputStatus onBattery(3)
+_UPS_ON_BATTERY = 3
+
+# Path of the device table within the config
+_DEVICES_PATH = "devices.data"
+
 
 class SimpleTimer():
     def __init__(self, time = 0):
@@ -110,34 +135,583 @@ class UpsControlException(dbus.DBusException):
 class UpsControl(dbus.service.Object):
     def __init__(self):
         self.__dbus_lock = Lock()
-        self.__config_lock = Lock()
-        self.__config = VarTab()
-        self.__activation_queue = Queue()
+        self.__metrics = MetricsRegistry()
+        self.__setup_metrics()
+        self.__config_lock = TimedLock(self.__lock_wait)
+        self.__config = VarTab(CONFIGFILE)
+        self.__store = VarTabStore(self.__config)
+        self.__activation_queue = ActivationQueue()
+        self.__actions = ActionExecutor()
+        self.__inrush = InrushPlanner(self.__pdu_of)
+        self.__scheduler = ActivationScheduler(self.__node_action, stagger=self.__inrush)
 
         # Put in the user portion of the config
         default_config = DEFAULT_NODE_CONFIG
 
         # Read current config file if available
-        self.__config.Load(init=default_config)
+        self.__store.Load(init=default_config)
 
-        # Overwrite defaults for all of the items in the DEFAULT_SYSTEM_CONFIG
+        # Overwrite defaults for all of the items in the DEFAULT_SYSTEM_CONFIG, except the
+        # 'global' settings: those can be changed by the user, so only add missing ones
         for item in DEFAULT_SYSTEM_CONFIG:
-            self.__config.SetValue(item, DEFAULT_SYSTEM_CONFIG[item])
+            if item == _GLOBAL_PATH:
+                try:
+                    current = self.__config.GetValue(item, evaluate=False)
+                except VarTabException:
+                    current = None
+                value = merge_defaults(current, DEFAULT_SYSTEM_CONFIG[item])
+                try:
+                    ValidateSettings(item, value, DEFAULT_SYSTEM_CONFIG[item])
+                except SchemaException as e:
+                    # Stored before settings were checked
+                    syslog.syslog("Using default %s settings: %s" % (item, str(e)))
+                    value = DEFAULT_SYSTEM_CONFIG[item]
+                self.__config.SetValue(item, value)
+            else:
+                self.__config.SetValue(item, DEFAULT_SYSTEM_CONFIG[item])
+
+        # Slow D-Bus methods run here; replies are posted back to the main loop
+        self.__dispatcher = Dispatcher(gobject.idle_add, observe=self.__observe_call)
+
+        self.__signals = SignalCoalescer(self.__emit_indicate_data,
+                                         schedule=lambda delay, func: gobject.timeout_add(int(delay * 1000), func))
+        self.__configure_signals()
+
+        self.__state_cache = StateCache()
+        self.__telemetry = TelemetryStore()
+        self.__started = False
+        self.__archive = None
+        self.__archive_settings = None
+        self.__configure_archive()
+        self.__estimator = BatteryEstimator() if BatteryEstimator is not None else None
+        self.__estimator_lock = Lock()
+        self.__shedder = LoadShedder(self.__shed_nodes, self.__restore_nodes)
+        self.__configure_shedding()
+        self.__configure_inrush()
+        self.__on_battery = set()   # Names of the UPSes running on battery
+        self.__on_battery_lock = Lock()
+        self.__poller = NodePoller(listener=self.__state_changed, observe=self.__observe_poll,
+                                   pool=IPMI_SessionPool(observer=self.__observe_bmc))
+        self.__profiler = SamplingProfiler()
+        self.__exporter = None
+        self.__metrics_settings = None
+        self.__configure_metrics()
+
+        try:
+            self.__apc = ApcDriver(MibIndex(), self.__pdu_table)
+        except Exception as e:
+            syslog.syslog("APC driver not available: %s" % str(e))
+            self.__apc = None
+
+        self.__actions.Register('apcstart', lambda node, cancel: self.__apc_switch(node, True))
+        self.__actions.Register('apcstop', lambda node, cancel: self.__apc_switch(node, False))
+
+        self.__set_node_index(DependencyIndex(self.__config.GetValue(_NODES_PATH)))
+        self.__set_pdus()
+
+    # Register the hot path metrics up front so recording never has to
+    def __setup_metrics(self):
+        metrics = self.__metrics
+        self.__lock_wait = metrics.Histogram("config_lock_wait_seconds", "Time spent waiting for the config lock")
+        self.__call_times = {}      # D-Bus method body name -> histogram, filled on first call
+        self.__call_errors = metrics.Counter("dbus_call_errors_total", "D-Bus method calls that returned an error")
+        self.__step_times = dict((activate, metrics.Histogram("activation_step_seconds", "Duration of one node start or stop",
+                                                              { 'direction': "start" if activate else "stop" }))
+                                 for activate in (True, False))
+        self.__step_results = dict((status, metrics.Counter("activation_steps_total", "Node starts and stops by result",
+                                                            { 'status': status }))
+                                   for status in (ActionResult.OK, ActionResult.FAILED, ActionResult.TIMEOUT, ActionResult.CANCELLED))
+        self.__bmc_times = metrics.Histogram("bmc_round_trip_seconds", "Duration of one IPMI command")
+        self.__bmc_errors = metrics.Counter("bmc_errors_total", "IPMI commands that failed")
+        self.__poll_times = dict((group, metrics.Histogram("poll_seconds", "Duration of one device poll", { 'group': group }))
+                                 for group in (NODE_GROUP, PDU_GROUP))
+        self.__poll_errors = dict((group, metrics.Counter("poll_errors_total", "Device polls that failed", { 'group': group }))
+                                  for group in (NODE_GROUP, PDU_GROUP))
+
+    def __observe_call(self, func, seconds, ok):
+        histogram = self.__call_times.get(func.__name__)
+        if histogram is None:
+            # e.g. _UpsControl__set_value -> set_value
+            method = func.__name__.rpartition("__")[2]
+            histogram = self.__metrics.Histogram("dbus_call_seconds", "Time from D-Bus call to reply", { 'method': method })
+            self.__call_times[func.__name__] = histogram
+        histogram.Observe(seconds)
+        if not ok:
+            self.__call_errors.Add()
+
+    def __observe_bmc(self, seconds, ok):
+        self.__bmc_times.Observe(seconds)
+        if not ok:
+            self.__bmc_errors.Add()
+
+    def __observe_poll(self, group, seconds, ok):
+        self.__poll_times[group].Observe(seconds)
+        if not ok:
+            self.__poll_errors[group].Add()
+
+    # Set up Prometheus export and the profiler from 'global.metrics'; a running exporter is
+    # replaced when its outputs change
+    def __configure_metrics(self):
+        try:
+            settings = self.__config.GetValue("global.metrics")
+        except VarTabException:
+            settings = {}
+
+        text_file = settings.get('text_file') or None
+        http_address = (settings.get('http_address', "127.0.0.1"), settings['http_port']) if settings.get('http_port') else None
+        profiling = settings.get('profiling', False)
+
+        previous_settings = self.__metrics_settings
+        self.__metrics_settings = (text_file, http_address, profiling)
+
+        # Only a change of the setting switches the profiler, so SetProfiling() holds until then
+        if self.__started and (previous_settings is None or previous_settings[2] != profiling):
+            self.__set_profiling(profiling)
+
+        if previous_settings is not None and previous_settings[:2] == (text_file, http_address):
+            return
+
+        exporter = None
+        if text_file is not None or http_address is not None:
+            exporter = MetricsExporter(self.__metrics, text_file=text_file, http_address=http_address)
+            if self.__started:
+                exporter = self.__start_exporter(exporter)
+
+        previous, self.__exporter = self.__exporter, exporter
+        if previous is not None and self.__started:
+            previous.Stop()
+
+    def __start_exporter(self, exporter):
+        try:
+            exporter.Start()
+            return exporter
+        except OSError as e:
+            syslog.syslog("Metrics export not available: %s" % str(e))
+            return None
+
+    def __set_profiling(self, on):
+        if on:
+            self.__profiler.Start()
+        else:
+            self.__profiler.Stop()
+
+    # Pick up IndicateData coalescing settings from 'global.signals'
+    def __configure_signals(self):
+        try:
+            settings = self.__config.GetValue("global.signals")
+            self.__signals.Configure(window=settings.get('window'),
+                                     max_rates=settings.get('max_rates'),
+                                     priority=settings.get('priority'))
+        except VarTabException:
+            pass
+
+    # Pick up load shedding settings from 'global.shedding'
+    def __configure_shedding(self):
+        try:
+            settings = self.__config.GetValue("global.shedding")
+            self.__shedding_source = settings.get('source', "")
+            self.__shedder.Configure(shed_below=settings.get('shed_below'),
+                                     hold=settings.get('hold'),
+                                     enabled=settings.get('enabled'))
+        except VarTabException:
+            self.__shedding_source = ""
+
+    # Set up the long-term telemetry archive from 'global.archive'; a running archive is
+    # replaced when its settings change
+    def __configure_archive(self):
+        try:
+            settings = self.__config.GetValue("global.archive")
+        except VarTabException:
+            settings = {}
+
+        wanted = (settings.get('enabled', True),
+                  settings.get('path', ARCHIVE_DIR),
+                  settings.get('retention_days', SegmentArchive.RETENTION_DAYS))
+        if wanted == self.__archive_settings:
+            return
+        self.__archive_settings = wanted
+
+        enabled, path, retention_days = wanted
+        archive = SegmentArchive(directory=path, retention_days=retention_days) if enabled else None
+        if archive is not None and self.__started:
+            archive = self.__start_archive(archive)
+
+        previous, self.__archive = self.__archive, archive
+        if previous is not None and self.__started:
+            previous.Close()
+
+    def __start_archive(self, archive):
+        try:
+            archive.Start()
+            return archive
+        except OSError as e:
+            syslog.syslog("Telemetry archive not available: %s" % str(e))
+            return None
+
+    # Pick up power-on staggering settings from 'global.inrush'
+    def __configure_inrush(self):
+        try:
+            settings = self.__config.GetValue("global.inrush")
+            self.__inrush.Configure(slot=settings.get('slot'),
+                                    inrush=settings.get('outlets'),
+                                    default_inrush=settings.get('default_inrush'),
+                                    budgets=settings.get('budgets'),
+                                    default_budget=settings.get('default_budget'),
+                                    total_budget=settings.get('total_budget'))
+        except VarTabException:
+            pass
+
+    # Name of the PDU whose outlet feeds 'node', if any
+    def __pdu_of(self, node):
+        address = ApcDriver.ParseUri(node.get('uri'))
+        return address[0] if address is not None else None
+
+    # Install a new node dependency index and pass the node list on to its users
+    def __set_node_index(self, index):
+        self.__node_index = index
+        self.__poller.SetNodes(index)
+        self.__shedder.SetIndex(index)
+
+    # True if changing 'name' can change what is at 'path' or below it
+    def __touches(self, name, path):
+        pieces = [] if name == "" else name.split(".")
+        path = path.split(".")
+        length = min(len(pieces), len(path))
+        return pieces[:length] == path[:length]
+
+    # Apply a list of (name, value) changes, or a whole new config, as one unit.  The
+    # tables involved are checked against their schema and the node table against the
+    # dependency rules; if anything fails the config is put back as it was.  The config
+    # lock must be held.
+    def __apply_changes(self, changes, config=None):
+        before = self.__config.GetSnapshot()
+        names = [ "" ] if config is not None else [ name for name, value in changes ]
+
+        try:
+            if config is not None:
+                self.__config.SetAllValues(config)
+            for name, value in changes:
+                self.__config.SetValue(name, value)
+
+            data = self.__config.GetAllValues()
+            tables = set()
+            for name in names:
+                tables |= set(data) if name == "" else set([ name.split(".")[0] ])
+            for table in tables:
+                ValidateTable(table, data.get(table))
+            if _GLOBAL_PATH in tables:
+                ValidateSettings(_GLOBAL_PATH, data.get(_GLOBAL_PATH, {}), DEFAULT_SYSTEM_CONFIG[_GLOBAL_PATH])
+
+            index = None
+            if any(self.__touches(name, _NODES_PATH) for name in names):
+                index = DependencyIndex(self.__config.GetValue(_NODES_PATH))
+                for name in index.Names():
+                    NodePoller.ParseUri(index.Node(name).get('uri'))
+
+        except (VarTabException, SchemaException, DependencyException, PollerException) as e:
+            # Snapshots are never modified, so the previous version can simply be put back
+            self.__config.SetAllValues(before.data)
+            raise UpsControlException(_BUSNAME + ".InvalidConfig", str(e))
+
+        # Put the new settings to use before they are journaled; if that fails, go back to
+        # the previous ones so what is stored is always what runs
+        try:
+            self.__use_config(index)
+        except Exception as e:
+            self.__config.SetAllValues(before.data)
+            self.__use_config(DependencyIndex(self.__config.GetValue(_NODES_PATH)) if index is not None else None)
+            raise UpsControlException(_BUSNAME + ".InvalidConfig", str(e))
+
+        if config is not None:
+            self.__store.ChangedAll(config)
+        elif len(changes) == 1:
+            self.__store.Changed(changes[0][0], changes[0][1])
+        else:
+            self.__store.ChangedMany(changes)
+
+        return names
+
+    # Pass the current config on to the poller and the other users of its settings;
+    # 'index' is a new node DependencyIndex or None if the nodes did not change
+    def __use_config(self, index):
+        if index is not None:
+            self.__set_node_index(index)
+        self.__set_pdus()
+        self.__configure_signals()
+        self.__configure_shedding()
+        self.__configure_inrush()
+        self.__configure_archive()
+        self.__configure_metrics()
+
+    # Pass the current 'pdus' table on to the poller; config lock held or not yet shared
+    def __set_pdus(self):
+        if self.__apc is not None:
+            try:
+                pdus = self.__config.GetValue(_PDUS_PATH)
+            except VarTabException:
+                pdus = []
+            names = [ pdu['name'] for pdu in pdus ]
+            self.__poller.SetPdus(self.__apc, names)
+            self.__shedder.SetSources(names)
+
+    # Poll results from the poller; store them and tell clients what changed
+    def __state_changed(self, group, name, state):
+        prefix = "%s.%s" % (group, name)
+        values = {}
+        for key, value in state.items():
+            # Time stamps change on every poll
+            if key not in ('updated', 'time'):
+                StateCache.Flatten("%s.%s" % (prefix, key), value, values)
+
+        seq, delta = self.__state_cache.Update(prefix, values)
+        if delta is not None:
+            gobject.idle_add(self.__send_delta, seq, delta)
+
+        self.__record_telemetry(prefix, state)
+
+        if group == PDU_GROUP and 'ups' in state and self.__shedding_source in ("", name):
+            self.__ups_sample(name, state['ups'], state.get('updated', time.time()))
+
+    # Keep history of the numeric readings of a poll: node power and sensor values, UPS
+    # figures and outlet states
+    def __record_telemetry(self, prefix, state):
+        if 'error' in state:
+            return
+
+        values = {}
+        if 'power' in state:
+            values[prefix + ".power"] = state['power']
+        for sensor, reading in state.get('sensors', {}).items():
+            if 'value' in reading:
+                values["%s.sensors.%s" % (prefix, sensor)] = reading['value']
+        for item, value in state.get('ups', {}).items():
+            values["%s.ups.%s" % (prefix, item)] = value
+        for outlet, on in state.get('outlets', {}).items():
+            values["%s.outlets.%s" % (prefix, outlet)] = on
+
+        when = state.get('updated', time.time())
+        self.__telemetry.Record(when, values)
+        if self.__archive is not None:
+            self.__archive.Append(when, values)
+
+    # Feed the UPS figures of a PDU poll to the load shedder
+    def __ups_sample(self, name, ups, when):
+        status = ups.get('upsBasicOutputStatus')
+        if status is None:
+            return
+
+        on_battery = status == _UPS_ON_BATTERY
+        runtime = ups.get('upsAdvBatteryRunTimeRemaining')
+        load = ups.get('upsAdvOutputLoad')
+
+        estimate = self.__estimate_runtime(name, on_battery, when, load, ups.get('upsAdvBatteryCapacity'))
+        if estimate is not None:
+            # Go by whichever figure is more pessimistic
+            runtime = estimate if runtime is None else min(runtime, estimate)
+
+        self.__shedder.Sample(runtime, load=load, on_battery=on_battery, source=name)
+
+        # Signal when the first UPS goes on battery and when the last one is back on line
+        with self.__on_battery_lock:
+            was_on_battery = len(self.__on_battery) != 0
+            if on_battery:
+                self.__on_battery.add(name)
+            else:
+                self.__on_battery.discard(name)
+            changed = (len(self.__on_battery) != 0) != was_on_battery
+        if changed:
+            self.SendIndicateData("on-battery", { 'on-battery': not was_on_battery })
+            if was_on_battery:
+                self.__autostart()
+
+    # Feed the battery estimator; returns its runtime estimate once its fit has settled
+    def __estimate_runtime(self, name, on_battery, when, load, charge):
+        if self.__estimator is None:
+            return None
+
+        with self.__estimator_lock:
+            if not on_battery:
+                self.__estimator.EndDischarge(name)
+                return None
+            if load is None or charge is None:
+                return None
+
+            self.__estimator.Update(name, [ when ], [ load ], [ charge ])
+            try:
+                if self.__estimator.Status(name)['settled']:
+                    return float(self.__estimator.Runtime(name))
+            except EstimatorException:
+                pass
+            return None
+
+    # Power returned: bring up the autostart nodes (the scheduler staggers the starts)
+    def __autostart(self):
+        index = self.__node_index
+        for name in index.Names():
+            if index.Node(name).get('autostart'):
+                self.__activation_queue.Put(name, True)
+
+    def __shed_nodes(self, names):
+        for name in names:
+            self.__activation_queue.Put(name, False, ActivationQueue.EMERGENCY)
+        self.SendIndicateData("low-battery", { 'shed': names })
+
+    def __restore_nodes(self, names):
+        for name in names:
+            self.__activation_queue.Put(name, True)
+
+    def __send_delta(self, seq, delta):
+        self.IndicateDelta(seq, json.dumps(delta, separators=(',', ':')))
+        # One shot
+        return False
+
+    def __pdu_table(self):
+        with self.__config_lock:
+            try:
+                return self.__config.GetValue(_PDUS_PATH)
+            except VarTabException:
+                return []
+
+    def __apc_switch(self, node, on):
+        if self.__apc is None:
+            raise ApcException("no APC driver")
+        return self.__apc.Switch(node['uri'], on)
+
+    # Power a single node up or down.  Returns True on success.
+    def __node_action(self, node, activate):
+        action = node.get('start' if activate else 'stop')
+        syslog.syslog("%s %s (%s)" % ("Activate" if activate else "Deactivate", node['name'], action))
+
+        result = self.__actions.Run(action, node['name'], node)
+        self.__step_times[activate].Observe(result.duration)
+        self.__step_results[result.status].Add()
+        return result.ok()
+
+    # Run the on-action or off-action of an entry in the devices table
+    def __switch_device(self, name, on):
+        with self.__config_lock:
+            devices = self.__config.GetValue(_DEVICES_PATH)
+
+        for device in devices:
+            if device.get('name') == name:
+                result = self.__actions.Run(device.get('on-action' if on else 'off-action'), name, device)
+                return json.dumps(result.as_dict())
+
+        raise UpsControlException(_BUSNAME + ".Undefined", "No device %s" % name)
+
+    # Queue a request for a node of the current node table
+    def __queue_activation(self, device, activate, priority=ActivationQueue.NORMAL):
+        if device not in self.__node_index:
+            raise UpsControlException(_BUSNAME + ".Undefined", "No node %s" % device)
+        self.__activation_queue.Put(device, activate, priority)
+
+    # Run one batch of activation requests for the same direction
+    def __run_activation(self, devices, activate, between=None):
+        try:
+            results = self.__scheduler.Run(self.__node_index, devices, activate, between)
+            self.SendIndicateData("activation", { 'activate': activate, 'devices': devices, 'results': results })
+
+        except Exception as e:
+            syslog.syslog("Activation of %s failed: %s" % (devices, str(e)))
+
+    # Run queue items (in priority order) as batches of the same direction
+    def __run_items(self, items, between=None):
+        devices = []
+        activate = None
+
+        for item in items:
+            if activate is not None and item['activate'] != activate:
+                # Direction changed; finish the previous batch first
+                self.__run_activation(devices, activate, between)
+                devices = []
+            activate = item['activate']
+            devices.append(item['device'])
+
+        if len(devices) != 0:
+            self.__run_activation(devices, activate, between)
+
+    # Called between the waves of a batch: run emergency requests that arrived since it
+    # started, and return the nodes they took down so the batch leaves them alone
+    def __run_emergencies(self):
+        items = self.__activation_queue.GetUrgent(ActivationQueue.EMERGENCY)
+        if len(items) == 0:
+            return ()
+
+        syslog.syslog("Emergency requests ahead of the running batch: %s" % [ item['device'] for item in items ])
+        self.__run_items(items)
+
+        index = self.__node_index
+        stopped = set()
+        for item in items:
+            if not item['activate'] and item['device'] in index:
+                stopped |= index.Dependents(item['device'])
+        return stopped
 
     def __activation_thread(self):
-        running = True
-
-        while running:
-            item = self.__activation_queue.get()
-            if type(item) is dict:
-                if 'activate' in item:
-                    if item['activate']:
-                        syslog.syslog("Activate %s" % item['device'])
-                    else:
-                        syslog.syslog("Deactivate %s" % item['device'])
-            elif item is None:
+        while True:
+            # Everything waiting, highest priority first.  Requests arriving together
+            # (e.g. after a power outage) are planned as one set of waves.
+            items = self.__activation_queue.GetAll()
+            if len(items) == 0:
                 syslog.syslog("activation_thread stopping")
-                running = False
+                break
+
+            self.__run_items(items, self.__run_emergencies)
+
+    # Bodies of the config D-Bus methods; these run on the dispatcher workers
+
+    def __set_value(self, name, value):
+        value = json.loads(value)
+
+        with self.__config_lock:
+            names = self.__apply_changes([ (name, value) ])
+
+        self.SendIndicateData("config-changed", dict((name, True) for name in names))
+
+    def __set_values(self, values):
+        changes = [ (str(name), json.loads(value)) for name, value in values.items() ]
+
+        with self.__config_lock:
+            names = self.__apply_changes(changes)
+
+        self.SendIndicateData("config-changed", dict((name, True) for name in names))
+
+    def __get_value(self, name):
+        with self.__config_lock:
+            if name == "":
+                snapshot = self.__config.GetSnapshot()
+            else:
+                value = self.__config.GetValue(name)
+
+        # Values are shared immutable views, so they can be encoded outside of the lock
+        return snapshot.Json() if name == "" else json.dumps(value)
+
+    def __get_values(self, names):
+        values = {}
+
+        with self.__config_lock:
+            try:
+                for name in names:
+                    values[str(name)] = self.__config.GetValue(name)
+            except VarTabException as e:
+                raise UpsControlException(_BUSNAME + ".Undefined", str(e))
+
+        return json.dumps(values)
+
+    def __set_config(self, config):
+        config = json.loads(config)
+
+        with self.__config_lock:
+            names = self.__apply_changes([], config=config)
+
+        self.SendIndicateData("config-changed", dict((name, True) for name in names))
+
+    def __get_config(self):
+        with self.__config_lock:
+            snapshot = self.__config.GetSnapshot()
+
+        # Encoded once per version of the config
+        return snapshot.Json()
 
     def run(self):
 
@@ -145,6 +719,21 @@ class UpsControl(dbus.service.Object):
         self.__activation_thread_id = Thread(target=self.__activation_thread)
         self.__activation_thread_id.start()
 
+        # Settings changes from here on restart the background services they affect
+        self.__started = True
+
+        if self.__archive is not None:
+            self.__archive = self.__start_archive(self.__archive)
+
+        if self.__exporter is not None:
+            self.__exporter = self.__start_exporter(self.__exporter)
+
+        if self.__metrics_settings[2]:
+            self.__set_profiling(True)
+
+        # Start polling the BMCs
+        self.__poller.Start()
+
         gobject.threads_init()
         dbus.mainloop.glib.threads_init()
         DBusGMainLoop(set_as_default=True)
@@ -175,10 +764,29 @@ class UpsControl(dbus.service.Object):
         syslog.syslog ("UpsControl Service stopped")
 
         # shutdown activation thread
-        self.__activation_queue.put(None)
+        self.__activation_queue.Close()
         self.__activation_thread_id.join()
 
+        self.__poller.Stop()
+        self.__dispatcher.Shutdown()
+        if self.__archive is not None:
+            self.__archive.Close()
+        if self.__exporter is not None:
+            self.__exporter.Stop()
+        self.__profiler.Stop()
+        self.__actions.Shutdown()
+
+        # Write out anything still waiting for the save timer
+        try:
+            self.__store.Close()
+        except VarTabException as e:
+            syslog.syslog("Config save failed: %s" % str(e))
+
+    # Updates are merged per reason and rate limited; priority reasons go out at once
     def SendIndicateData(self, reason, data=None):
+        self.__signals.Send(reason, data)
+
+    def __emit_indicate_data(self, reason, data):
         self.IndicateData(reason, json.dumps(data))
 
     # Data as json string
@@ -186,40 +794,138 @@ class UpsControl(dbus.service.Object):
     def IndicateData(self, reason, data=None):
         pass
 
+    # Changed state values (json object of key: value, null when removed) with sequence number
+    @dbus.service.signal(_BUSNAME, signature='ts')
+    def IndicateDelta(self, seq, delta):
+        pass
+
+    # Everything that changed after sequence number 'seq'; returns json with 'seq',
+    # 'full' (True when 'changes' is the complete state) and 'changes'
+    @dbus.service.method(_BUSNAME, in_signature='t', out_signature='s')
+    def GetStateSince(self, seq):
+        seq, full, changes = self.__state_cache.Since(seq)
+        return json.dumps({ 'seq': seq, 'full': full, 'changes': changes })
+
+    # History of a metric (e.g. "pdu.APC1.ups.upsAdvOutputLoad") between two unix times as
+    # json with 'metric', 'step' and 'points' ([ time, mean, min, max ] per step).
+    # If metric is blank, returns the list of metric names.
+    @dbus.service.method(_BUSNAME, in_signature='sddd', out_signature='s')
+    def GetSeries(self, metric, start, end, step):
+        if metric == "":
+            return json.dumps(self.__telemetry.Names())
+        try:
+            return json.dumps(self.__telemetry.Series(metric, start, end, step))
+        except TelemetryException as e:
+            raise UpsControlException(_BUSNAME + ".Undefined", str(e))
+
+    def __get_history(self, metric, start, end, step):
+        if self.__archive is None:
+            raise UpsControlException(_BUSNAME + ".Undefined", "Telemetry archive disabled")
+        try:
+            return json.dumps(self.__archive.Series(metric, start, end, step))
+        except SegmentException as e:
+            raise UpsControlException(_BUSNAME + ".Undefined", str(e))
+
+    # Like GetSeries, but from the on-disk archive, which goes back 'retention_days'.
+    # Steps of an hour or more only read the per-segment indexes.
+    @dbus.service.method(_BUSNAME, in_signature='sddd', out_signature='s', async_callbacks=('reply', 'error'))
+    def GetHistory(self, metric, start, end, step, reply, error):
+        self.__dispatcher.Run(self.__get_history, (metric, start, end, step), reply, error)
+
+    # Battery model of the UPS behind a PDU as json: 'a', 'k', 'weight', 'settled', 'health'
+    # and 'runtime' (seconds at the last load and charge)
+    @dbus.service.method(_BUSNAME, in_signature='s', out_signature='s')
+    def GetBatteryEstimate(self, name):
+        if self.__estimator is None:
+            raise UpsControlException(_BUSNAME + ".Undefined", "Battery estimator needs numpy")
+        with self.__estimator_lock:
+            try:
+                status = self.__estimator.Status(name)
+                status['runtime'] = float(self.__estimator.Runtime(name))
+            except EstimatorException as e:
+                raise UpsControlException(_BUSNAME + ".Undefined", str(e))
+        return json.dumps(status)
+
+    # Counters and latency histograms as json: { name: [ { 'labels', 'value' } or
+    # { 'labels', 'buckets', 'counts', 'count', 'sum' } ] }
+    @dbus.service.method(_BUSNAME, in_signature='', out_signature='s')
+    def GetMetrics(self):
+        return json.dumps(self.__metrics.Snapshot())
+
+    # Switch the sampling profiler on or off; switching on drops earlier samples
+    @dbus.service.method(_BUSNAME, in_signature='b')
+    def SetProfiling(self, on):
+        self.__set_profiling(on)
+
+    # Collapsed stacks sampled by the profiler ("frame;frame;... count" per line)
+    @dbus.service.method(_BUSNAME, in_signature='', out_signature='s')
+    def GetProfile(self):
+        return self.__profiler.Collapsed()
+
     # Activates a device and all dependencies
     @dbus.service.method(_BUSNAME, in_signature='s')
     def Activate(self, device):
-        self.__activation_queue.put({'device': device, 'activate': True})
+        self.__queue_activation(device, True)
 
     # Deactivates a device and all dependencies
     @dbus.service.method(_BUSNAME, in_signature='s')
-    def Activate(self, device):
-        self.__activation_queue.put({'device': device, 'activate': False})
+    def Deactivate(self, device):
+        self.__queue_activation(device, False)
+
+    # Deactivates a device ahead of any routine requests (e.g. on battery)
+    @dbus.service.method(_BUSNAME, in_signature='s')
+    def EmergencyDeactivate(self, device):
+        self.__queue_activation(device, False, ActivationQueue.EMERGENCY)
+
+    # Drop a request for a device that has not started yet; returns True if there was one
+    @dbus.service.method(_BUSNAME, in_signature='s', out_signature='b')
+    def CancelActivation(self, device):
+        return self.__activation_queue.Cancel(device)
+
+    # Activation queue depth and wait time counters as json
+    @dbus.service.method(_BUSNAME, in_signature='', out_signature='s')
+    def GetQueueStats(self):
+        return json.dumps(self.__activation_queue.Stats())
+
+    # Run the on-action (on=True) or off-action of a device; returns json with 'status',
+    # 'exit_status', 'duration' and 'error'
+    @dbus.service.method(_BUSNAME, in_signature='sb', out_signature='s', async_callbacks=('reply', 'error'))
+    def SwitchDevice(self, name, on, reply, error):
+        self.__dispatcher.Run(self.__switch_device, (name, on), reply, error)
 
     # Send value as dbus 'value'
-    @dbus.service.method(_BUSNAME, in_signature='ss')
-    def SetValue(self, name, value):
-        with self.__config_lock:
-            self.__config.SetValue(name, json.loads(value))
+    @dbus.service.method(_BUSNAME, in_signature='ss', async_callbacks=('reply', 'error'))
+    def SetValue(self, name, value, reply, error):
+        self.__dispatcher.Run(self.__set_value, (name, value), reply, error)
 
-        # Debug
-        # self.SendIndicateData("info", "value of '%s' set to %s" % (name, value))
+    # Set several values at once; 'values' maps names to json values.  Either all of
+    # them are applied or none are.
+    @dbus.service.method(_BUSNAME, in_signature='a{ss}', async_callbacks=('reply', 'error'))
+    def SetValues(self, values, reply, error):
+        self.__dispatcher.Run(self.__set_values, (values,), reply, error)
 
     # Receive data as dbus 'value'
     # If name is blank, retrieve all of the config
-    @dbus.service.method(_BUSNAME, in_signature='s', out_signature='s')
-    def GetValue(self, name):
-        with self.__config_lock:
-            return json.dumps(self.__config.GetValue(name))
+    @dbus.service.method(_BUSNAME, in_signature='s', out_signature='s', async_callbacks=('reply', 'error'))
+    def GetValue(self, name, reply, error):
+        self.__dispatcher.Run(self.__get_value, (name,), reply, error)
+
+    # Get several values at once; returns json object of name: value
+    @dbus.service.method(_BUSNAME, in_signature='as', out_signature='s', async_callbacks=('reply', 'error'))
+    def GetValues(self, names, reply, error):
+        self.__dispatcher.Run(self.__get_values, (names,), reply, error)
 
     # Set full config
-    @dbus.service.method(_BUSNAME, in_signature='s')
-    def SetConfig(self, config):
-        with self.__config_lock:
-            self.__config.SetAllValus(json.loads(config))
+    @dbus.service.method(_BUSNAME, in_signature='s', async_callbacks=('reply', 'error'))
+    def SetConfig(self, config, reply, error):
+        self.__dispatcher.Run(self.__set_config, (config,), reply, error)
 
     # Get full config
-    @dbus.service.method(_BUSNAME, in_signature='', out_signature='s')
-    def GetConfig(self):
-        with self.__config_lock:
-            return json.dumps(self.__config.GetAllValues())
+    @dbus.service.method(_BUSNAME, in_signature='', out_signature='s', async_callbacks=('reply', 'error'))
+    def GetConfig(self, reply, error):
+        self.__dispatcher.Run(self.__get_config, (), reply, error)
+
+    # Get last polled power and sensor state of a node (all nodes if name is blank)
+    @dbus.service.method(_BUSNAME, in_signature='s', out_signature='s')
+    def GetNodeState(self, name):
+        return json.dumps(self.__poller.GetState(name))
@@ -0,0 +1,228 @@
+#
+# UpsControlActions.py
+#
+# Registry and executor for the node 'start'/'stop' and device 'on-action'/'off-action'
+# strings.
+#
+# An action string is either the name of a registered Python callable (e.g. 'apcstart')
+# or 'cmd:<program> <arguments>' for an external command.  The program must be in
+# ACTION_DIR, a root-owned directory that only root can write to, so a client that can
+# change the config can only choose between commands the administrator installed.
+# Commands get the target's fields in the environment as UPS_<FIELD> (UPS_NAME, UPS_URI,
+# UPS_DNS, ...), except for credentials.
+#
+# Actions run on a bounded pool with a timeout.  A second request for the same action on
+# the same target while the first is still running joins the first instead of running
+# again, so a double click on Activate sends one power command.
+#
+
+import os
+import shlex
+import signal
+import subprocess
+import syslog
+import time
+from threading import Lock, Event
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, CancelledError
+
+COMMAND_PREFIX = "cmd:"
+ACTION_DIR = "/etc/upscontrol/actions"
+
+# Fields never passed to commands
+CREDENTIAL_FIELDS = ( 'username', 'password', 'community' )
+
+class ActionException(Exception):
+    pass
+
+# Outcome of one action
+class ActionResult():
+    OK = "ok"
+    FAILED = "failed"
+    TIMEOUT = "timeout"
+    CANCELLED = "cancelled"
+
+    def __init__(self, action, target):
+        self.action = action
+        self.target = target
+        self.status = None
+        self.exit_status = None
+        self.duration = None
+        self.error = None
+
+    def ok(self):
+        return self.status == self.OK
+
+    def as_dict(self):
+        return {
+            'action': self.action,
+            'target': self.target,
+            'status': self.status,
+            'exit_status': self.exit_status,
+            'duration': self.duration,
+            'error': self.error,
+        }
+
+class ActionExecutor():
+    MAX_WORKERS = 4
+    TIMEOUT = 60
+
+    def __init__(self, max_workers=MAX_WORKERS, timeout=TIMEOUT, action_dir=ACTION_DIR):
+        self.__timeout = timeout
+        self.__action_dir = action_dir
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.__lock = Lock()
+        self.__actions = {}         # name -> func(context, cancel) returning True on success
+        self.__running = {}         # (target, action) -> (future, cancel event, process holder)
+
+    # Make 'func' available as action 'name'.  It is called as func(context, cancel) where
+    # context is the node or device record and cancel an Event set on cancellation.
+    def Register(self, name, func):
+        with self.__lock:
+            self.__actions[name] = func
+
+    # Full path of the program of a command line; it has to be a root-owned file in the
+    # action directory that only root can change
+    def __program(self, command):
+        if not command:
+            raise ActionException("Empty command")
+
+        directory = os.path.realpath(self.__action_dir)
+        path = os.path.realpath(os.path.join(directory, command[0]))
+        if os.path.dirname(path) != directory:
+            raise ActionException("%s is not in %s" % (command[0], self.__action_dir))
+
+        for item in (directory, path):
+            info = os.stat(item)
+            if info.st_uid != 0 or info.st_mode & 0o022:
+                raise ActionException("%s is not owned and only writable by root" % item)
+
+        return path
+
+    def __run_command(self, command, context, cancel, holder):
+        command = shlex.split(command)
+        command[0] = self.__program(command)
+
+        environment = dict(os.environ)
+        for key, value in context.items():
+            if type(value) in (str, int, float, bool) and key.lower() not in CREDENTIAL_FIELDS:
+                environment["UPS_%s" % key.upper().replace("-", "_")] = str(value)
+
+        process = subprocess.Popen(command, env=environment,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                   start_new_session=True)
+        holder.append(process)
+
+        try:
+            stderr = process.communicate(timeout=self.__timeout)[1]
+        except subprocess.TimeoutExpired:
+            self.__kill(process)
+            process.wait()
+            raise
+
+        if cancel.is_set():
+            return None, process.returncode, None
+
+        return process.returncode == 0, process.returncode, stderr.decode(errors="replace").strip() or None
+
+    def __kill(self, process):
+        try:
+            # Whole process group, in case the command started children
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def __execute(self, action, target, context, cancel, holder):
+        result = ActionResult(action, target)
+        started = time.monotonic()
+
+        try:
+            if action.startswith(COMMAND_PREFIX):
+                ok, result.exit_status, result.error = self.__run_command(action[len(COMMAND_PREFIX):], context, cancel, holder)
+            else:
+                with self.__lock:
+                    func = self.__actions.get(action)
+                if func is None:
+                    raise ActionException("Unknown action %s" % action)
+                ok = bool(func(context, cancel))
+
+            if cancel.is_set():
+                result.status = ActionResult.CANCELLED
+            else:
+                result.status = ActionResult.OK if ok else ActionResult.FAILED
+
+        except subprocess.TimeoutExpired:
+            result.status = ActionResult.TIMEOUT
+
+        except Exception as e:
+            result.status = ActionResult.FAILED
+            result.error = str(e)
+
+        finally:
+            result.duration = time.monotonic() - started
+            with self.__lock:
+                self.__running.pop((target, action), None)
+
+        syslog.syslog("Action %s on %s: %s in %.2fs" % (action, target, result.status, result.duration))
+        return result
+
+    # Start 'action' for 'target' (unless the same one is already running) and return its future
+    def Submit(self, action, target, context):
+        with self.__lock:
+            key = (target, action)
+            if key in self.__running:
+                return self.__running[key][0]
+
+            cancel = Event()
+            holder = []
+            future = self.__executor.submit(self.__execute, action, target, context, cancel, holder)
+            self.__running[key] = (future, cancel, holder)
+            return future
+
+    # Run 'action' and wait for it; returns ActionResult
+    def Run(self, action, target, context, timeout=None):
+        if not action:
+            # Nothing configured
+            result = ActionResult(action, target)
+            result.status = ActionResult.OK
+            result.duration = 0
+            return result
+
+        future = self.Submit(action, target, context)
+        try:
+            return future.result(timeout=timeout if timeout is not None else self.__timeout)
+
+        except CancelledError:
+            result = ActionResult(action, target)
+            result.status = ActionResult.CANCELLED
+            result.duration = 0
+            return result
+
+        except TimeoutError:
+            # Python actions can't be stopped from outside; tell them and move on
+            self.Cancel(target, action)
+            result = ActionResult(action, target)
+            result.status = ActionResult.TIMEOUT
+            result.duration = timeout if timeout is not None else self.__timeout
+            return result
+
+    # Cancel running actions on 'target' (only 'action' if given).  Returns number cancelled.
+    def Cancel(self, target, action=None):
+        count = 0
+        with self.__lock:
+            for (running_target, running_action), (future, cancel, holder) in list(self.__running.items()):
+                if running_target == target and (action is None or running_action == action):
+                    cancel.set()
+                    if future.cancel():
+                        # Never started, so __execute won't clean up
+                        del(self.__running[(running_target, running_action)])
+                    for process in holder:
+                        self.__kill(process)
+                    count += 1
+        return count
+
+    def Shutdown(self):
+        with self.__lock:
+            running = list(self.__running)
+        for target, action in running:
+            self.Cancel(target, action)
+        self.__executor.shutdown(wait=False)
@@ -0,0 +1,202 @@
+#
+# UpsControlApc.py
+#
+# SNMP driver for APC switched PDUs and UPSs behind 'APCn:m' node uris.
+#
+# 'APC1:6' is outlet 6 of the PDU named APC1 in the 'pdus' table.  All outlet states
+# and the UPS battery/load figures of one device are read with a single GETBULK, and
+# outlet commands for the same PDU that arrive within BATCH_WINDOW of each other go
+# out as one SET.  Pointing a 'pdus' entry at a local SNMP simulator (address and
+# port) is enough to exercise the driver without hardware.
+#
+
+import time
+from threading import Lock, Event, local
+
+# Without pysnmp the module still loads (ParseUri works) but ApcDriver can't be created
+try:
+    from pysnmp.hlapi import SnmpEngine, CommunityData, UdpTransportTarget, ContextData, ObjectType, ObjectIdentity, setCmd
+    from pysnmp.hlapi.asyncore import bulkCmd
+    from pysnmp.proto.rfc1902 import Integer
+except ImportError:
+    SnmpEngine = None
+
+from UpsControlMib import *
+
+APC_URI_PREFIX = "APC"
+
+# Outlet objects per PDU family: state column, command column and their values
+OUTLET_PROFILES = {
+    'rPDU': {
+        'state': 'rPDUOutletStatusOutletState', 'state_on': 'outletStatusOn',
+        'command': 'rPDUOutletControlOutletCommand', 'on': 'immediateOn', 'off': 'immediateOff',
+    },
+    'sPDU': {
+        'state': 'sPDUOutletCtl', 'state_on': 'outletOn',
+        'command': 'sPDUOutletCtl', 'on': 'outletOn', 'off': 'outletOff',
+    },
+}
+
+# UPS scalars read with every poll
+UPS_OBJECTS = [
+    'upsBasicOutputStatus',
+    'upsBasicBatteryStatus',
+    'upsAdvBatteryCapacity',
+    'upsAdvBatteryRunTimeRemaining',
+    'upsAdvOutputLoad',
+]
+
+class ApcException(Exception):
+    pass
+
+class ApcDriver():
+    MAX_OUTLETS = 48
+    BATCH_WINDOW = 0.05
+    TIMEOUT = 2
+    RETRIES = 1
+
+    # 'mib' is a MibIndex; 'pdus' is called with no arguments and returns the 'pdus' table data
+    def __init__(self, mib, pdus, timeout=TIMEOUT, retries=RETRIES):
+        if SnmpEngine is None:
+            raise ApcException("pysnmp is not installed")
+
+        self.__mib = mib
+        self.__pdus = pdus
+        self.__timeout = timeout
+        self.__retries = retries
+        self.__lock = Lock()
+        self.__batches = {}     # pdu name -> pending batch of outlet commands
+        self.__local = local()  # SnmpEngine per thread
+
+    # Returns (pdu name, outlet number) for an APC uri, else None
+    @staticmethod
+    def ParseUri(uri):
+        if uri is None or not uri.startswith(APC_URI_PREFIX):
+            return None
+
+        name, sep, outlet = uri.partition(":")
+        if not sep or not outlet.isdigit():
+            return None
+
+        return name, int(outlet)
+
+    def __engine(self):
+        engine = getattr(self.__local, 'engine', None)
+        if engine is None:
+            engine = SnmpEngine()
+            self.__local.engine = engine
+        return engine
+
+    def __pdu(self, name):
+        for pdu in self.__pdus():
+            if pdu.get('name') == name:
+                return pdu
+        raise ApcException("Undefined PDU %s" % name)
+
+    def __profile(self, pdu):
+        profile = OUTLET_PROFILES.get(pdu.get('profile') or 'rPDU')
+        if profile is None:
+            raise ApcException("Unknown PDU profile %s" % pdu.get('profile'))
+        return profile
+
+    def __target(self, pdu):
+        port = int(pdu.get('port') or 161)
+        return (CommunityData(pdu.get('community') or 'private'),
+                UdpTransportTarget((pdu['address'], port), timeout=self.__timeout, retries=self.__retries))
+
+    # Read outlet states and UPS figures of one device with a single GETBULK
+    def Poll(self, name):
+        pdu = self.__pdu(name)
+        profile = self.__profile(pdu)
+        community, target = self.__target(pdu)
+
+        scalars = [ self.__mib.Oid(item) for item in UPS_OBJECTS ]
+        column = self.__mib.Oid(profile['state'])
+        state_on = self.__mib.Lookup(profile['state'])['enums'][profile['state_on']]
+
+        reply = {}
+
+        def response(engine, handle, error_indication, error_status, error_index, table, context):
+            reply['error'] = error_indication or (error_status and error_status.prettyPrint())
+            reply['table'] = table
+            # Only the first response; don't continue the walk
+            return False
+
+        engine = self.__engine()
+        bulkCmd(engine, community, target, ContextData(),
+                len(scalars), self.MAX_OUTLETS,
+                *([ ObjectType(ObjectIdentity(oid)) for oid in scalars ] + [ ObjectType(ObjectIdentity(column)) ]),
+                cbFun=response)
+        engine.transportDispatcher.runDispatcher()
+
+        if reply.get('error'):
+            raise ApcException("%s: %s" % (name, reply['error']))
+
+        ups = {}
+        outlets = {}
+
+        for row in reply.get('table') or []:
+            for oid, value in row:
+                oid = tuple(oid)
+                for item, base in zip(UPS_OBJECTS, scalars):
+                    if oid == base + (0,):
+                        ups[item] = int(value)
+                if oid[:len(column)] == column and len(oid) == len(column) + 1:
+                    outlets[oid[-1]] = int(value) == state_on
+
+        if 'upsAdvBatteryRunTimeRemaining' in ups:
+            # TimeTicks are hundredths of a second
+            ups['upsAdvBatteryRunTimeRemaining'] //= 100
+
+        return { 'outlets': outlets, 'ups': ups, 'time': time.time() }
+
+    # Set several outlets of one PDU in one SET request; commands is { outlet: on }
+    def SetOutlets(self, name, commands):
+        pdu = self.__pdu(name)
+        profile = self.__profile(pdu)
+        community, target = self.__target(pdu)
+        enums = self.__mib.Lookup(profile['command'])['enums']
+
+        bindings = []
+        for outlet, on in sorted(commands.items()):
+            oid = self.__mib.Oid("%s.%d" % (profile['command'], outlet))
+            bindings.append(ObjectType(ObjectIdentity(oid), Integer(enums[profile['on'] if on else profile['off']])))
+
+        error_indication, error_status, error_index, bindings = next(
+            setCmd(self.__engine(), community, target, ContextData(), *bindings))
+
+        if error_indication or error_status:
+            raise ApcException("%s: %s" % (name, error_indication or error_status.prettyPrint()))
+
+    # Switch the outlet behind 'uri'.  Commands for the same PDU are gathered for
+    # BATCH_WINDOW seconds by the first caller and sent together.
+    def Switch(self, uri, on):
+        address = self.ParseUri(uri)
+        if address is None:
+            raise ApcException("Not an APC uri: %s" % uri)
+        name, outlet = address
+
+        with self.__lock:
+            batch = self.__batches.get(name)
+            leader = batch is None
+            if leader:
+                batch = { 'commands': {}, 'done': Event(), 'error': None }
+                self.__batches[name] = batch
+            batch['commands'][outlet] = on
+
+        if leader:
+            time.sleep(self.BATCH_WINDOW)
+            with self.__lock:
+                del(self.__batches[name])
+            try:
+                self.SetOutlets(name, batch['commands'])
+            except Exception as e:
+                batch['error'] = e
+            batch['done'].set()
+        else:
+            batch['done'].wait()
+
+        if batch['error'] is not None:
+            raise ApcException(str(batch['error']))
+
+        return True
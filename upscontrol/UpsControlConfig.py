@@ -17,6 +17,44 @@ DEFAULT_SYSTEM_CONFIG = {
     "version": 1,
     "global": {
         # Global configuration goes here
+        "signals": {
+            "window": 0.1,                          # Seconds IndicateData updates are held and merged per reason
+            "max_rates": {                          # Maximum IndicateData signals per second, per reason
+            },
+            "priority": [                           # Reasons sent at once, never held back
+                "on-battery",
+                "low-battery",
+                "shutdown",
+                "activation",
+            ],
+        },
+        "shedding": {
+            "enabled": True,                        # Shed non-critical nodes when runtime runs short on battery
+            "source": "",                           # PDU whose UPS figures are used ("" for any)
+            "shed_below": 900,                      # Target battery runtime in seconds
+            "hold": 60,                             # Seconds to let readings settle between steps
+        },
+        "inrush": {
+            "slot": 2.0,                            # Seconds between staggered power-on slots
+            "default_inrush": 2.0,                  # Amps drawn by an outlet at power on, unless listed below
+            "outlets": {                            # Inrush amps per outlet uri, e.g. "APC1:3": 4.5
+            },
+            "default_budget": 10.0,                 # Amps of inrush a PDU may take per slot, unless listed below
+            "budgets": {                            # Inrush budget per PDU, e.g. "APC1": 12.0
+            },
+            "total_budget": 0,                      # Amps of inrush the UPS may take per slot (0 for no limit)
+        },
+        "archive": {
+            "enabled": True,                        # Keep telemetry on disk for capacity planning
+            "path": "/var/lib/upscontrol/telemetry",    # Directory of the hourly segment files
+            "retention_days": 35,                   # Segments older than this are removed
+        },
+        "metrics": {
+            "text_file": "",                        # Write Prometheus text here (e.g. for the node exporter)
+            "http_address": "127.0.0.1",            # Serve Prometheus text on http://<address>:<port>/metrics
+            "http_port": 0,                         # 0 to not serve it
+            "profiling": False,                     # Run the sampling profiler (see GetProfile)
+        },
     },
     "available": [
         # List of available devices seen by scanner
@@ -291,5 +329,43 @@ DEFAULT_NODE_CONFIG = {
             "password": "",
             "autostart": False,
         }],
-    }
+    },
+    # SNMP managed APC PDUs and UPSs; 'APC1:6' in a node uri is outlet 6 of 'APC1'
+    "pdus": {
+        "schema": {
+            "name": "<unique-item>",                # name used in node uris
+            "address": "<str>",                     # host name or address
+            "port": "<str>",                        # SNMP port
+            "community": "<password>",              # SNMP write community
+            "profile": [ "<one-of>", "rPDU", "sPDU" ],  # Switched rack PDU or MasterSwitch outlet table
+        },
+        "headers": {
+            "name": "Name",
+            "address": "Address",
+            "port": "Port",
+            "community": "Community",
+            "profile": "Outlet Table",
+        },
+        'table_fields': [
+            'name',
+            'address',
+            'profile',
+        ],
+        'edit_fields': [
+            'name',
+            'address',
+            'port',
+            'community',
+            'profile',
+        ],
+        'default': {
+            "name": None,
+            "address": "",
+            "port": "161",
+            "community": "private",
+            "profile": "rPDU",
+        },
+        "data": [
+        ],
+    },
 }
@@ -0,0 +1,157 @@
+#
+# UpsControlDependency.py
+#
+# Precompiled dependency index over the 'nodes.data' table.
+#
+# The index is built once each time the node table changes and is never modified
+# afterwards, so it can be shared between threads without locking.  Building it
+# checks for undefined names and dependency cycles so a bad table is refused when
+# it is applied rather than in the middle of a power-on.
+#
+# The activation and dependents closures are only worked out when asked for and then
+# remembered per name.  Building them all up front costs O(N^2) time and memory, while
+# an activation only ever needs a few of them.  Two threads asking for the same closure
+# at once both compute the same set, so the cache needs no lock either.
+#
+
+class DependencyException(Exception):
+    pass
+
+class DependencyIndex():
+    def __init__(self, nodes=()):
+        self.__nodes = {}           # name -> node record
+        self.__requires = {}        # name -> tuple of required names
+        self.__wants = {}           # name -> tuple of wanted names
+        self.__required_by = {}     # name -> tuple of names that require it
+        self.__wanted_by = {}       # name -> tuple of names that want it
+        self.__order = ()           # topological order (dependencies first)
+        self.__depth = {}           # name -> longest dependency chain below it
+        self.__activation = {}      # name -> frozenset of everything needed to start it, once asked for
+        self.__dependents = {}      # name -> frozenset of everything that requires it, once asked for
+
+        for node in nodes:
+            name = node.get('name')
+            if name is None:
+                raise DependencyException("Node without a name")
+            if name in self.__nodes:
+                raise DependencyException("Duplicate node %s" % name)
+            self.__nodes[name] = node
+            self.__requires[name] = tuple(node.get('requires') or [])
+            self.__wants[name] = tuple(node.get('wants') or [])
+
+        required_by = {}
+        wanted_by = {}
+        for name in self.__nodes:
+            for dep in self.__requires[name]:
+                if dep not in self.__nodes:
+                    raise DependencyException("%s requires undefined node %s" % (name, dep))
+                required_by.setdefault(dep, []).append(name)
+            for dep in self.__wants[name]:
+                if dep not in self.__nodes:
+                    raise DependencyException("%s wants undefined node %s" % (name, dep))
+                wanted_by.setdefault(dep, []).append(name)
+
+        for name in self.__nodes:
+            self.__required_by[name] = tuple(required_by.get(name, []))
+            self.__wanted_by[name] = tuple(wanted_by.get(name, []))
+
+        self.__sort()
+
+
+    # Depth-first topological sort with cycle detection
+    def __sort(self):
+        order = []
+        state = {}      # name -> 1 while visiting, 2 when done
+
+        for root in self.__nodes:
+            if root in state:
+                continue
+
+            stack = [ (root, iter(self.__requires[root] + self.__wants[root])) ]
+            state[root] = 1
+            while len(stack) != 0:
+                name, deps = stack[-1]
+                advanced = False
+                for dep in deps:
+                    if state.get(dep) == 1:
+                        path = [ entry[0] for entry in stack ]
+                        path = path[path.index(dep):] + [ dep ]
+                        raise DependencyException("Dependency cycle: %s" % " -> ".join(path))
+                    if dep not in state:
+                        state[dep] = 1
+                        stack.append((dep, iter(self.__requires[dep] + self.__wants[dep])))
+                        advanced = True
+                        break
+
+                if not advanced:
+                    stack.pop()
+                    state[name] = 2
+                    level = 0
+                    for dep in self.__requires[name] + self.__wants[name]:
+                        level = max(level, self.__depth[dep] + 1)
+                    self.__depth[name] = level
+                    order.append(name)
+
+        self.__order = tuple(order)
+
+    def __check(self, name):
+        if name not in self.__nodes:
+            raise DependencyException("Undefined node %s" % name)
+
+    def __contains__(self, name):
+        return name in self.__nodes
+
+    def Names(self):
+        return self.__order
+
+    def Node(self, name):
+        self.__check(name)
+        return self.__nodes[name]
+
+    def Requires(self, name):
+        self.__check(name)
+        return self.__requires[name]
+
+    def Wants(self, name):
+        self.__check(name)
+        return self.__wants[name]
+
+    def RequiredBy(self, name):
+        self.__check(name)
+        return self.__required_by[name]
+
+    def WantedBy(self, name):
+        self.__check(name)
+        return self.__wanted_by[name]
+
+    def Depth(self, name):
+        self.__check(name)
+        return self.__depth[name]
+
+    # Everything reachable from 'name' (including it) through 'neighbours', remembered in 'cache'
+    def __closure(self, name, neighbours, cache):
+        self.__check(name)
+        closure = cache.get(name)
+        if closure is None:
+            found = set([ name ])
+            pending = [ name ]
+            while pending:
+                for dep in neighbours(pending.pop()):
+                    if dep not in found:
+                        found.add(dep)
+                        pending.append(dep)
+            closure = frozenset(found)
+            cache[name] = closure
+        return closure
+
+    # Everything (including 'name') that must or should be up before 'name' can start
+    def ActivationSet(self, name):
+        return self.__closure(name, lambda dep: self.__requires[dep] + self.__wants[dep], self.__activation)
+
+    # Everything (including 'name') that has to go down when 'name' goes down
+    def Dependents(self, name):
+        return self.__closure(name, lambda dep: self.__required_by[dep], self.__dependents)
+
+    # Return the members of 'names' in topological order (dependencies first)
+    def Ordered(self, names):
+        return [ name for name in self.__order if name in names ]
@@ -0,0 +1,56 @@
+#
+# UpsControlDispatch.py
+#
+# Runs D-Bus method bodies on a worker pool.
+#
+# Methods declared with async_callbacks=('reply', 'error') hand their work to Run() and
+# return at once, so the main loop keeps serving other clients and emitting signals
+# while a slow call (lock waits, encoding a large config, device I/O) is in progress.
+# Only the reply itself is passed back to the main loop.
+#
+
+import syslog
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as elapsed_time
+
+class Dispatcher():
+    MAX_WORKERS = 4
+
+    # post(func, *args) must run func(*args) on the main loop (e.g. GLib idle_add).
+    # observe, if given, is called as observe(func, seconds, ok) after every call, with
+    # the time from Run() to the reply being posted.
+    def __init__(self, post, max_workers=MAX_WORKERS, observe=None):
+        self.__post = post
+        self.__observe = observe
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __call(self, func, args, reply, error, submitted):
+        try:
+            result = func(*args)
+
+        except Exception as e:
+            self.__post(error, e)
+            if self.__observe is not None:
+                self.__observe(func, elapsed_time() - submitted, False)
+            return
+
+        if self.__observe is not None:
+            self.__observe(func, elapsed_time() - submitted, True)
+
+        if result is None:
+            self.__post(reply)
+        else:
+            self.__post(reply, result)
+
+    # Run func(*args) on a worker and send its return value (or exception) with reply/error
+    def Run(self, func, args, reply, error):
+        try:
+            self.__executor.submit(self.__call, func, args, reply, error, elapsed_time())
+
+        except RuntimeError as e:
+            # Pool already shut down
+            syslog.syslog("Dispatcher: %s" % str(e))
+            error(e)
+
+    def Shutdown(self):
+        self.__executor.shutdown(wait=True)
@@ -0,0 +1,190 @@
+#
+# UpsControlEstimator.py
+#
+# Battery runtime and health estimate per UPS from its load and charge history.
+#
+# On battery, the charge drops at a rate that grows faster than the load (Peukert):
+#
+#     rate = a * load ** k        i.e.  log(rate) = log(a) + k * log(load)
+#
+# The charge is only reported in whole percents, so a rate is measured between two
+# points where the charge changed, against the mean load over that interval.  The
+# (log load, log rate) pairs go into weighted least squares sums that decay with a
+# half life, so the fit follows the battery as it ages and every new batch of samples
+# is an O(1) update of the sums instead of a refit.  A prior on k keeps the fit sane
+# while the UPS has only seen one load level.
+#
+# Runtime remaining is (charge - cutoff) / rate at the given load; health is the runtime
+# at REFERENCE_LOAD now against that of the first settled fit (1.0 = as new).
+#
+
+import math
+import numpy
+
+class EstimatorException(Exception):
+    pass
+
+class BatteryEstimator():
+    HALF_LIFE = 90 * 86400      # Seconds for old discharge data to lose half its weight
+    PEUKERT = 1.2               # Prior exponent
+    PRIOR_WEIGHT = 50.0         # Strength of the prior on k
+    SETTLED = 1800.0            # Seconds of discharge data before the fit is trusted
+    CUTOFF = 0.0                # Charge (percent) at which the UPS gives up
+    REFERENCE_LOAD = 50.0       # Load (percent) at which health is compared
+
+    def __init__(self, half_life=HALF_LIFE, peukert=PEUKERT, prior_weight=PRIOR_WEIGHT,
+                 settled=SETTLED, cutoff=CUTOFF):
+        self.__half_life = half_life
+        self.__peukert = peukert
+        self.__prior_weight = prior_weight
+        self.__settled = settled
+        self.__cutoff = cutoff
+        self.__ups = {}
+
+    def __state(self, name):
+        state = self.__ups.get(name)
+        if state is None:
+            state = {
+                'sums': numpy.zeros(5),     # weight, x, y, xx, xy
+                'updated': None,            # time of the last decay
+                'last': None,               # (time, load, charge) of the last sample
+                'ended': None,              # 'last' of the previous discharge
+                'anchor': None,             # (time, load integral, charge) at the last charge change
+                'exact': False,             # Anchor is at a charge change, not just the first sample
+                'integral': 0.0,            # load * seconds since the first sample
+                'reference': None,          # (a, k) of the first settled fit
+            }
+            self.__ups[name] = state
+        return state
+
+    # Add samples of one UPS taken on battery: arrays (or lists) of unix times, load in percent
+    # and charge in percent, in time order.  Call EndDischarge() when the UPS goes back on line.
+    def Update(self, name, times, loads, charges):
+        times = numpy.asarray(times, dtype=float)
+        loads = numpy.asarray(loads, dtype=float)
+        charges = numpy.asarray(charges, dtype=float)
+        if len(times) == 0:
+            return
+
+        state = self.__state(name)
+
+        if state['last'] is not None:
+            last_time, last_load, last_charge = state['last']
+            keep = times > last_time
+            times, loads, charges = times[keep], loads[keep], charges[keep]
+            if len(times) == 0:
+                return
+            times = numpy.concatenate(([ last_time ], times))
+            loads = numpy.concatenate(([ last_load ], loads))
+            charges = numpy.concatenate(([ last_charge ], charges))
+
+        # Load integral at every sample (load held until the next sample)
+        integral = state['integral'] + numpy.concatenate(([ 0.0 ], numpy.cumsum(loads[:-1] * numpy.diff(times))))
+
+        if state['anchor'] is None:
+            state['anchor'] = (times[0], integral[0], charges[0])
+            state['exact'] = False
+
+        # Points where the charge changed
+        changes = numpy.flatnonzero(numpy.diff(charges)) + 1
+
+        anchor_time, anchor_integral, anchor_charge = state['anchor']
+        if len(changes) != 0:
+            # Intervals between consecutive changes, starting at the stored anchor
+            start_times = numpy.concatenate(([ anchor_time ], times[changes[:-1]]))
+            start_integrals = numpy.concatenate(([ anchor_integral ], integral[changes[:-1]]))
+            start_charges = numpy.concatenate(([ anchor_charge ], charges[changes[:-1]]))
+
+            spans = times[changes] - start_times
+            drops = start_charges - charges[changes]
+            mean_loads = (integral[changes] - start_integrals) / numpy.where(spans > 0, spans, 1)
+
+            # Discharging intervals only; a charging step just moves the anchor.  The first
+            # interval after a fresh anchor started somewhere within a percent, so skip it.
+            use = (spans > 0) & (drops > 0) & (mean_loads > 0)
+            use[0] &= state['exact']
+            if use.any():
+                x = numpy.log(mean_loads[use])
+                y = numpy.log(drops[use] / spans[use])
+                w = spans[use]
+                self.__decay(state, times[changes][use][-1])
+                state['sums'] += numpy.array([ w.sum(), (w * x).sum(), (w * y).sum(), (w * x * x).sum(), (w * x * y).sum() ])
+
+            last_change = changes[-1]
+            state['anchor'] = (times[last_change], integral[last_change], charges[last_change])
+            state['exact'] = True
+
+        state['integral'] = integral[-1]
+        state['last'] = (times[-1], loads[-1], charges[-1])
+
+        if state['reference'] is None and state['sums'][0] >= self.__settled:
+            state['reference'] = self.__fit(state)
+
+    # The UPS is no longer on battery; the next Update() starts a new discharge
+    def EndDischarge(self, name):
+        state = self.__ups.get(name)
+        if state is not None:
+            if state['last'] is not None:
+                state['ended'] = state['last']
+            state['last'] = None
+            state['anchor'] = None
+            state['integral'] = 0.0
+
+    def __decay(self, state, now):
+        if state['updated'] is not None and now > state['updated']:
+            state['sums'] *= 0.5 ** ((now - state['updated']) / self.__half_life)
+        state['updated'] = now
+
+    # Returns (a, k) for the state's sums, pulled towards the prior exponent
+    def __fit(self, state):
+        weight, sx, sy, sxx, sxy = state['sums']
+        if weight <= 0:
+            raise EstimatorException("No discharge data")
+
+        # Minimise sum(w * (y - b - k x)^2) + prior_weight * (k - peukert)^2
+        matrix = numpy.array([ [ weight, sx ], [ sx, sxx + self.__prior_weight ] ])
+        vector = numpy.array([ sy, sxy + self.__prior_weight * self.__peukert ])
+        b, k = numpy.linalg.solve(matrix, vector)
+        return math.exp(b), k
+
+    def Names(self):
+        return list(self.__ups)
+
+    # Runtime remaining in seconds at 'load' percent (scalar or array) from 'charge' percent;
+    # both default to the last sample, or that of the previous discharge when on line
+    def Runtime(self, name, load=None, charge=None):
+        state = self.__ups.get(name)
+        if state is None:
+            raise EstimatorException("No data for %s" % name)
+
+        a, k = self.__fit(state)
+        last = state['last'] if state['last'] is not None else state['ended']
+        if last is None and (load is None or charge is None):
+            raise EstimatorException("No samples for %s" % name)
+        if load is None:
+            load = last[1]
+        if charge is None:
+            charge = last[2]
+
+        load = numpy.maximum(numpy.asarray(load, dtype=float), 1e-3)
+        return numpy.maximum(charge - self.__cutoff, 0.0) / (a * load ** k)
+
+    # { 'a', 'k', 'weight' (seconds of discharge data), 'settled', 'health' (None until settled) }
+    def Status(self, name):
+        state = self.__ups.get(name)
+        if state is None:
+            raise EstimatorException("No data for %s" % name)
+
+        a, k = self.__fit(state)
+        health = None
+        if state['reference'] is not None:
+            reference_a, reference_k = state['reference']
+            health = (reference_a * self.REFERENCE_LOAD ** reference_k) / (a * self.REFERENCE_LOAD ** k)
+
+        return {
+            'a': a,
+            'k': float(k),
+            'weight': float(state['sums'][0]),
+            'settled': state['reference'] is not None,
+            'health': health,
+        }
@@ -0,0 +1,86 @@
+#
+# UpsControlInrush.py
+#
+# Staggered power-on within the current limits of the PDUs.
+#
+# Switching on many outlets of one PDU at the same moment adds up their inrush currents
+# and can trip its breaker.  The nodes of an activation wave are therefore packed into
+# time slots: within a slot the estimated inrush on each PDU stays under that PDU's
+# budget (and the total under the UPS budget, if one is set), and slots start 'slot'
+# seconds apart, once the previous inrush has died down.  Nodes on different PDUs share
+# a slot freely.  Packing is first fit, largest inrush first, which keeps the number of
+# slots (and so the restore time) close to the minimum.
+#
+# Inrush figures are per outlet uri (e.g. "APC1:3") in amps; outlets without a figure use
+# the default.  Nodes not behind a PDU outlet don't count against any budget.
+#
+
+class InrushPlanner():
+    SLOT = 2.0                  # Seconds between slots
+    DEFAULT_INRUSH = 2.0        # Amps per outlet when not configured
+    DEFAULT_BUDGET = 10.0       # Amps per PDU when not configured
+
+    # pdu_of(node) returns the name of the PDU feeding the node, or None
+    def __init__(self, pdu_of, slot=SLOT, inrush=None, default_inrush=DEFAULT_INRUSH,
+                 budgets=None, default_budget=DEFAULT_BUDGET, total_budget=None):
+        self.__pdu_of = pdu_of
+        self.__slot = slot
+        self.__inrush = inrush if inrush is not None else {}
+        self.__default_inrush = default_inrush
+        self.__budgets = budgets if budgets is not None else {}
+        self.__default_budget = default_budget
+        self.__total_budget = total_budget
+
+    def Configure(self, slot=None, inrush=None, default_inrush=None, budgets=None, default_budget=None, total_budget=None):
+        if slot is not None:
+            self.__slot = slot
+        if inrush is not None:
+            self.__inrush = dict(inrush)
+        if default_inrush is not None:
+            self.__default_inrush = default_inrush
+        if budgets is not None:
+            self.__budgets = dict(budgets)
+        if default_budget is not None:
+            self.__default_budget = default_budget
+        # 0 turns the UPS budget off
+        if total_budget is not None:
+            self.__total_budget = total_budget or None
+
+    def SlotTime(self):
+        return self.__slot
+
+    def Inrush(self, node):
+        return self.__inrush.get(node.get('uri'), self.__default_inrush)
+
+    # Split 'names' (nodes that may all start now) into a list of slots, each a list of names
+    def Slots(self, index, names):
+        entries = []
+        for name in names:
+            node = index.Node(name)
+            pdu = self.__pdu_of(node)
+            entries.append((self.Inrush(node) if pdu is not None else 0.0, name, pdu))
+
+        # Largest first; ties by name so the plan is stable
+        entries.sort(key=lambda entry: (-entry[0], entry[1]))
+
+        slots = []                  # [ names, { pdu: amps }, total amps ]
+        for amps, name, pdu in entries:
+            budget = self.__budgets.get(pdu, self.__default_budget)
+            for slot in slots:
+                used = slot[1].get(pdu, 0.0)
+                # An outlet over budget on its own still gets a slot of its own
+                fits = pdu is None or used == 0.0 or used + amps <= budget
+                if fits and self.__total_budget is not None and slot[2] > 0.0:
+                    fits = slot[2] + amps <= self.__total_budget
+                if fits:
+                    break
+            else:
+                slot = [ [], {}, 0.0 ]
+                slots.append(slot)
+
+            slot[0].append(name)
+            if pdu is not None:
+                slot[1][pdu] = slot[1].get(pdu, 0.0) + amps
+                slot[2] += amps
+
+        return [ sorted(slot[0]) for slot in slots ]
@@ -0,0 +1,294 @@
+#
+# UpsControlMetrics.py
+#
+# Counters and latency histograms for the daemon's hot paths, with Prometheus text export
+# and a sampling profiler that can be switched on while things are slow.
+#
+# Histograms have fixed bucket bounds and preallocated array counts, so recording a
+# sample is a bisect and two increments under a lock; nothing is allocated per sample.
+# Metrics are registered once up front, including one child per label value.
+#
+
+import os
+import sys
+import syslog
+import time
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Counter as _Tally
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread, Event
+
+# Upper bounds in seconds: 10us .. 60s
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+class MetricsException(Exception):
+    pass
+
+class MetricCounter():
+    def __init__(self, name, help, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.__lock = Lock()
+        self.__value = array('Q', [ 0 ])
+
+    def Add(self, amount=1):
+        with self.__lock:
+            self.__value[0] += amount
+
+    def Value(self):
+        return self.__value[0]
+
+class MetricHistogram():
+    def __init__(self, name, help, labels=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+        self.__lock = Lock()
+        # One count per bucket plus +Inf, then the sum in its own array
+        self.__counts = array('Q', [ 0 ]) * (len(self.buckets) + 1)
+        self.__sum = array('d', [ 0.0 ])
+
+    def Observe(self, seconds):
+        slot = bisect_left(self.buckets, seconds)
+        with self.__lock:
+            self.__counts[slot] += 1
+            self.__sum[0] += seconds
+
+    # (per bucket counts, count, sum)
+    def Value(self):
+        with self.__lock:
+            counts = list(self.__counts)
+            total = self.__sum[0]
+        return counts, sum(counts), total
+
+# Lock that records how long each acquire waited
+class TimedLock():
+    def __init__(self, histogram, lock=None):
+        self.__histogram = histogram
+        self.__lock = lock if lock is not None else Lock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        started = time.perf_counter()
+        acquired = self.__lock.acquire(blocking, timeout)
+        self.__histogram.Observe(time.perf_counter() - started)
+        return acquired
+
+    def release(self):
+        self.__lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+class MetricsRegistry():
+    def __init__(self, prefix="upscontrol_"):
+        self.__prefix = prefix
+        self.__lock = Lock()
+        self.__metrics = {}         # (name, sorted label items) -> metric
+        self.__order = []
+
+    def __add(self, kind, name, help, labels, **args):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.__lock:
+            metric = self.__metrics.get(key)
+            if metric is None:
+                metric = kind(self.__prefix + name, help, labels, **args)
+                self.__metrics[key] = metric
+                self.__order.append(metric)
+            elif type(metric) is not kind:
+                raise MetricsException("%s registered as another type" % name)
+            return metric
+
+    def Counter(self, name, help, labels=None):
+        return self.__add(MetricCounter, name, help, labels)
+
+    def Histogram(self, name, help, labels=None, buckets=LATENCY_BUCKETS):
+        return self.__add(MetricHistogram, name, help, labels, buckets=buckets)
+
+    def __metrics_list(self):
+        with self.__lock:
+            return list(self.__order)
+
+    # { name: [ { 'labels', 'value' } or { 'labels', 'buckets', 'counts', 'count', 'sum' } ] }
+    def Snapshot(self):
+        snapshot = {}
+        for metric in self.__metrics_list():
+            if type(metric) is MetricCounter:
+                entry = { 'labels': metric.labels, 'value': metric.Value() }
+            else:
+                counts, count, total = metric.Value()
+                entry = { 'labels': metric.labels, 'buckets': list(metric.buckets),
+                          'counts': counts, 'count': count, 'sum': total }
+            snapshot.setdefault(metric.name, []).append(entry)
+        return snapshot
+
+    # Prometheus text exposition format
+    def PrometheusText(self):
+        def label_text(labels, extra=None):
+            items = sorted(labels.items()) + ([ extra ] if extra else [])
+            if not items:
+                return ""
+            return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                     for key, value in items)
+
+        lines = []
+        described = set()
+        for metric in self.__metrics_list():
+            kind = "counter" if type(metric) is MetricCounter else "histogram"
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append("# HELP %s %s" % (metric.name, metric.help))
+                lines.append("# TYPE %s %s" % (metric.name, kind))
+
+            if kind == "counter":
+                lines.append("%s%s %d" % (metric.name, label_text(metric.labels), metric.Value()))
+            else:
+                counts, count, total = metric.Value()
+                running = 0
+                for bound, bucket_count in zip(metric.buckets + ( "+Inf", ), counts):
+                    running += bucket_count
+                    lines.append("%s_bucket%s %d" % (metric.name, label_text(metric.labels, ("le", bound)), running))
+                lines.append("%s_sum%s %.9f" % (metric.name, label_text(metric.labels), total))
+                lines.append("%s_count%s %d" % (metric.name, label_text(metric.labels), count))
+
+        return "\n".join(lines) + "\n"
+
+# Writes the Prometheus text to a file (for the node exporter textfile collector) and/or
+# serves it on a local HTTP port
+class MetricsExporter():
+    INTERVAL = 15
+
+    def __init__(self, registry, text_file=None, http_address=None, interval=INTERVAL):
+        self.__registry = registry
+        self.__text_file = text_file
+        self.__http_address = http_address
+        self.__interval = interval
+        self.__stop = Event()
+        self.__thread = None
+        self.__server = None
+
+    def __write_file(self):
+        temp_file = "%s.tmp" % self.__text_file
+        try:
+            with open(temp_file, "w") as f:
+                f.write(self.__registry.PrometheusText())
+            os.replace(temp_file, self.__text_file)
+        except OSError as e:
+            syslog.syslog("Metrics file %s: %s" % (self.__text_file, str(e)))
+
+    def __file_thread(self):
+        while not self.__stop.is_set():
+            self.__write_file()
+            self.__stop.wait(self.__interval)
+
+    def Start(self):
+        self.__stop.clear()
+
+        if self.__text_file:
+            self.__thread = Thread(target=self.__file_thread, daemon=True)
+            self.__thread.start()
+
+        if self.__http_address:
+            registry = self.__registry
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path != "/metrics":
+                        self.send_error(404)
+                        return
+                    body = registry.PrometheusText().encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.__server = ThreadingHTTPServer(self.__http_address, Handler)
+            self.__server.daemon_threads = True
+            Thread(target=self.__server.serve_forever, daemon=True).start()
+
+    def Stop(self):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+# Samples the stacks of all threads every 'interval' seconds while running and counts the
+# collapsed stacks ("outer;...;inner" of file:function:line), ready for a flame graph
+class SamplingProfiler():
+    INTERVAL = 0.01
+    MAX_DEPTH = 32
+
+    def __init__(self, interval=INTERVAL):
+        self.__interval = interval
+        self.__lock = Lock()
+        self.__stacks = _Tally()
+        self.__samples = 0
+        self.__stop = Event()
+        self.__thread = None
+
+    def Running(self):
+        return self.__thread is not None
+
+    def __sample(self):
+        me = threading.get_ident()
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            names = []
+            while frame is not None and len(names) < self.MAX_DEPTH:
+                code = frame.f_code
+                names.append("%s:%s:%d" % (os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+                frame = frame.f_back
+            names.reverse()
+            stacks.append(";".join(names))
+
+        with self.__lock:
+            self.__samples += 1
+            self.__stacks.update(stacks)
+
+    def __profile_thread(self):
+        while not self.__stop.wait(self.__interval):
+            self.__sample()
+
+    # Start sampling; earlier samples are dropped
+    def Start(self):
+        if self.__thread is not None:
+            return
+        with self.__lock:
+            self.__stacks = _Tally()
+            self.__samples = 0
+        self.__stop.clear()
+        self.__thread = Thread(target=self.__profile_thread, daemon=True)
+        self.__thread.start()
+
+    def Stop(self):
+        if self.__thread is None:
+            return
+        self.__stop.set()
+        self.__thread.join()
+        self.__thread = None
+
+    # Collapsed stacks with their counts, most frequent first, one per line
+    def Collapsed(self, limit=None):
+        with self.__lock:
+            return "\n".join("%s %d" % (stack, count) for stack, count in self.__stacks.most_common(limit))
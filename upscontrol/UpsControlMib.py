@@ -0,0 +1,295 @@
+#
+# UpsControlMib.py
+#
+# Compiled, memory-mapped index of the APC PowerNet MIB.
+#
+# Parsing the 84k line MIB text takes a while, so it is compiled once into a compact
+# binary index (on first use, or ahead of time by running this module) and then only
+# memory mapped.  Lookups are binary searches over the mapped file, so only the pages
+# actually touched are read and the MIB is never loaded into memory as a whole.
+#
+# Index layout (all integers little endian):
+#   header    magic, record count, offset of name ordered records, offset of oid ordered
+#             record numbers
+#   records   fixed size, ordered by name: name, oid, syntax, enumerations (offset and
+#             length into the data area) and access code
+#   oid order record numbers ordered by oid
+#   data      names, syntax and enumeration text (utf-8) and oids (uint32 arcs)
+#
+
+import mmap
+import os
+import re
+import struct
+import sys
+
+MIB_FILE = "/usr/share/upscontrol/mibs/PowerNet-MIB.txt"
+MIB_INDEX_FILE = "/var/cache/upscontrol/PowerNet-MIB.idx"
+
+# Where the imported roots live
+MIB_ROOTS = {
+    'iso': (1,),
+    'org': (1, 3),
+    'dod': (1, 3, 6),
+    'internet': (1, 3, 6, 1),
+    'mgmt': (1, 3, 6, 1, 2),
+    'mib-2': (1, 3, 6, 1, 2, 1),
+    'private': (1, 3, 6, 1, 4),
+    'enterprises': (1, 3, 6, 1, 4, 1),
+}
+
+ACCESS_CODES = [ "not-accessible", "read-only", "read-write", "write-only", "read-create", "accessible-for-notify" ]
+
+_MAGIC = b"UPSMIB01"
+_HEADER = struct.Struct("<8sIII")
+_RECORD = struct.Struct("<IHIHIHIHB")   # name, oid, syntax, enums (offset, length) and access
+
+_TOKENS = re.compile(r'--[^\n]*|"[^"]*"|::=|\.\.|[A-Za-z0-9_-]+|\S')
+
+class MibException(Exception):
+    pass
+
+# Parse MIB text into { name: (parent, number, syntax, access, enums) } for every
+# OBJECT IDENTIFIER and OBJECT-TYPE definition
+def _parse_mib(text):
+    tokens = [ token for token in _TOKENS.findall(text) if not token.startswith("--") ]
+    definitions = {}
+    pos = 0
+    count = len(tokens)
+
+    while pos < count - 1:
+        name = tokens[pos]
+
+        if name == "IMPORTS":
+            # Skip the import list; it names macros like OBJECT-TYPE without defining them
+            while pos < count and tokens[pos] != ";":
+                pos += 1
+
+        elif tokens[pos + 1] == "OBJECT" and pos + 7 < count and tokens[pos + 2] == "IDENTIFIER" and tokens[pos + 3] == "::=":
+            # name OBJECT IDENTIFIER ::= { parent number }
+            definitions[name] = (tokens[pos + 5], int(tokens[pos + 6]), "", "", "")
+            pos += 8
+
+        elif tokens[pos + 1] == "OBJECT-TYPE":
+            syntax = []
+            access = ""
+            pos += 2
+            while pos < count and tokens[pos] != "::=":
+                if tokens[pos] == "SYNTAX":
+                    pos += 1
+                    while pos < count and tokens[pos] not in ("ACCESS", "MAX-ACCESS", "STATUS", "::="):
+                        syntax.append(tokens[pos])
+                        pos += 1
+                elif tokens[pos] in ("ACCESS", "MAX-ACCESS"):
+                    access = tokens[pos + 1]
+                    pos += 2
+                else:
+                    pos += 1
+
+            if pos + 4 >= count or tokens[pos + 1] != "{":
+                # Not a parent reference we understand
+                pos += 1
+                continue
+
+            # Enumerations look like: name ( number )
+            enums = []
+            for index in range(len(syntax) - 3):
+                if syntax[index + 1] == "(" and syntax[index + 3] == ")" and re.match(r'-?[0-9]+$', syntax[index + 2]) and re.match(r'[a-zA-Z]', syntax[index]):
+                    enums.append("%s=%s" % (syntax[index], syntax[index + 2]))
+
+            base = syntax[0] if len(syntax) != 0 else ""
+            if base == "SEQUENCE" and len(syntax) > 2:
+                base = "SEQUENCE OF %s" % syntax[2]
+            elif base == "OCTET":
+                base = "OCTET STRING"
+
+            definitions[name] = (tokens[pos + 2], int(tokens[pos + 3]), base, access, ",".join(enums))
+            pos += 5
+
+        else:
+            pos += 1
+
+    return definitions
+
+# Resolve parent references into full oids
+def _resolve(definitions):
+    oids = {}
+
+    def resolve(name, depth=0):
+        if name in oids:
+            return oids[name]
+        if name in MIB_ROOTS:
+            return MIB_ROOTS[name]
+        if name not in definitions or depth > 64:
+            raise MibException("Unresolved OID parent %s" % name)
+        parent, number = definitions[name][:2]
+        oid = resolve(parent, depth + 1) + (number,)
+        oids[name] = oid
+        return oid
+
+    for name in definitions:
+        resolve(name)
+
+    return oids
+
+# Compile 'mib_file' into the binary index 'index_file'
+def CompileMib(mib_file=MIB_FILE, index_file=MIB_INDEX_FILE):
+    with open(mib_file, "r", encoding="latin-1") as f:
+        definitions = _parse_mib(f.read())
+
+    oids = _resolve(definitions)
+    names = sorted(definitions)
+
+    data = bytearray()
+    def add(blob):
+        offset = len(data)
+        data.extend(blob)
+        return offset
+
+    records = bytearray()
+    for name in names:
+        parent, number, syntax, access, enums = definitions[name]
+        oid = oids[name]
+        name_bytes = name.encode()
+        syntax_bytes = syntax.encode()
+        enum_bytes = enums.encode()
+        access_code = ACCESS_CODES.index(access) + 1 if access in ACCESS_CODES else 0
+        records += _RECORD.pack(add(name_bytes), len(name_bytes),
+                                add(struct.pack("<%dI" % len(oid), *oid)), len(oid),
+                                add(syntax_bytes), len(syntax_bytes),
+                                add(enum_bytes), len(enum_bytes),
+                                access_code)
+
+    by_oid = sorted(range(len(names)), key=lambda index: oids[names[index]])
+    oid_order = struct.pack("<%dI" % len(by_oid), *by_oid)
+
+    # Offsets in the records are relative to the data area that follows the oid order
+    records_offset = _HEADER.size
+    oid_order_offset = records_offset + len(records)
+
+    directory = os.path.dirname(os.path.abspath(index_file))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    temp_file = "%s.tmp" % index_file
+    with open(temp_file, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, len(names), records_offset, oid_order_offset))
+        f.write(records)
+        f.write(oid_order)
+        f.write(data)
+    os.replace(temp_file, index_file)
+
+    return len(names)
+
+class MibIndex():
+    # Open the index, compiling it first if it is missing or older than the MIB text
+    def __init__(self, index_file=MIB_INDEX_FILE, mib_file=MIB_FILE):
+        if mib_file is not None and os.path.exists(mib_file):
+            if not os.path.exists(index_file) or os.path.getmtime(index_file) < os.path.getmtime(mib_file):
+                CompileMib(mib_file, index_file)
+
+        with open(index_file, "rb") as f:
+            self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.__count, self.__records, self.__oid_order = _HEADER.unpack_from(self.__map, 0)
+        if magic != _MAGIC:
+            raise MibException("%s is not a MIB index" % index_file)
+
+        self.__data = self.__oid_order + 4 * self.__count
+
+    def Close(self):
+        self.__map.close()
+
+    def __len__(self):
+        return self.__count
+
+    def __record(self, number):
+        return _RECORD.unpack_from(self.__map, self.__records + number * _RECORD.size)
+
+    def __name(self, record):
+        return self.__map[self.__data + record[0]:self.__data + record[0] + record[1]]
+
+    def __oid(self, record):
+        return struct.unpack_from("<%dI" % record[3], self.__map, self.__data + record[2])
+
+    def __text(self, offset, length):
+        return self.__map[self.__data + offset:self.__data + offset + length].decode()
+
+    # Binary search on name; returns record number or None
+    def __find_name(self, name):
+        key = name.encode()
+        low, high = 0, self.__count
+        while low < high:
+            middle = (low + high) // 2
+            found = self.__name(self.__record(middle))
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return middle
+        return None
+
+    # Binary search on oid; returns record number or None
+    def __find_oid(self, oid):
+        low, high = 0, self.__count
+        while low < high:
+            middle = (low + high) // 2
+            number = struct.unpack_from("<I", self.__map, self.__oid_order + 4 * middle)[0]
+            found = self.__oid(self.__record(number))
+            if found < oid:
+                low = middle + 1
+            elif found > oid:
+                high = middle
+            else:
+                return number
+        return None
+
+    def __object(self, number):
+        record = self.__record(number)
+        enums = {}
+        if record[7] != 0:
+            for item in self.__text(record[6], record[7]).split(","):
+                key, value = item.split("=")
+                enums[key] = int(value)
+
+        return {
+            'name': self.__name(record).decode(),
+            'oid': self.__oid(record),
+            'syntax': self.__text(record[4], record[5]),
+            'access': ACCESS_CODES[record[8] - 1] if record[8] != 0 else "",
+            'enums': enums,
+        }
+
+    # Return the object definition for 'name'
+    def Lookup(self, name):
+        number = self.__find_name(name)
+        if number is None:
+            raise MibException("Unknown MIB object %s" % name)
+        return self.__object(number)
+
+    # Return oid tuple for 'name' or 'name.instance' (e.g. sPDUOutletCtl.3)
+    def Oid(self, name):
+        base, sep, instance = name.partition(".")
+        number = self.__find_name(base)
+        if number is None:
+            raise MibException("Unknown MIB object %s" % base)
+        oid = self.__oid(self.__record(number))
+        if sep:
+            oid = oid + tuple(int(arc) for arc in instance.split("."))
+        return oid
+
+    # Return (object definition, instance suffix) for the closest defined parent of 'oid'
+    def Resolve(self, oid):
+        oid = tuple(oid)
+        for length in range(len(oid), 0, -1):
+            number = self.__find_oid(oid[:length])
+            if number is not None:
+                return self.__object(number), oid[length:]
+        raise MibException("Unknown OID %s" % ".".join(str(arc) for arc in oid))
+
+if __name__ == '__main__':
+    # Build step: UpsControlMib.py [mib-file [index-file]]
+    mib_file = sys.argv[1] if len(sys.argv) > 1 else MIB_FILE
+    index_file = sys.argv[2] if len(sys.argv) > 2 else MIB_INDEX_FILE
+    print("%d objects compiled into %s" % (CompileMib(mib_file, index_file), index_file))
@@ -0,0 +1,191 @@
+#
+# UpsControlPoller.py
+#
+# Polls power state and sensors of every IPMI managed node, and the outlet and UPS
+# figures of every SNMP PDU, in parallel.
+#
+# Nodes with a uri of the form "IPMI:<host>" or "IPMI:<host>:<port>" and the entries of
+# the 'pdus' table are polled on a bounded thread pool.  Each poll has its own deadline
+# and a target that is still busy with its previous poll is skipped, so one unresponsive
+# device never delays the others.  Results go into a state table that readers query
+# without touching a device, and are passed to an optional listener.
+#
+
+import syslog
+import time
+from threading import Thread, Lock, Event
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from ipmi import *
+
+IPMI_URI_PREFIX = "IPMI:"
+
+# Target groups
+NODE_GROUP = "node"
+PDU_GROUP = "pdu"
+
+class PollerException(Exception):
+    pass
+
+class NodePoller():
+    POLL_INTERVAL = 10
+    MAX_WORKERS = 8
+    HOST_DEADLINE = 8
+
+    # listener, if given, is called as listener(group, name, state) after every poll, and
+    # observe as observe(group, seconds, ok).  'pool' is the IPMI_SessionPool for the nodes.
+    def __init__(self, interval=POLL_INTERVAL, max_workers=MAX_WORKERS, deadline=HOST_DEADLINE, sensors=True,
+                 listener=None, observe=None, pool=None):
+        self.__interval = interval
+        self.__max_workers = max_workers
+        self.__deadline = deadline
+        self.__sensors = sensors
+        self.__listener = listener
+        self.__observe = observe
+        self.__pool = pool
+        self.__lock = Lock()
+        self.__targets = { NODE_GROUP: {}, PDU_GROUP: {} }  # group -> name -> poll function
+        self.__busy = set()         # (group, name) with a poll in flight
+        self.__state = { NODE_GROUP: {}, PDU_GROUP: {} }    # group -> name -> state dictionary
+        self.__stop = Event()
+        self.__thread = None
+        self.__executor = None
+
+    # Returns (host, port) for an IPMI uri, else None; a malformed IPMI uri raises PollerException
+    @staticmethod
+    def ParseUri(uri):
+        if uri is None or not uri.startswith(IPMI_URI_PREFIX):
+            return None
+
+        host, sep, port = uri[len(IPMI_URI_PREFIX):].partition(":")
+        if not sep:
+            port = "623"
+        if host == "" or not port.isdigit() or not 0 < int(port) < 65536:
+            raise PollerException("Bad IPMI uri: %s" % uri)
+        return host, int(port)
+
+    def __set_targets(self, group, targets):
+        with self.__lock:
+            self.__targets[group] = targets
+            # Drop state of targets no longer polled
+            for name in list(self.__state[group]):
+                if name not in targets:
+                    del(self.__state[group][name])
+
+    def __ipmi_poll(self, control):
+        def poll():
+            state = { 'power': control.is_power_on() }
+            if self.__sensors:
+                control.read_sensors()
+                state['sensors'] = dict(control.sensors)
+            return state
+        return poll
+
+    # Update the set of polled nodes from a DependencyIndex
+    def SetNodes(self, index):
+        targets = {}
+
+        for name in index.Names():
+            node = index.Node(name)
+            try:
+                address = self.ParseUri(node.get('uri'))
+            except PollerException as e:
+                syslog.syslog("Not polling %s: %s" % (name, str(e)))
+                continue
+            if address is not None:
+                targets[name] = self.__ipmi_poll(IPMI_Control(host_address=address[0],
+                                                              host_port=address[1],
+                                                              username=node.get('username'),
+                                                              password=node.get('password'),
+                                                              pool=self.__pool))
+
+        self.__set_targets(NODE_GROUP, targets)
+
+    # Update the set of polled PDUs; 'driver' is an ApcDriver
+    def SetPdus(self, driver, names):
+        targets = {}
+        for name in names:
+            targets[name] = lambda name=name: driver.Poll(name)
+
+        self.__set_targets(PDU_GROUP, targets)
+
+    def __poll_target(self, group, name, poll):
+        updated = time.time()
+        started = time.monotonic()
+
+        try:
+            state = poll()
+            state['updated'] = updated
+
+        except Exception as e:
+            state = { 'updated': updated, 'error': str(e) }
+
+        if self.__observe is not None:
+            self.__observe(group, time.monotonic() - started, 'error' not in state)
+
+        with self.__lock:
+            self.__busy.discard((group, name))
+            if name not in self.__targets[group]:
+                return
+            if 'error' in state:
+                # Keep the last good readings when a poll fails
+                state = dict(self.__state[group].get(name, {}), **state)
+            self.__state[group][name] = state
+
+        if self.__listener is not None:
+            self.__listener(group, name, state)
+
+    # Poll all targets once; returns after every poll finished or hit its deadline
+    def PollOnce(self):
+        with self.__lock:
+            pending = []
+            for group, targets in self.__targets.items():
+                for name, poll in targets.items():
+                    if (group, name) not in self.__busy:
+                        pending.append((group, name, poll))
+                        self.__busy.add((group, name))
+
+        futures = {}
+        for group, name, poll in pending:
+            futures[self.__executor.submit(self.__poll_target, group, name, poll)] = (group, name)
+
+        done, not_done = wait(futures, timeout=self.__deadline)
+
+        for future in not_done:
+            group, name = futures[future]
+            syslog.syslog("NodePoller: %s %s missed its %d second deadline" % (group, name, self.__deadline))
+            with self.__lock:
+                if name in self.__state[group]:
+                    self.__state[group][name]['error'] = "timeout"
+
+    def __poll_thread(self):
+        while not self.__stop.is_set():
+            started = time.monotonic()
+            try:
+                self.PollOnce()
+            except Exception as e:
+                syslog.syslog("NodePoller: %s" % str(e))
+            self.__stop.wait(max(0, self.__interval - (time.monotonic() - started)))
+
+    def Start(self):
+        self.__stop.clear()
+        self.__executor = ThreadPoolExecutor(max_workers=self.__max_workers)
+        self.__thread = Thread(target=self.__poll_thread, daemon=True)
+        self.__thread.start()
+
+    def Stop(self):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        if self.__executor is not None:
+            # Don't wait for polls stuck on a dead device
+            self.__executor.shutdown(wait=False)
+            self.__executor = None
+
+    # Latest state of one target, or of all targets in the group when name is empty
+    def GetState(self, name="", group=NODE_GROUP):
+        with self.__lock:
+            if name == "":
+                return dict((key, dict(value)) for key, value in self.__state[group].items())
+            return dict(self.__state[group].get(name, {}))
@@ -0,0 +1,142 @@
+#
+# UpsControlQueue.py
+#
+# Keyed priority queue for activation requests.
+#
+# There is at most one pending request per device: a newer request replaces the pending
+# one (so Activate followed by Deactivate before either ran leaves just the Deactivate).
+# Requests come out highest priority first, oldest first within a priority, which lets
+# emergency shutdowns overtake routine activations.
+#
+
+import heapq
+import time
+from threading import Condition
+
+class ActivationQueue():
+    # Priorities
+    NORMAL = 0
+    EMERGENCY = 10
+
+    def __init__(self):
+        self.__cond = Condition()
+        self.__heap = []            # (-priority, seq, device)
+        self.__pending = {}         # device -> { 'device', 'activate', 'priority', 'seq', 'queued' }
+        self.__seq = 0
+        self.__closed = False
+
+        # Counters
+        self.__queued = 0
+        self.__replaced = 0
+        self.__cancelled = 0
+        self.__taken = 0
+        self.__wait_total = 0.0
+        self.__wait_max = 0.0
+        self.__depth_max = 0
+
+    # Queue a request for 'device'.  A pending request for the same device is replaced.  A
+    # repeat of the same request (same direction) keeps the higher of the two priorities
+    # and the original queue time; a reversal is queued as a new request with its own
+    # priority, so a routine Deactivate can't inherit an emergency Activate's priority.
+    def Put(self, device, activate, priority=NORMAL):
+        with self.__cond:
+            if self.__closed:
+                return
+
+            self.__seq += 1
+            self.__queued += 1
+            now = time.monotonic()
+
+            old = self.__pending.get(device)
+            if old is not None:
+                self.__replaced += 1
+                if old['activate'] == activate:
+                    priority = max(priority, old['priority'])
+                    now = old['queued']
+
+            self.__pending[device] = { 'device': device, 'activate': activate, 'priority': priority,
+                                       'seq': self.__seq, 'queued': now }
+            # The old heap entry is dropped when it comes up (its seq no longer matches)
+            heapq.heappush(self.__heap, (-priority, self.__seq, device))
+
+            self.__depth_max = max(self.__depth_max, len(self.__pending))
+            self.__cond.notify()
+
+    # Drop the pending request for 'device'.  Returns True if there was one.
+    def Cancel(self, device):
+        with self.__cond:
+            if self.__pending.pop(device, None) is None:
+                return False
+            self.__cancelled += 1
+            return True
+
+    def __pop(self):
+        while self.__heap:
+            priority, seq, device = heapq.heappop(self.__heap)
+            item = self.__pending.get(device)
+            if item is not None and item['seq'] == seq:
+                del(self.__pending[device])
+                wait = time.monotonic() - item['queued']
+                self.__taken += 1
+                self.__wait_total += wait
+                self.__wait_max = max(self.__wait_max, wait)
+                return { 'device': device, 'activate': item['activate'], 'priority': item['priority'], 'wait': wait }
+        return None
+
+    # Wait for requests and return all of them in priority order; [] once closed
+    def GetAll(self):
+        with self.__cond:
+            while not self.__pending and not self.__closed:
+                self.__cond.wait()
+
+            if self.__closed:
+                return []
+
+            items = []
+            item = self.__pop()
+            while item is not None:
+                items.append(item)
+                item = self.__pop()
+            return items
+
+    # Return the requests of at least 'priority' without waiting, highest first; lets a
+    # long running batch let emergencies go ahead of the rest of it
+    def GetUrgent(self, priority=EMERGENCY):
+        with self.__cond:
+            items = []
+            while self.__heap and -self.__heap[0][0] >= priority:
+                negated, seq, device = self.__heap[0]
+                item = self.__pending.get(device)
+                if item is None or item['seq'] != seq:
+                    # Replaced or cancelled
+                    heapq.heappop(self.__heap)
+                    continue
+                items.append(self.__pop())
+            return items
+
+    # Wake GetAll() and make it return [] from now on; pending requests are dropped
+    def Close(self):
+        with self.__cond:
+            self.__closed = True
+            self.__pending.clear()
+            self.__heap = []
+            self.__cond.notify_all()
+
+    def __len__(self):
+        with self.__cond:
+            return len(self.__pending)
+
+    def Stats(self):
+        with self.__cond:
+            oldest = min((item['queued'] for item in self.__pending.values()), default=None)
+            return {
+                'depth': len(self.__pending),
+                'depth_max': self.__depth_max,
+                'queued': self.__queued,
+                'replaced': self.__replaced,
+                'cancelled': self.__cancelled,
+                'taken': self.__taken,
+                'wait_mean': self.__wait_total / self.__taken if self.__taken else 0.0,
+                'wait_max': self.__wait_max,
+                'oldest_wait': time.monotonic() - oldest if oldest is not None else 0.0,
+            }
@@ -0,0 +1,189 @@
+#
+# UpsControlScheduler.py
+#
+# Dependency-aware activation scheduler for the nodes graph.
+#
+# A request to activate a node is turned into a plan of 'waves'.  Every node in a wave
+# only depends on nodes in earlier waves, so all nodes of a wave are started in parallel
+# (bounded by the worker count) and the total time is the depth of the graph instead of
+# the number of nodes.  Deactivation uses the same waves in reverse order.
+#
+# With a 'stagger' planner (see UpsControlInrush.py) the starts within a wave are spread
+# over time slots so that the inrush current on each PDU stays within its budget.  A slot
+# is only submitted once every action of the previous slot (in the same wave or the one
+# before) has actually started and the slot time has passed since the last of them, so
+# neither a slot bigger than the worker pool nor the next wave can overlap it.
+#
+
+import syslog
+import time
+from threading import Event
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from UpsControlDependency import *
+
+class SchedulerException(Exception):
+    pass
+
+class ActivationScheduler():
+    MAX_WORKERS = 4
+    NODE_TIMEOUT = 120
+
+    # Result codes per node
+    OK = "ok"
+    FAILED = "failed"
+    TIMEOUT = "timeout"
+    SKIPPED = "skipped"
+
+    # action is called as action(node, activate) and returns True on success
+    def __init__(self, action, max_workers=MAX_WORKERS, node_timeout=NODE_TIMEOUT, stagger=None):
+        self.__action = action
+        self.__max_workers = max_workers
+        self.__node_timeout = node_timeout
+        self.__stagger = stagger
+
+    # Group the nodes in 'members' into waves by their dependency depth within 'members'
+    def __waves(self, index, members):
+        depth = {}
+        waves = []
+
+        # Ordered() puts dependencies first so each depth only needs its direct neighbours
+        for name in index.Ordered(members):
+            level = 0
+            for dep in index.Requires(name) + index.Wants(name):
+                if dep in depth:
+                    level = max(level, depth[dep] + 1)
+            depth[name] = level
+            while len(waves) <= level:
+                waves.append([])
+            waves[level].append(name)
+
+        return [ sorted(wave) for wave in waves ]
+
+    # Return list of waves (lists of node names) to activate or deactivate 'names'.  Names
+    # not in the index (e.g. removed since they were queued) are left out.
+    def Plan(self, index, names, activate=True):
+        members = set()
+        for name in names:
+            if name not in index:
+                syslog.syslog("%s skipped: undefined node" % name)
+                continue
+            members |= index.ActivationSet(name) if activate else index.Dependents(name)
+
+        waves = self.__waves(index, members)
+        if not activate:
+            waves.reverse()
+
+        return waves
+
+    # Returns True if 'name' cannot be processed because something it depends on failed
+    def __blocked(self, index, name, results, activate):
+        if activate:
+            # Only hard requirements block an activation; a missing 'want' is tolerated
+            for required in index.Requires(name):
+                if results.get(required, self.OK) != self.OK:
+                    return True
+        return False
+
+    # Runs the action for 'name' on a worker, noting when it really started
+    def __start(self, name, node, activate, started, events):
+        started[name] = time.monotonic()
+        events[name].set()
+        return self.__action(node, activate)
+
+    # An action times out 'node_timeout' seconds after it started; one still queued by then
+    # times out as well
+    def __deadline(self, name, submitted, started):
+        return started.get(name, submitted[name]) + self.__node_timeout
+
+    # Wait until the actions of 'names' have started (or are past their deadline) and return
+    # when the last of them started
+    def __wait_started(self, names, submitted, started, events):
+        for name in names:
+            events[name].wait(max(0, self.__deadline(name, submitted, started) - time.monotonic()))
+        return max([ started[name] for name in names if name in started ] or [ time.monotonic() ])
+
+    # Wait for the futures of a wave, each until its own deadline, and put their result
+    # codes in 'results'
+    def __collect(self, futures, submitted, started, results):
+        pending = set(futures)
+        while pending:
+            now = time.monotonic()
+            for future in [ future for future in pending if self.__deadline(futures[future], submitted, started) <= now ]:
+                pending.discard(future)
+                if future.done():
+                    continue
+                name = futures[future]
+                syslog.syslog("%s timed out after %d seconds" % (name, self.__node_timeout))
+                future.cancel()
+                results[name] = self.TIMEOUT
+
+            if not pending:
+                break
+
+            deadline = min(self.__deadline(futures[future], submitted, started) for future in pending)
+            done, pending = wait(pending, timeout=deadline - now, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = futures[future]
+                try:
+                    results[name] = self.OK if future.result() else self.FAILED
+                except Exception as e:
+                    syslog.syslog("%s failed: %s" % (name, str(e)))
+                    results[name] = self.FAILED
+
+    # Execute a plan.  Returns dictionary of node name to result code.  'between', if given,
+    # is called before every wave but the first and returns names this run must leave
+    # alone from then on (e.g. nodes an emergency shutdown just took down); they are
+    # reported as skipped.
+    def Run(self, index, names, activate=True, between=None):
+        plan = self.Plan(index, names, activate)
+        results = dict((name, self.SKIPPED) for name in names if name not in index)
+
+        syslog.syslog("%s plan: %s" % ("Activation" if activate else "Deactivation", plan))
+
+        submitted = {}
+        started = {}                # name -> time its action started
+        events = {}                 # name -> Event set when its action started
+        previous = []               # Last slot submitted, in this wave or the one before
+
+        executor = ThreadPoolExecutor(max_workers=self.__max_workers)
+        try:
+            for number, wave in enumerate(plan):
+                if between is not None and number != 0:
+                    for name in between() or ():
+                        results.setdefault(name, self.SKIPPED)
+
+                futures = {}
+                ready = []
+                for name in wave:
+                    if name in results:
+                        continue
+                    if self.__blocked(index, name, results, activate):
+                        syslog.syslog("%s skipped: dependency failed" % name)
+                        results[name] = self.SKIPPED
+                    else:
+                        ready.append(name)
+
+                staggered = activate and self.__stagger is not None
+                slots = self.__stagger.Slots(index, ready) if staggered else [ ready ]
+
+                for slot in slots:
+                    if staggered and len(previous) != 0:
+                        # Let the inrush of the previous slot die down; actions such as
+                        # apcstart return as soon as the outlet is on, so this holds
+                        # across waves as well
+                        last_start = self.__wait_started(previous, submitted, started, events)
+                        time.sleep(max(0, self.__stagger.SlotTime() - (time.monotonic() - last_start)))
+                    for name in slot:
+                        events[name] = Event()
+                        submitted[name] = time.monotonic()
+                        futures[executor.submit(self.__start, name, index.Node(name), activate, started, events)] = name
+                    if len(slot) != 0:
+                        previous = slot
+
+                self.__collect(futures, submitted, started, results)
+
+        finally:
+            # Don't wait on actions that overran their timeout
+            executor.shutdown(wait=False)
+
+        return results
@@ -0,0 +1,107 @@
+#
+# UpsControlSchema.py
+#
+# Checks table records against the table 'schema' (see UpsControlConfig.py for the
+# list of schema options).
+#
+
+class SchemaException(Exception):
+    pass
+
+# Field types that may be left unset (None)
+_OPTIONAL = ( '<str>', '<icon>', '<password>', '<one-of-items>' )
+
+def _check_field(table, field, option, value, record):
+    where = "%s %s.%s" % (table, record.get('name'), field)
+
+    if type(option) is list:
+        kind, choices = option[0], option[1:]
+        if kind == '<one-of>':
+            if value not in choices:
+                raise SchemaException("%s: %s is not one of %s" % (where, value, choices))
+        elif kind in ('<zero-or-more>', '<one-or-more>'):
+            if type(value) is not list or any(item not in choices for item in value):
+                raise SchemaException("%s: %s is not a list from %s" % (where, value, choices))
+            if kind == '<one-or-more>' and len(value) == 0:
+                raise SchemaException("%s: needs at least one item" % where)
+        return
+
+    if option == '<bool>':
+        if type(value) is not bool:
+            raise SchemaException("%s: %s is not a boolean" % (where, value))
+
+    elif option == '<unique-item>':
+        if type(value) is not str or value == "":
+            raise SchemaException("%s: name is required" % where)
+
+    elif option in ('<zero-or-more-items>', '<one-or-more-items>'):
+        if type(value) is not list or any(type(item) is not str for item in value):
+            raise SchemaException("%s: %s is not a list of names" % (where, value))
+        if option == '<one-or-more-items>' and len(value) == 0:
+            raise SchemaException("%s: needs at least one item" % where)
+
+    elif option in _OPTIONAL:
+        if value is not None and type(value) is not str:
+            raise SchemaException("%s: %s is not a string" % (where, value))
+
+# Check every record in 'table' (a dictionary with 'schema' and 'data') against its schema.
+# Tables without a schema are not checked.
+def ValidateTable(name, table):
+    if type(table) is not dict or 'schema' not in table:
+        return
+
+    schema = table['schema']
+    records = table.get('data', [])
+
+    if type(records) is not list:
+        raise SchemaException("%s: data is not a list" % name)
+
+    unique = {}
+    for record in records:
+        if type(record) is not dict:
+            raise SchemaException("%s: record %s is not a dictionary" % (name, record))
+
+        for field, value in record.items():
+            if field in schema:
+                _check_field(name, field, schema[field], value, record)
+
+        for field, option in schema.items():
+            if option == '<unique-item>':
+                seen = unique.setdefault(field, set())
+                if record.get(field) in seen:
+                    raise SchemaException("%s: duplicate %s %s" % (name, field, record.get(field)))
+                seen.add(record.get(field))
+
+# Check settings such as 'global' against the shape of their defaults: booleans, numbers
+# (not negative) and strings have to keep their type, lists hold strings and an empty
+# default dictionary (e.g. per outlet amps) maps names to numbers.  Settings missing
+# from 'value' are fine; the defaults fill them in.
+def ValidateSettings(name, value, default):
+    if type(default) is dict:
+        if type(value) is not dict:
+            raise SchemaException("%s: %s is not a dictionary" % (name, value))
+        if len(default) == 0:
+            for key, item in value.items():
+                _check_number("%s.%s" % (name, key), item)
+        for key, item in value.items():
+            if key in default:
+                ValidateSettings("%s.%s" % (name, key), item, default[key])
+
+    elif type(default) is list:
+        if type(value) is not list or any(type(item) is not str for item in value):
+            raise SchemaException("%s: %s is not a list of strings" % (name, value))
+
+    elif type(default) is bool:
+        if type(value) is not bool:
+            raise SchemaException("%s: %s is not a boolean" % (name, value))
+
+    elif type(default) in (int, float):
+        _check_number(name, value)
+
+    elif type(default) is str:
+        if type(value) is not str:
+            raise SchemaException("%s: %s is not a string" % (name, value))
+
+def _check_number(name, value):
+    if type(value) not in (int, float) or value < 0:
+        raise SchemaException("%s: %s is not a number of 0 or more" % (name, value))
@@ -0,0 +1,354 @@
+#
+# UpsControlSegments.py
+#
+# Long-term telemetry archive in memory-mapped, append-only segment files.
+#
+# Each metric has a directory of hourly segments named <hour number>.seg.  A segment is
+# a 16 byte header followed by fixed (time, value) records of two little endian doubles
+# in time order, so a segment mapped with mmap is directly an array of doubles: a time
+# range is found by bisection and returned as a memoryview slice without copying.
+#
+# When a segment is finished (its hour is over, or the archive closes) a small index
+# with count, first and last time, minimum, maximum and sum is written next to it as
+# <hour number>.idx, so queries with a step of an hour or more read only the indexes.
+#
+# Append() only puts the samples on a queue; a writer thread does the file I/O.  If the
+# writer falls behind, the oldest queued samples are dropped rather than blocking.  The
+# writer takes everything queued at once and appends each metric's records with a
+# single open, write and close, so no file stays open however many metrics there are.
+#
+
+import mmap
+import os
+import re
+import struct
+import syslog
+import time
+from bisect import bisect_left
+from collections import deque
+from threading import Thread, Lock, Event
+
+ARCHIVE_DIR = "/var/lib/upscontrol/telemetry"
+
+SEGMENT_SECONDS = 3600
+SEGMENT_MAGIC = b"UPSSEG01"
+HEADER_SIZE = 16
+RECORD = struct.Struct("<dd")
+INDEX = struct.Struct("<Qddddd")    # count, first, last, min, max, sum
+
+class SegmentException(Exception):
+    pass
+
+# Directory name for a metric: anything outside [A-Za-z0-9_.-] becomes '_', as does a
+# leading '.', so no name can leave the archive directory or hide in it
+def metric_dir_name(metric):
+    name = re.sub(r"[^A-Za-z0-9_.-]", "_", metric)
+    if name.startswith(".") or name == "":
+        name = "_" + name
+    return name
+
+class Segment():
+    # Map an existing segment read-only
+    def __init__(self, path):
+        self.path = path
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            # Ignore a record still being written
+            size -= (size - HEADER_SIZE) % RECORD.size
+            if size <= HEADER_SIZE:
+                self.__map = None
+                self.__values = memoryview(b"").cast('d')
+                return
+            self.__map = mmap.mmap(fd, size, prot=mmap.PROT_READ)
+        finally:
+            os.close(fd)
+
+        if self.__map[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+            self.__map.close()
+            raise SegmentException("%s: not a segment" % path)
+
+        # time, value, time, value, ...
+        self.__values = memoryview(self.__map)[HEADER_SIZE:].cast('d')
+
+    def __len__(self):
+        return len(self.__values) // 2
+
+    def Time(self, record):
+        return self.__values[record * 2]
+
+    # First record at or after 'when'
+    def __bisect(self, when):
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.__values[middle * 2] < when:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # Records with start <= time < end as a memoryview of doubles (time, value, ...)
+    def Range(self, start, end):
+        return self.__values[self.__bisect(start) * 2:self.__bisect(end) * 2]
+
+    # (count, first, last, min, max, sum) of the whole segment
+    def Summary(self):
+        values = self.__values[1::2]
+        if len(values) == 0:
+            return (0, 0.0, 0.0, 0.0, 0.0, 0.0)
+        return (len(values), self.__values[0], self.__values[-2], min(values), max(values), sum(values))
+
+    def Close(self):
+        self.__values.release()
+        if self.__map is not None:
+            self.__map.close()
+
+class SegmentArchive():
+    RETENTION_DAYS = 35
+    MAX_QUEUED = 100000
+
+    def __init__(self, directory=ARCHIVE_DIR, retention_days=RETENTION_DAYS, max_queued=MAX_QUEUED):
+        self.__directory = directory
+        self.__retention = retention_days * 86400
+        self.__queue = deque(maxlen=max_queued)
+        self.__wakeup = Event()
+        self.__stop = Event()
+        self.__lock = Lock()            # Open segment files
+        self.__current = {}             # metric -> hour of the segment being written
+        self.__dropped = 0
+        self.__thread = None
+
+    def __metric_dir(self, metric):
+        return os.path.join(self.__directory, metric_dir_name(metric))
+
+    def __segment_path(self, metric, hour, suffix=".seg"):
+        return os.path.join(self.__metric_dir(metric), "%d%s" % (hour, suffix))
+
+    # Queue samples taken at 'when' ({ metric: number or bool }); never blocks
+    def Append(self, when, values):
+        samples = []
+        for name, value in values.items():
+            if type(value) is bool:
+                value = 1.0 if value else 0.0
+            elif type(value) not in (int, float):
+                continue
+            samples.append((name, float(when), float(value)))
+
+        if len(self.__queue) + len(samples) > self.__queue.maxlen:
+            self.__dropped += len(samples)
+        self.__queue.extend(samples)
+        self.__wakeup.set()
+
+    def __write_index(self, metric, hour):
+        path = self.__segment_path(metric, hour)
+        try:
+            segment = Segment(path)
+        except (OSError, SegmentException) as e:
+            syslog.syslog("Telemetry archive: %s" % str(e))
+            return None
+        try:
+            summary = segment.Summary()
+        finally:
+            segment.Close()
+
+        tmp = self.__segment_path(metric, hour, ".idx.tmp")
+        with open(tmp, "wb") as f:
+            f.write(INDEX.pack(*summary))
+        os.replace(tmp, self.__segment_path(metric, hour, ".idx"))
+        return summary
+
+    # The hour of 'metric' is over; lock held
+    def __finish_segment(self, metric):
+        self.__write_index(metric, self.__current.pop(metric))
+
+    def __append(self, metric, hour, records):
+        fd = os.open(self.__segment_path(metric, hour), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            data = b"".join(RECORD.pack(when, value) for when, value in records)
+            if os.fstat(fd).st_size == 0:
+                data = SEGMENT_MAGIC.ljust(HEADER_SIZE, b"\0") + data
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    # Write the (time, value) records of one metric, in queue order
+    def __write(self, metric, records):
+        with self.__lock:
+            if metric not in self.__current:
+                os.makedirs(self.__metric_dir(metric), exist_ok=True)
+
+            first = 0
+            while first < len(records):
+                hour = int(records[first][0] // SEGMENT_SECONDS)
+                last = first + 1
+                while last < len(records) and int(records[last][0] // SEGMENT_SECONDS) == hour:
+                    last += 1
+
+                current = self.__current.get(metric)
+                if current is not None and hour != current:
+                    if hour < current:
+                        # Out of order; segments only go forward
+                        first = last
+                        continue
+                    self.__finish_segment(metric)
+
+                self.__append(metric, hour, records[first:last])
+                self.__current[metric] = hour
+                first = last
+
+    def __prune(self):
+        oldest = int((time.time() - self.__retention) // SEGMENT_SECONDS)
+        try:
+            metrics = os.listdir(self.__directory)
+        except OSError:
+            return
+
+        with self.__lock:
+            open_files = set((metric_dir_name(metric), "%d" % hour) for metric, hour in self.__current.items())
+
+        for metric in metrics:
+            directory = os.path.join(self.__directory, metric)
+            for name in os.listdir(directory):
+                hour = name.partition(".")[0]
+                if hour.isdigit() and int(hour) < oldest and (metric, hour) not in open_files:
+                    os.unlink(os.path.join(directory, name))
+
+    def __writer_thread(self):
+        last_prune = 0
+
+        while not self.__stop.is_set() or len(self.__queue) != 0:
+            self.__wakeup.wait(1.0)
+            self.__wakeup.clear()
+
+            batch = {}
+            while len(self.__queue) != 0:
+                metric, when, value = self.__queue.popleft()
+                batch.setdefault(metric, []).append((when, value))
+
+            for metric, records in batch.items():
+                try:
+                    self.__write(metric, records)
+                except OSError as e:
+                    syslog.syslog("Telemetry archive %s: %s" % (metric, str(e)))
+
+            if time.time() - last_prune > SEGMENT_SECONDS:
+                last_prune = time.time()
+                self.__prune()
+
+        with self.__lock:
+            for metric in list(self.__current):
+                self.__finish_segment(metric)
+
+        if self.__dropped:
+            syslog.syslog("Telemetry archive: %d samples dropped" % self.__dropped)
+
+    def Start(self):
+        os.makedirs(self.__directory, exist_ok=True)
+        self.__stop.clear()
+        self.__thread = Thread(target=self.__writer_thread, daemon=True)
+        self.__thread.start()
+
+    # Write out what is queued and finish the open segments
+    def Close(self):
+        self.__stop.set()
+        self.__wakeup.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __hours(self, metric, start, end):
+        try:
+            names = os.listdir(self.__metric_dir(metric))
+        except FileNotFoundError:
+            raise SegmentException("No metric %s" % metric)
+
+        first = int(start // SEGMENT_SECONDS)
+        last = int(end // SEGMENT_SECONDS)
+        return sorted(int(name[:-4]) for name in names
+                      if name.endswith(".seg") and first <= int(name[:-4]) <= last)
+
+    # Yield (time, value, time, value, ...) memoryviews of doubles covering start <= time < end.
+    # The views refer to mapped segments and are only valid until the next one is yielded.
+    def Scan(self, metric, start, end):
+        for hour in self.__hours(metric, start, end):
+            segment = Segment(self.__segment_path(metric, hour))
+            try:
+                view = segment.Range(start, end)
+                try:
+                    yield view
+                finally:
+                    view.release()
+            finally:
+                segment.Close()
+
+    def __summary(self, metric, hour):
+        with self.__lock:
+            is_open = self.__current.get(metric) == hour
+
+        if not is_open:
+            try:
+                with open(self.__segment_path(metric, hour, ".idx"), "rb") as f:
+                    return INDEX.unpack(f.read(INDEX.size))
+            except (OSError, struct.error):
+                # Not finished cleanly; build it now
+                summary = self.__write_index(metric, hour)
+                if summary is not None:
+                    return summary
+
+        segment = Segment(self.__segment_path(metric, hour))
+        try:
+            return segment.Summary()
+        finally:
+            segment.Close()
+
+    # Return { 'metric', 'step', 'points': [ [ time, mean, min, max ], ... ] }.  A step of an
+    # hour or more is answered from the segment indexes alone.
+    def Series(self, metric, start, end, step):
+        step = max(1, int(step))
+        points = []
+
+        if step >= SEGMENT_SECONDS:
+            step -= step % SEGMENT_SECONDS
+            per = step // SEGMENT_SECONDS
+            groups = {}
+            for hour in self.__hours(metric, start, end):
+                count, first, last, low, high, total = self.__summary(metric, hour)
+                if count == 0:
+                    continue
+                group = groups.setdefault(hour - hour % per, [ 0, 0.0, low, high ])
+                group[0] += count
+                group[1] += total
+                group[2] = min(group[2], low)
+                group[3] = max(group[3], high)
+            for group in sorted(groups):
+                count, total, low, high = groups[group]
+                points.append([ group * SEGMENT_SECONDS, total / count, low, high ])
+            return { 'metric': metric, 'step': step, 'points': points }
+
+        # Each segment is decoded in one go; the records are in time order, so every bucket
+        # is a slice found by bisection and summed by the builtins
+        current = None              # [ bucket, count, sum, min, max ]; may span segments
+        for view in self.Scan(metric, start, end):
+            records = view.tolist()
+            times = records[0::2]
+            values = records[1::2]
+            first = 0
+            while first < len(times):
+                bucket = int(times[first] // step) * step
+                last = bisect_left(times, bucket + step, first)
+                chunk = values[first:last]
+                first = last
+                if current is not None and current[0] == bucket:
+                    current[1] += len(chunk)
+                    current[2] += sum(chunk)
+                    current[3] = min(current[3], min(chunk))
+                    current[4] = max(current[4], max(chunk))
+                    continue
+                if current is not None:
+                    points.append([ current[0], current[2] / current[1], current[3], current[4] ])
+                current = [ bucket, len(chunk), sum(chunk), min(chunk), max(chunk) ]
+        if current is not None:
+            points.append([ current[0], current[2] / current[1], current[3], current[4] ])
+
+        return { 'metric': metric, 'step': step, 'points': points }
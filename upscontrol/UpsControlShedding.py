@@ -0,0 +1,152 @@
+#
+# UpsControlShedding.py
+#
+# Load shedding on battery.
+#
+# Critical nodes are those shown on the main page ('showmain') together with everything
+# they require.  The other nodes that have a stop action can be shed.  Nodes that are
+# only wanted (e.g. the file servers Nas1 and Nas2) go first, then the rest with
+# dependents before their dependencies.  That order only changes with the node table,
+# so it is worked out once per DependencyIndex.
+#
+# Samples come from one or more UPSes and the latest reading of each is kept.  Every
+# sample is evaluated against the worst of them: the UPS on battery with the least
+# runtime.  The shed nodes are only restored once no UPS is on battery, so readings
+# from several UPSes can't make the shedder go back and forth.
+#
+# That runtime is compared against the target runtime.  When it falls short the
+# number of nodes to shed is estimated from the UPS load, assuming runtime is inversely
+# proportional to load and the load is shared evenly by the nodes still running.  After
+# a step the readings get 'hold' seconds to settle before the next one, so the plan
+# advances step by step instead of being redone on every sample.  When the UPS is back
+# on line the shed nodes are restored.
+#
+
+import math
+import syslog
+import time
+from threading import Lock
+
+class LoadShedder():
+    SHED_BELOW = 900            # Target runtime in seconds
+    HOLD = 60                   # Seconds to wait after a step before shedding more
+
+    # shed(names) powers the names off (dependents first); restore(names) powers them back on
+    def __init__(self, shed, restore=None, shed_below=SHED_BELOW, hold=HOLD, enabled=True):
+        self.__shed_func = shed
+        self.__restore_func = restore
+        self.__shed_below = shed_below
+        self.__hold = hold
+        self.__enabled = enabled
+        self.__lock = Lock()
+        self.__plan = []            # Sheddable names, first to go first
+        self.__running = 0          # Nodes with a stop action, i.e. sharing the load
+        self.__shed = []            # Names shed so far, in order
+        self.__last_step = None
+        self.__readings = {}        # UPS name -> (runtime, load, on battery)
+
+    def Configure(self, shed_below=None, hold=None, enabled=None):
+        with self.__lock:
+            if shed_below is not None:
+                self.__shed_below = shed_below
+            if hold is not None:
+                self.__hold = hold
+            if enabled is not None:
+                self.__enabled = enabled
+
+    # Work out the shed order for a new node table
+    def SetIndex(self, index):
+        critical = set()
+        pending = [ name for name in index.Names() if index.Node(name).get('showmain') ]
+        while pending:
+            name = pending.pop()
+            if name not in critical:
+                critical.add(name)
+                pending.extend(index.Requires(name))
+
+        switchable = [ name for name in index.Names() if index.Node(name).get('stop') ]
+
+        # Ordered() puts dependencies first; shed in the reverse, the nodes nothing
+        # requires first (the sort is stable, so the order holds within each group)
+        plan = index.Ordered(set(switchable) - critical)
+        plan.reverse()
+        plan.sort(key=lambda name: len(index.RequiredBy(name)) != 0)
+
+        with self.__lock:
+            self.__plan = plan
+            self.__running = len(switchable)
+            self.__shed = [ name for name in self.__shed if name in index ]
+
+    def Plan(self):
+        with self.__lock:
+            return list(self.__plan)
+
+    def Shed(self):
+        with self.__lock:
+            return list(self.__shed)
+
+    # Forget the readings of UPSes not in 'names'
+    def SetSources(self, names):
+        with self.__lock:
+            for source in list(self.__readings):
+                if source not in names:
+                    del(self.__readings[source])
+
+    # (runtime, load, on battery) of the worst UPS; lock held
+    def __worst(self):
+        on_battery = [ reading for reading in self.__readings.values() if reading[2] ]
+        if len(on_battery) == 0:
+            return None, None, False
+        return min(on_battery, key=lambda reading: math.inf if reading[0] is None else reading[0])
+
+    # How many more nodes have to go to bring 'runtime' up to the target at 'load' percent
+    def __needed(self, runtime, load):
+        if not load or runtime <= 0:
+            return 1
+
+        running = self.__running - len(self.__shed)
+        if running <= 0:
+            return 1
+
+        target_load = load * runtime / self.__shed_below
+        share = load / running
+        return max(1, math.ceil((load - target_load) / share))
+
+    # Feed one reading of UPS 'source': 'runtime' in seconds, 'load' in percent (if known),
+    # and whether it runs on battery.  Returns the names shed (or restored) by this sample.
+    def Sample(self, runtime, load=None, on_battery=True, source=""):
+        now = time.monotonic()
+
+        with self.__lock:
+            self.__readings[source] = (runtime, load, on_battery)
+            runtime, load, on_battery = self.__worst()
+
+            if not on_battery:
+                if len(self.__shed) == 0:
+                    return []
+                # Dependencies first
+                names = list(reversed(self.__shed))
+                self.__shed = []
+                self.__last_step = None
+                func = self.__restore_func
+
+            else:
+                if not self.__enabled or runtime is None or runtime >= self.__shed_below:
+                    return []
+                if self.__last_step is not None and now - self.__last_step < self.__hold:
+                    return []
+
+                remaining = [ name for name in self.__plan if name not in self.__shed ]
+                if len(remaining) == 0:
+                    return []
+
+                names = remaining[:self.__needed(runtime, load)]
+                self.__shed.extend(names)
+                self.__last_step = now
+                func = self.__shed_func
+
+        syslog.syslog("Load shedding: runtime %s load %s on battery %s: %s %s" %
+                      (runtime, load, on_battery, "shed" if on_battery else "restore", names))
+        if func is not None:
+            func(names)
+        return names
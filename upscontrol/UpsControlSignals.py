@@ -0,0 +1,93 @@
+#
+# UpsControlSignals.py
+#
+# Coalescing and rate limiting for IndicateData signals.
+#
+# Updates are held per reason for a short window; a newer update for the same reason
+# replaces (or, for dictionaries, is merged into) the pending one, so a burst turns into
+# a single signal.  Each reason can also have a maximum rate.  Priority reasons such as
+# on-battery skip all of this and are scheduled without delay.  Every signal, priority
+# or not, is emitted from schedule(), so with a GLib schedule they all leave from the
+# main loop.
+#
+
+from threading import Lock, Timer
+from timeit import default_timer as elapsed_time
+
+class SignalCoalescer():
+    WINDOW = 0.1
+
+    # emit(reason, data) sends the signal.  max_rates is { reason: signals per second }.
+    # schedule(delay, func) runs func after delay seconds; defaults to a threading.Timer.
+    def __init__(self, emit, window=WINDOW, max_rates=None, priority=(), schedule=None):
+        self.__emit = emit
+        self.__window = window
+        self.__max_rates = max_rates if max_rates is not None else {}
+        self.__priority = set(priority)
+        self.__schedule = schedule if schedule is not None else self.__timer
+        self.__lock = Lock()
+        self.__pending = {}     # reason -> data waiting to be sent
+        self.__last = {}        # reason -> time of last signal
+
+    def __timer(self, delay, func):
+        timer = Timer(delay, func)
+        timer.daemon = True
+        timer.start()
+
+    def Configure(self, window=None, max_rates=None, priority=None):
+        with self.__lock:
+            if window is not None:
+                self.__window = window
+            if max_rates is not None:
+                self.__max_rates = dict(max_rates)
+            if priority is not None:
+                self.__priority = set(priority)
+
+    def Send(self, reason, data):
+        now = elapsed_time()
+
+        with self.__lock:
+            if reason in self.__priority:
+                # Anything pending for the reason is superseded
+                self.__pending.pop(reason, None)
+                self.__last[reason] = now
+                immediate = True
+
+            else:
+                immediate = False
+                if reason in self.__pending:
+                    pending = self.__pending[reason]
+                    if type(pending) is dict and type(data) is dict:
+                        pending.update(data)
+                    else:
+                        self.__pending[reason] = data
+                    # Already scheduled
+                    return
+
+                self.__pending[reason] = dict(data) if type(data) is dict else data
+
+                due = now + self.__window
+                rate = self.__max_rates.get(reason)
+                if rate and reason in self.__last:
+                    due = max(due, self.__last[reason] + 1.0 / rate)
+
+        if immediate:
+            self.__schedule(0, lambda: self.__send_now(reason, data))
+        else:
+            self.__schedule(due - now, lambda: self.__flush(reason))
+
+    def __send_now(self, reason, data):
+        self.__emit(reason, data)
+        return False
+
+    def __flush(self, reason):
+        with self.__lock:
+            if reason not in self.__pending:
+                return False
+            data = self.__pending.pop(reason)
+            self.__last[reason] = elapsed_time()
+
+        self.__emit(reason, data)
+
+        # Don't repeat when run from a GLib timeout
+        return False
@@ -0,0 +1,85 @@
+#
+# UpsControlState.py
+#
+# Last known UPS, outlet and node power states with change tracking.
+#
+# Values are kept under flat dotted keys ("pdu.APC1.outlet.6", "node.Nimbus.power").
+# Every update that actually changes something gets the next sequence number, and only
+# the changed keys are passed on.  A client that missed some changes asks for everything
+# since the last sequence number it saw; if that is older than the change log it gets
+# the full state instead.
+#
+
+from collections import deque
+from threading import Lock
+
+class StateCache():
+    MAX_LOG = 1024
+
+    def __init__(self, max_log=MAX_LOG):
+        self.__lock = Lock()
+        self.__values = {}          # key -> value
+        self.__seq = 0
+        self.__log = deque(maxlen=max_log)  # (seq, { key: value }) per update; None value means removed
+
+    # Flatten nested dictionaries into dotted keys
+    @staticmethod
+    def Flatten(prefix, value, into=None):
+        if into is None:
+            into = {}
+        if type(value) is dict:
+            for key, item in value.items():
+                StateCache.Flatten("%s.%s" % (prefix, key), item, into)
+        else:
+            into[prefix] = value
+        return into
+
+    # Replace all values below 'prefix' with 'values' (flat keys).  Returns (seq, delta)
+    # where delta holds only the keys that changed; removed keys have value None.
+    # Returns (seq, None) when nothing changed.
+    def Update(self, prefix, values):
+        delta = {}
+        below = prefix + "."
+
+        with self.__lock:
+            for key, value in values.items():
+                if key not in self.__values or self.__values[key] != value:
+                    delta[key] = value
+
+            for key in self.__values:
+                if key.startswith(below) and key not in values:
+                    delta[key] = None
+
+            if len(delta) == 0:
+                return self.__seq, None
+
+            for key, value in delta.items():
+                if value is None:
+                    self.__values.pop(key, None)
+                else:
+                    self.__values[key] = value
+
+            self.__seq += 1
+            self.__log.append((self.__seq, delta))
+            return self.__seq, delta
+
+    # Returns (seq, full, changes): everything that changed after 'seq'.  When 'seq' is
+    # too old for the change log, or newer than any we handed out (the daemon restarted),
+    # 'full' is True and changes holds the whole state.
+    def Since(self, seq):
+        with self.__lock:
+            if seq == self.__seq:
+                return self.__seq, False, {}
+
+            if seq > self.__seq or len(self.__log) == 0 or self.__log[0][0] > seq + 1:
+                return self.__seq, True, dict(self.__values)
+
+            changes = {}
+            for entry_seq, delta in self.__log:
+                if entry_seq > seq:
+                    changes.update(delta)
+            return self.__seq, False, changes
+
+    def Get(self, key):
+        with self.__lock:
+            return self.__values.get(key)
@@ -0,0 +1,164 @@
+#
+# UpsControlStorage.py
+#
+# Persistence for a VarTab.
+#
+# Every change is appended to a small journal next to the config file as one JSON line
+# and synced right away, which is cheap.  The full config file is only rewritten after
+# a quiet period (so a burst of SetValue calls costs one write) by the background
+# compaction, which saves the table atomically and then drops the journal lines it covers.
+# After a crash, Load() replays whatever is left in the journal on top of the config file.
+#
+
+import json
+import os
+import syslog
+from threading import Lock, Timer
+
+from UpsControlVartab import *
+
+class VarTabStore():
+    SAVE_DELAY = 2.0
+
+    def __init__(self, vartab, journal=True, delay=SAVE_DELAY, mode=0o600):
+        self.__vartab = vartab
+        self.__config_file = vartab.GetConfigFile()
+        self.__journal_file = "%s.journal" % self.__config_file if journal else None
+        self.__delay = delay
+        self.__mode = mode
+        self.__lock = Lock()            # Protects journal and timer
+        self.__save_lock = Lock()       # One compaction at a time
+        self.__journal = None           # Open journal file
+        self.__lines = []               # Journal lines written since last compaction
+        self.__timer = None
+
+    # Load config file and replay the journal on top of it
+    def Load(self, init=None):
+        self.__vartab.Load(init=init)
+
+        replayed = 0
+        if self.__journal_file is not None and os.path.exists(self.__journal_file):
+            with open(self.__journal_file, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Partial last line from a crash during append
+                        break
+
+                    if 'all' in entry:
+                        self.__vartab.SetAllValues(entry['all'])
+                    elif 'many' in entry:
+                        for name, value in entry['many']:
+                            self.__vartab.SetValue(name, value, protect=False)
+                    else:
+                        self.__vartab.SetValue(entry['name'], entry['value'], protect=False)
+                    self.__lines.append(line if line.endswith("\n") else line + "\n")
+                    replayed += 1
+
+        if replayed != 0:
+            syslog.syslog("VarTabStore: replayed %d journal entries" % replayed)
+            # Fold the recovered changes into the config file
+            self.Flush()
+
+    def __open_journal(self):
+        if self.__journal is None:
+            fd = os.open(self.__journal_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, self.__mode)
+            self.__journal = os.fdopen(fd, "a")
+            # Make sure a newly created journal can be found after a crash
+            fsync_directory(os.path.dirname(os.path.abspath(self.__journal_file)))
+        return self.__journal
+
+    def __append(self, entry):
+        line = json.dumps(entry) + "\n"
+        journal = self.__open_journal()
+        journal.write(line)
+        journal.flush()
+        fsync_file(journal.fileno())
+        self.__lines.append(line)
+
+    # Record a change made with VarTab.SetValue(name, value)
+    def Changed(self, name, value):
+        self.__record({ 'name': name, 'value': value })
+
+    # Record several VarTab.SetValue changes as one journal entry; changes is [ (name, value) ]
+    def ChangedMany(self, changes):
+        self.__record({ 'many': [ [ name, value ] for name, value in changes ] })
+
+    # Record a change made with VarTab.SetAllValues(values)
+    def ChangedAll(self, values):
+        self.__record({ 'all': values })
+
+    def __record(self, entry):
+        with self.__lock:
+            if self.__journal_file is not None:
+                try:
+                    self.__append(entry)
+                except OSError as e:
+                    syslog.syslog("VarTabStore: journal write failed: %s" % str(e))
+
+            # Start the quiet period timer if it isn't already running
+            if self.__timer is None:
+                self.__timer = Timer(self.__delay, self.__compact)
+                self.__timer.daemon = True
+                self.__timer.start()
+
+    def __compact(self):
+        with self.__lock:
+            self.__timer = None
+
+        try:
+            self.Flush()
+        except VarTabException as e:
+            syslog.syslog("VarTabStore: %s" % str(e))
+
+    # Write the whole table now and drop journal lines it covers
+    def Flush(self):
+        with self.__save_lock:
+            # Count before taking the snapshot: every counted change is already in the table
+            with self.__lock:
+                covered = len(self.__lines)
+
+            self.__vartab.Save(mode=self.__mode, snapshot=self.__vartab.GetSnapshot())
+
+            if self.__journal_file is not None:
+                with self.__lock:
+                    self.__rewrite_journal(self.__lines[covered:])
+
+    # Replace the journal with 'lines' (changes that arrived during the save)
+    def __rewrite_journal(self, lines):
+        if self.__journal is not None:
+            self.__journal.close()
+            self.__journal = None
+
+        try:
+            if len(lines) == 0:
+                if os.path.exists(self.__journal_file):
+                    os.remove(self.__journal_file)
+            else:
+                temp_file = "%s.tmp" % self.__journal_file
+                with os.fdopen(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, self.__mode), "w") as f:
+                    f.write("".join(lines))
+                    f.flush()
+                    fsync_file(f.fileno())
+                os.replace(temp_file, self.__journal_file)
+
+            fsync_directory(os.path.dirname(os.path.abspath(self.__journal_file)))
+            self.__lines = lines
+
+        except OSError as e:
+            syslog.syslog("VarTabStore: journal compaction failed: %s" % str(e))
+
+    # Stop the timer and save anything outstanding
+    def Close(self):
+        with self.__lock:
+            if self.__timer is not None:
+                self.__timer.cancel()
+                self.__timer = None
+
+        self.Flush()
+
+        with self.__lock:
+            if self.__journal is not None:
+                self.__journal.close()
+                self.__journal = None
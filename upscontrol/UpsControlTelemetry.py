@@ -0,0 +1,146 @@
+#
+# UpsControlTelemetry.py
+#
+# Fixed-memory history of sensor readings, UPS figures and outlet states.
+#
+# Every metric has one ring per tier (1 second, 1 minute and 1 hour buckets).  A ring is
+# a set of preallocated arrays holding count, sum, minimum and maximum per bucket plus
+# the bucket number, so a sample is folded into all tiers in place and old buckets are
+# simply overwritten.  Nothing grows while the daemon runs: the rings are sized up front
+# and the number of metrics is capped.
+#
+
+import math
+import syslog
+from array import array
+from threading import Lock
+
+# (bucket seconds, buckets kept)
+TIERS = (
+    (1, 600),                   # 10 minutes of seconds
+    (60, 1440),                 # a day of minutes
+    (3600, 720),                # 30 days of hours
+)
+
+class TelemetryException(Exception):
+    pass
+
+class SeriesRing():
+    def __init__(self, step, size):
+        self.step = step
+        self.size = size
+        self.__bucket = array('q', [ -1 ]) * size
+        self.__count = array('L', [ 0 ]) * size
+        self.__sum = array('d', [ 0.0 ]) * size
+        self.__min = array('d', [ 0.0 ]) * size
+        self.__max = array('d', [ 0.0 ]) * size
+
+    def Add(self, when, value):
+        bucket = int(when // self.step)
+        pos = bucket % self.size
+
+        if self.__bucket[pos] != bucket:
+            if self.__bucket[pos] > bucket:
+                # Older than anything the ring still holds for this slot
+                return
+            self.__bucket[pos] = bucket
+            self.__count[pos] = 1
+            self.__sum[pos] = value
+            self.__min[pos] = value
+            self.__max[pos] = value
+        else:
+            self.__count[pos] += 1
+            self.__sum[pos] += value
+            if value < self.__min[pos]:
+                self.__min[pos] = value
+            if value > self.__max[pos]:
+                self.__max[pos] = value
+
+    # Oldest time still held by the ring if it is up to date at 'now'
+    def Oldest(self, now):
+        return (int(now // self.step) - self.size + 1) * self.step
+
+    # Return [ time, mean, min, max ] for every 'step' seconds (a multiple of the ring's
+    # step) between start and end that has samples
+    def Range(self, start, end, step):
+        per = max(1, int(step // self.step))
+        first = int(start // self.step)
+        last = int(end // self.step)
+        first = max(first, last - self.size + 1)
+        first -= first % per
+
+        points = []
+        for group in range(first, last + 1, per):
+            count = 0
+            total = 0.0
+            low = math.inf
+            high = -math.inf
+            for bucket in range(group, min(group + per, last + 1)):
+                pos = bucket % self.size
+                if self.__bucket[pos] == bucket:
+                    count += self.__count[pos]
+                    total += self.__sum[pos]
+                    low = min(low, self.__min[pos])
+                    high = max(high, self.__max[pos])
+            if count != 0:
+                points.append([ group * self.step, total / count, low, high ])
+
+        return points
+
+class TelemetryStore():
+    MAX_METRICS = 1024
+
+    def __init__(self, tiers=TIERS, max_metrics=MAX_METRICS):
+        self.__tiers = tiers
+        self.__max_metrics = max_metrics
+        self.__lock = Lock()
+        self.__metrics = {}         # name -> [ SeriesRing per tier ]
+        self.__dropped = set()
+        self.__latest = 0.0
+
+    # Add samples taken at 'when'; values is { metric: number or bool }.  Other values
+    # are ignored.
+    def Record(self, when, values):
+        with self.__lock:
+            self.__latest = max(self.__latest, when)
+
+            for name, value in values.items():
+                if type(value) is bool:
+                    value = 1.0 if value else 0.0
+                elif type(value) not in (int, float):
+                    continue
+
+                rings = self.__metrics.get(name)
+                if rings is None:
+                    if len(self.__metrics) >= self.__max_metrics:
+                        if name not in self.__dropped:
+                            self.__dropped.add(name)
+                            syslog.syslog("Telemetry: no room for metric %s" % name)
+                        continue
+                    rings = [ SeriesRing(step, size) for step, size in self.__tiers ]
+                    self.__metrics[name] = rings
+
+                for ring in rings:
+                    ring.Add(when, value)
+
+    def Names(self):
+        with self.__lock:
+            return sorted(self.__metrics)
+
+    # Return { 'metric', 'step', 'points': [ [ time, mean, min, max ], ... ] } for 'metric'
+    # between 'start' and 'end'.  Uses the finest tier that still covers 'start'; 'step' is
+    # rounded down to a multiple of that tier's buckets (at least one bucket).
+    def Series(self, metric, start, end, step=0):
+        with self.__lock:
+            rings = self.__metrics.get(metric)
+            if rings is None:
+                raise TelemetryException("No metric %s" % metric)
+
+            ring = rings[-1]
+            for candidate in rings:
+                if candidate.Oldest(self.__latest) <= start:
+                    ring = candidate
+                    break
+
+            step = max(ring.step, step - step % ring.step)
+            return { 'metric': metric, 'step': step, 'points': ring.Range(start, end, step) }
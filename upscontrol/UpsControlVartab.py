@@ -7,12 +7,180 @@ from copy import deepcopy
 class VarTabException(Exception):
     pass
 
+# Data sync function, picked on first use rather than at import
+_data_sync = None
+
+# Flush one file descriptor to disk.  Only touches files we own, unlike a global sync()
+# which can stall for seconds behind unrelated network mounts.
+def fsync_file(fd):
+    global _data_sync
+
+    if _data_sync is None:
+        # fdatasync skips metadata such as access times; not available everywhere
+        _data_sync = getattr(os, "fdatasync", os.fsync)
+
+    _data_sync(fd)
+
+# Make a create, rename or remove within 'path' durable
+def fsync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# Builtins available to $eval{} expressions
+EVAL_BUILTINS = {
+    'abs': abs, 'bool': bool, 'float': float, 'int': int, 'len': len, 'max': max,
+    'min': min, 'round': round, 'str': str, 'sum': sum, 'True': True, 'False': False, 'None': None,
+}
+
+# A macro-bearing string parsed once into literal chunks, ${} references and the $eval{} expression
+class VarTemplate():
+    def __init__(self, text):
+        self.text = text
+        self.chunks = []        # list of (is_reference, text)
+        self.code = None        # $eval{} expression compiled ahead when it has no ${} inside it
+        self.has_eval = False
+
+        pos = 0
+        while True:
+            # Look for start of macro
+            start = text.find("${", pos)
+            if start < 0:
+                break
+            # Look for end of macro
+            end = text.find("}", start + 2)
+            if end < 0:
+                break
+            if start > pos:
+                self.chunks.append((False, text[pos:start]))
+            self.chunks.append((True, text[start+2:end]))
+            pos = end + 1
+
+        if pos < len(text):
+            self.chunks.append((False, text[pos:]))
+
+        start = text.find("$eval{")
+        if start >= 0:
+            end = text.find("}", start + 6)
+            if end >= 0:
+                self.has_eval = True
+                expression = text[start+6:end]
+                if expression.find("${") < 0:
+                    self.code = compile(expression, "<$eval>", "eval")
+
+# One immutable version of the whole table.  The data is shared with every reader and
+# must not be modified; the JSON text is produced on first request and then reused.
+class VarSnapshot():
+    def __init__(self, version, data):
+        self.version = version
+        self.data = data
+        self.__json = None
+
+    def Json(self):
+        text = self.__json
+        if text is None:
+            text = json.dumps(self.data)
+            self.__json = text
+        return text
+
 class VarTab():
     MAX_RECURSION = 10
+    MAX_PATHS = 4096
+    MAX_TEMPLATES = 1024
 
     def __init__(self, config_file=None):
         self.__config_file = config_file
         self.__data = {}
+        self.__snapshot = VarSnapshot(0, self.__data)
+        self.__paths = {}       # dotted name -> tuple of path pieces
+        self.__cache = {}       # dotted name -> (resolved value, set of path tuples it was built from)
+        self.__depends = {}     # path tuple -> set of cached names that used it
+        self.__prefixes = {}    # path tuple -> set of dependency path tuples below it
+        self.__templates = {}   # macro string -> VarTemplate
+        self.__eval_codes = {}  # expanded $eval{} text -> code object
+        self.__eval_namespace = { '__builtins__': EVAL_BUILTINS, 'var': self.GetValue }
+
+    # Return the parsed template for a macro string
+    def __template(self, text):
+        template = self.__templates.get(text)
+        if template is None:
+            if len(self.__templates) >= self.MAX_TEMPLATES:
+                self.__templates = {}
+            template = VarTemplate(text)
+            self.__templates[text] = template
+        return template
+
+    # Run a $eval{} expression in the restricted namespace
+    def __eval(self, code):
+        return eval(code, self.__eval_namespace)
+
+    # Return the dotted name split into a tuple of pieces; kept so the split is only done once
+    def __compile(self, varname):
+        path = self.__paths.get(varname)
+        if path is None:
+            if len(self.__paths) >= self.MAX_PATHS:
+                self.__paths = {}
+            path = tuple(varname.split("."))
+            self.__paths[varname] = path
+        return path
+
+    # Make 'data' the current version of the table
+    def __publish(self, data):
+        self.__data = data
+        self.__snapshot = VarSnapshot(self.__snapshot.version + 1, data)
+
+    # Return copy of 'node' with 'value' stored at 'path', copying only the dictionaries along the path
+    def __copy_path(self, node, path, value):
+        node = dict(node)
+        if len(path) == 1:
+            node[path[0]] = value
+        else:
+            node[path[0]] = self.__copy_path(node.get(path[0], {}), path[1:], value)
+        return node
+
+    # Drop every resolved value
+    def __flush(self):
+        self.__cache = {}
+        self.__depends = {}
+        self.__prefixes = {}
+
+    def __remember(self, varname, value, deps):
+        self.__cache[varname] = (value, deps)
+        for dep in deps:
+            self.__depends.setdefault(dep, set()).add(varname)
+            for length in range(1, len(dep)):
+                self.__prefixes.setdefault(dep[:length], set()).add(dep)
+
+    def __forget(self, varname):
+        value, deps = self.__cache.pop(varname)
+        for dep in deps:
+            names = self.__depends.get(dep)
+            if names is not None:
+                names.discard(varname)
+                if len(names) == 0:
+                    del(self.__depends[dep])
+                    for length in range(1, len(dep)):
+                        below = self.__prefixes.get(dep[:length])
+                        if below is not None:
+                            below.discard(dep)
+                            if len(below) == 0:
+                                del(self.__prefixes[dep[:length]])
+
+    # Drop the resolved values that were built from 'path', anything above it or anything below it
+    def __invalidate(self, path):
+        names = set()
+        for length in range(1, len(path) + 1):
+            names |= self.__depends.get(path[:length], set())
+        for dep in self.__prefixes.get(path, set()):
+            names |= self.__depends.get(dep, set())
+
+        for name in names:
+            self.__forget(name)
+
+    def GetConfigFile(self):
+        return self.__config_file
 
     def Load(self, config_file = None, init=None):
         if config_file is None:
@@ -21,7 +189,7 @@ class VarTab():
         try:
             # Try to load config file
             with open(config_file, "r") as f:
-                self.__data = json.load(f)
+                data = json.load(f)
 
         except:
             # No config file, so try to init from initial data
@@ -29,36 +197,56 @@ class VarTab():
                raise VarTabException("No initial config specified")
 
             else:
-                self.__data = deepcopy(init)
-                
-    def __create_file_with_mode(self, path, flags, mode):
-        print("__create_file_with_mode: %s flags %o mode %o" % (path, flags, mode))
-        oldmask = os.umask(0)
-        f = os.open(path, flags, mode)
-        # If file already exists, set mode to override
-        os.chmod(path, mode)
-        # Put the mask back
-        os.umask(oldmask)
-        return f
-
-    def Save(self, config_file = None, mode = 0o600):
+                data = deepcopy(init)
+
+        self.__publish(data)
+        self.__flush()
+
+    # Write the table to a temporary file next to 'config_file' and rename it into place,
+    # so a crash part way through leaves either the old or the new file, never a mix.
+    def Save(self, config_file = None, mode = 0o600, snapshot = None):
         if config_file is None:
             config_file = self.__config_file
 
         if config_file is None:
             raise VarTabException("No config file specified")
 
+        if snapshot is None:
+            snapshot = self.__snapshot
+
+        text = json.dumps(snapshot.data, indent=4, sort_keys=True)
+        temp_file = "%s.tmp" % config_file
+
         try:
-            with open(config_file, "w", opener=lambda path, flags: self.__create_file_with_mode(path, flags, mode)) as f:
-                f.write(json.dumps(self.__data, indent=4, sort_keys=True))
-        except Exception as e:
-            print("VarTab.Save: %s" % str(e))
+            with os.fdopen(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), "w") as f:
+                # If file already exists, set mode to override
+                os.fchmod(f.fileno(), mode)
+                f.write(text)
+                f.flush()
+                fsync_file(f.fileno())
+
+            os.replace(temp_file, config_file)
+
+            # Make the rename itself durable
+            fsync_directory(os.path.dirname(os.path.abspath(config_file)))
 
+        except OSError as e:
+            raise VarTabException("Save %s failed: %s" % (config_file, str(e)))
+
+        return snapshot.version
+
+    # Current version of the table.  Readers share it and must not modify it.
+    def GetSnapshot(self):
+        return self.__snapshot
+
+    # Returns shared view of the table; treat as read-only
     def GetAllValues(self):
-        return deepcopy(self.__data)
+        return self.__snapshot.data
 
+    # Takes ownership of 'values'; the caller must not modify them afterwards
     def SetAllValues(self, values):
-        self.__data = deepcopy(values)
+        self.__publish(values)
+        self.__flush()
 
     def __getitem__(self, key=None):
         return self.GetValue(key)
@@ -69,7 +257,7 @@ class VarTab():
     def FindValue(self, varname, subvar=None, write=False):
         varvalue = self.__data if subvar is None else subvar
 
-        for piece in varname.split("."):
+        for piece in self.__compile(varname):
             # print("FindValue: piece %s varvalue %s" % (piece, varvalue))
             if type(varvalue) is dict:
                 if piece in varvalue:
@@ -87,61 +275,112 @@ class VarTab():
 
         return varvalue
 
-    # Return a value if present, else exception thrown for undefined
-    # If no value given, returns entire tree
-    def GetValue(self, varname="", subvar=None, evaluate=True, recursion=0):
+    # Look up and expand a value.  Every absolute path read is added to 'deps'.
+    # Returns (value, cacheable); results of $eval{} are never cacheable.
+    def __resolve(self, varname, subvar, evaluate, recursion, deps):
         if recursion > self.MAX_RECURSION:
             raise VarTabException("recursion overflow looking for %s" % (varname))
 
+        value = self.FindValue(varname, subvar=subvar)
+        cacheable = True
+
+        if subvar is None:
+            deps.add(self.__compile(varname))
+
+        # Process any macros in the value
+        if evaluate and type(value) is str and value.find("$") >= 0:
+            template = self.__template(value)
+
+            if template.code is not None:
+                # Fixed expression; nothing to expand first
+                return self.__eval(template.code), False
+
+            pieces = []
+            for is_reference, text in template.chunks:
+                if is_reference:
+                    newvalue, more = self.__resolve(text, None, evaluate, recursion + 1, deps)
+                    cacheable = cacheable and more
+                    pieces.append(str(newvalue))
+                else:
+                    pieces.append(text)
+            value = "".join(pieces)
+
+            if template.has_eval:
+                # Expression built from ${} references; compile each distinct expansion once
+                start = value.find("$eval{")
+                end = value.find("}", start + 6)
+                if start >= 0 and end >= 0:
+                    expression = value[start+6:end]
+                    code = self.__eval_codes.get(expression)
+                    if code is None:
+                        if len(self.__eval_codes) >= self.MAX_TEMPLATES:
+                            self.__eval_codes = {}
+                        code = compile(expression, "<$eval>", "eval")
+                        self.__eval_codes[expression] = code
+                    value = self.__eval(code)
+                    cacheable = False
+
+        return value, cacheable
+
+    # Return a value if present, else exception thrown for undefined
+    # If no value given, returns entire tree
+    def GetValue(self, varname="", subvar=None, evaluate=True, recursion=0):
         if varname == "":
             return self.__data if subvar is None else subvar
 
-        value = self.FindValue(varname, subvar=subvar)
+        # Resolved absolute values are cached until something they were built from changes
+        use_cache = subvar is None and evaluate and recursion == 0
 
-        if evaluate:
-            # Process any macros in the varname
-            if type(value) is str:
-                working = True
-                while working:
-                    # Look for start of macro
-                    start = value.find("${")
-                    if start >= 0:
-                        # Look for end of macro
-                        end = value.find("}", start + 2)
-                        if end >= 0:
-                            newvalue = self.GetValue(value[start+2:end], recursion=recursion + 1, evaluate=evaluate)
-    
-                            # String replacement within the text
-                            value = value[:start] + str(newvalue) + value[end+1:]
-                        else:
-                            working = False
-                    else:
-                        working = False
-    
-            if type(value) == str:
-                # If $evel{xxx} then evaluate expression to get return value
-                start = value.find("$eval{")
-                if start >= 0:
-                    end = value.find("}", start+6)
-                    if end >= 0:
-                        value = eval(value[start+6:end])
+        if use_cache and varname in self.__cache:
+            return self.__cache[varname][0]
+
+        deps = set()
+        value, cacheable = self.__resolve(varname, subvar, evaluate, recursion, deps)
+
+        if use_cache and cacheable:
+            self.__remember(varname, value, deps)
 
         return value
 
     def SetValue(self, varname, value, subvar=None, protect=True):
-        try:
-            first, last = varname.rsplit('.', maxsplit=1)
-            subvar = self.FindValue(first, subvar=subvar, write=True)
+        if subvar is not None:
+            # Caller owned dictionary; updated in place
+            try:
+                first, last = varname.rsplit('.', maxsplit=1)
+                subvar = self.FindValue(first, subvar=subvar, write=True)
 
-        except:
-            subvar = self.__data if subvar is None else subvar
-            last = varname
+            except:
+                last = varname
 
-        # print("SetValue: protect %s subvar %s" % (protect, subvar))
+            self.__protect(varname, subvar, last, protect)
+            subvar[last] = value
 
-        if protect and last in subvar and type(subvar[last]) is str and (subvar[last].find("$eval{") >= 0 or subvar[last].find("${") >= 0):
-            raise VarTabException("Var %s contains evaluated field and not overriden: %s" % (varname, subvar[last]))
+            # Relative to some unknown point in the tree
+            self.__flush()
 
         else:
-            subvar[last] = value
+            path = self.__compile(varname)
 
+            parent = self.__data
+            for piece in path[:-1]:
+                if type(parent) is not dict:
+                    break
+                # Missing dictionaries along the path are created
+                parent = parent.get(piece, {})
+
+            if type(parent) is not dict:
+                # Path runs through a non-dictionary; store under the full name at the top
+                parent = self.__data
+                path = (varname,)
+
+            self.__protect(varname, parent, path[-1], protect)
+            self.__invalidate(path)
+
+            # Copy the path down to the changed item so existing snapshots stay untouched
+            self.__publish(self.__copy_path(self.__data, path, value))
+
+    def __protect(self, varname, subvar, last, protect):
+        # print("SetValue: protect %s subvar %s" % (protect, subvar))
+
+        if protect and last in subvar and type(subvar[last]) is str and (subvar[last].find("$eval{") >= 0 or subvar[last].find("${") >= 0):
+            raise VarTabException("Var %s contains evaluated field and not overriden: %s" % (varname, subvar[last]))
@@ -1,9 +1,220 @@
 import pyipmi
 import pyipmi.interfaces
+from threading import Lock, BoundedSemaphore
+from timeit import default_timer as elapsed_time
 
 class IPMI_Exception(Exception):
     pass
 
+# Reuses established RMCP sessions per BMC instead of doing the session handshake for
+# every command.  The interface keep-alive (keep_alive_interval) holds idle sessions open;
+# sessions that fail are dropped and the command is retried once on a fresh session.
+class IPMI_SessionPool():
+    MAX_SESSIONS = 2            # Concurrent sessions per BMC
+    IDLE_TIMEOUT = 60           # Close sessions unused for this many seconds
+    ACQUIRE_TIMEOUT = 30
+
+    # observer, if given, is called as observer(seconds, ok) after every command sent to a BMC
+    def __init__(self, max_sessions=MAX_SESSIONS, idle_timeout=IDLE_TIMEOUT, factory=None, observer=None):
+        self.__max_sessions = max_sessions
+        self.__idle_timeout = idle_timeout
+        self.__factory = factory if factory is not None else self.__establish
+        self.__observer = observer
+        self.__lock = Lock()
+        self.__hosts = {}       # key -> { 'limit': semaphore, 'idle': [ (ipmi, last_used) ] }
+
+    def __key(self, control):
+        return (control.interface_type, control.host_address, control.host_port, control.username)
+
+    # Build a new session for 'control'
+    def __establish(self, control):
+        interface = pyipmi.interfaces.create_interface(interface=control.interface_type,
+                                                       slave_address=control.slave_address,
+                                                       host_target_address=control.host_target_address,
+                                                       keep_alive_interval=control.keep_alive_interval)
+
+        ipmi = pyipmi.create_connection(interface)
+        ipmi.session.set_session_type_rmcp(host=control.host_address, port=control.host_port)
+        ipmi.session.set_auth_type_user(control.username, control.password)
+        ipmi.target = pyipmi.Target(ipmb_address=0x20)
+        ipmi.session.establish()
+        return ipmi
+
+    def __close(self, ipmi):
+        try:
+            ipmi.session.close()
+        except Exception:
+            pass
+
+    def __host(self, key):
+        with self.__lock:
+            host = self.__hosts.get(key)
+            if host is None:
+                host = { 'limit': BoundedSemaphore(self.__max_sessions), 'idle': [] }
+                self.__hosts[key] = host
+            return host
+
+    # Take an idle session, closing any that have been idle too long
+    def __take_idle(self, host):
+        now = elapsed_time()
+        with self.__lock:
+            while len(host['idle']) != 0:
+                ipmi, last_used = host['idle'].pop()
+                if now - last_used < self.__idle_timeout:
+                    return ipmi
+                self.__close(ipmi)
+        return None
+
+    def __release(self, host, ipmi):
+        with self.__lock:
+            host['idle'].append((ipmi, elapsed_time()))
+
+    def __observe(self, started, ok):
+        if self.__observer is not None:
+            self.__observer(elapsed_time() - started, ok)
+
+    # Run func(ipmi) on a pooled session for 'control'
+    def Run(self, control, func):
+        host = self.__host(self.__key(control))
+
+        if not host['limit'].acquire(timeout=self.ACQUIRE_TIMEOUT):
+            raise IPMI_Exception("No session available for %s" % control.host_address)
+
+        try:
+            ipmi = self.__take_idle(host)
+            reused = ipmi is not None
+
+            while True:
+                if ipmi is None:
+                    ipmi = self.__factory(control)
+
+                started = elapsed_time()
+                try:
+                    result = func(ipmi)
+
+                except pyipmi.errors.CompletionCodeError:
+                    # The BMC answered, so the session itself is fine
+                    self.__observe(started, True)
+                    self.__release(host, ipmi)
+                    raise
+
+                except Exception:
+                    self.__observe(started, False)
+                    self.__close(ipmi)
+                    ipmi = None
+                    if not reused:
+                        raise
+                    # A reused session may have expired on the BMC side; retry on a new one
+                    reused = False
+                    continue
+
+                self.__observe(started, True)
+                self.__release(host, ipmi)
+                return result
+
+        finally:
+            host['limit'].release()
+
+    # Close all idle sessions
+    def Close(self):
+        with self.__lock:
+            for host in self.__hosts.values():
+                for ipmi, last_used in host['idle']:
+                    self.__close(ipmi)
+                host['idle'] = []
+
+# Shared by all IPMI_Control objects unless one is given
+_session_pool = IPMI_SessionPool()
+
+# One sensor from the SDR with what is needed to read it
+class IPMI_SensorRecord():
+    def __init__(self, sdr):
+        self.sdr = sdr          # Keeps the conversion factors for full records
+        self.name = sdr.device_id_string.decode()
+        self.id = sdr.id
+        self.number = sdr.number
+        self.full = sdr.type is pyipmi.sdr.SDR_TYPE_FULL_SENSOR_RECORD
+
+# Parsed sensor records per BMC.  The SDR is only walked again when the repository
+# info (record count and last addition/erase time stamps) shows that it changed,
+# and that info is itself only checked every CHECK_INTERVAL seconds.
+class IPMI_SdrCache():
+    CHECK_INTERVAL = 60
+
+    def __init__(self, check_interval=CHECK_INTERVAL):
+        self.__check_interval = check_interval
+        self.__lock = Lock()
+        self.__hosts = {}       # (host, port) -> { 'stamp', 'checked', 'records' }
+
+    # Returns something that changes whenever the SDR contents change
+    def __stamp(self, ipmi, use_repository):
+        try:
+            if use_repository:
+                info = ipmi.get_sdr_repository_info()
+                return (info.record_count, info.most_recent_addition, info.most_recent_erase)
+            else:
+                info = ipmi.get_device_sdr_info()
+                return (info.number_of_sensors, getattr(info, 'sensor_population_change', None))
+
+        except pyipmi.errors.CompletionCodeError:
+            # No change information available; rescan on every check
+            return None
+
+    def __scan(self, ipmi, use_repository):
+        iterator = ipmi.sdr_repository_entries() if use_repository else ipmi.device_sdr_entries()
+
+        records = []
+        for sdr in iterator:
+            if sdr.type in (pyipmi.sdr.SDR_TYPE_COMPACT_SENSOR_RECORD, pyipmi.sdr.SDR_TYPE_FULL_SENSOR_RECORD):
+                records.append(IPMI_SensorRecord(sdr))
+        return records
+
+    # Return list of IPMI_SensorRecord for the BMC behind 'control'
+    def Records(self, control, ipmi):
+        key = (control.host_address, control.host_port)
+        now = elapsed_time()
+
+        with self.__lock:
+            entry = self.__hosts.get(key)
+            if entry is not None and now - entry['checked'] < self.__check_interval:
+                return entry['records']
+
+        if entry is None:
+            device_id = ipmi.get_device_id()
+            if device_id.supports_function("sdr_repository"):
+                use_repository = True
+            elif device_id.supports_function("sensor"):
+                use_repository = False
+            else:
+                use_repository = None
+        else:
+            use_repository = entry['repository']
+
+        if use_repository is None:
+            stamp = None
+            records = []
+        else:
+            stamp = self.__stamp(ipmi, use_repository)
+            if entry is not None and stamp is not None and stamp == entry['stamp']:
+                records = entry['records']
+            else:
+                records = self.__scan(ipmi, use_repository)
+
+        with self.__lock:
+            self.__hosts[key] = { 'repository': use_repository, 'stamp': stamp, 'checked': now, 'records': records }
+
+        return records
+
+    # Forget the records for one BMC, or all of them
+    def Invalidate(self, control=None):
+        with self.__lock:
+            if control is None:
+                self.__hosts = {}
+            else:
+                self.__hosts.pop((control.host_address, control.host_port), None)
+
+_sdr_cache = IPMI_SdrCache()
+
 class IPMI_Control():
     def __init__(self,
                  interface_type="rmcp",
@@ -13,7 +224,9 @@ class IPMI_Control():
                  host_address=None,
                  host_port=623,
                  username=None,
-                 password=None):
+                 password=None,
+                 pool=None,
+                 sensor_filter=None):
         self.interface_type = interface_type
         self.slave_address = slave_address
         self.host_target_address = host_target_address
@@ -23,6 +236,8 @@ class IPMI_Control():
         self.ipmi = None
         self.username = username
         self.password = password
+        self.pool = pool if pool is not None else _session_pool
+        self.sensor_filter = sensor_filter
         self.sensors = {}
 
 
@@ -55,112 +270,53 @@ class IPMI_Control():
             self.ipmi = None
 
     def is_power_on(self):
-        self.connect()
-
-        if self.ipmi is None:
-            raise IPMI_Exception("Not connected")
-
-        power_on = self.ipmi.get_chassis_status().power_on
-
-        self.disconnect()
-
-        return power_on
+        return self.pool.Run(self, lambda ipmi: ipmi.get_chassis_status().power_on)
 
     def hard_reset(self):
-        self.connect()
-
-        if self.ipmi is None:
-            raise IPMI_Exception("Not connected")
-
-        self.ipmi.chassis_control_hard_reset()
-
-        self.disconnect()
+        self.pool.Run(self, lambda ipmi: ipmi.chassis_control_hard_reset())
 
     def power_cycle(self):
-        self.connect()
-
-        if self.ipmi is None:
-            raise IPMI_Exception("Not connected")
-
-        self.ipmi.chassis_control_power_cycle()
-
-        self.disconnect()
+        self.pool.Run(self, lambda ipmi: ipmi.chassis_control_power_cycle())
 
     def power_down(self):
-        self.connect()
-
-        if self.ipmi is None:
-            raise IPMI_Exception("Not connected")
-
-        self.ipmi.chassis_control_power_down()
-
-        self.disconnect()
+        self.pool.Run(self, lambda ipmi: ipmi.chassis_control_power_down())
 
     def power_up(self):
-        self.connect()
-
-        if self.ipmi is None:
-            raise IPMI_Exception("Not connected")
-
-        self.ipmi.chassis_control_power_up()
-
-        self.disconnect()
+        self.pool.Run(self, lambda ipmi: ipmi.chassis_control_power_up())
 
     def soft_shutdown(self):
-        self.connect()
-
-        if self.ipmi is None:
-            raise IPMI_Exception("Not connected")
+        self.pool.Run(self, lambda ipmi: ipmi.chassis_control_soft_shutdown())
 
-        self.ipmi.chassis_control_soft_shutdown()
+    # Read sensor values.  'names' (or the sensor_filter given to the constructor) limits
+    # the poll to those sensors; None reads every sensor in the SDR.
+    def read_sensors(self, names=None):
+        if names is None:
+            names = self.sensor_filter
+        return self.pool.Run(self, lambda ipmi: self.__read_sensors(ipmi, names))
 
-        self.disconnect()
-
-    def read_sensors(self):
-        self.connect()
-
-        if self.ipmi is None:
-            raise IPMI_Exception("Not connected")
+    def __read_sensors(self, ipmi, names):
+        count = 0
 
-        iterator = None
+        for record in _sdr_cache.Records(self, ipmi):
+            if names is not None and record.name not in names:
+                continue
 
-        device_id = self.ipmi.get_device_id()
-        if device_id.supports_function("sdr_repository"):
-            iterator = self.ipmi.sdr_repository_entries()
-        elif device_id.supports_function("sensor"):
-            iterator = self.ipmi.device_sdr_entries()
+            try:
+                (value, states) = ipmi.get_sensor_reading(record.number)
+                if value is not None and record.full:
+                    try:
+                        # Convert value to sensor value
+                        value = record.sdr.convert_sensor_raw_to_value(value)
+                    except:
+                        # Leave value as-is
+                        pass
 
-        count = 0
+                if value is not None:
+                    self.sensors[record.name] = { 'id': record.id, 'number': record.number, 'value': value }
+                    count += 1
 
-        if iterator is not None:
-            for sensor in iterator:
-                sensor_name = sensor.device_id_string.decode()
-                try:
-                    if sensor.type is pyipmi.sdr.SDR_TYPE_FULL_SENSOR_RECORD:
-                        try:
-                            (value, states) = self.ipmi.get_sensor_reading(sensor.number)
-                            number = sensor.number
-                            if value is not None:
-                                # Convert value to sensor value
-                                value = sensor.convert_sensor_raw_to_value(value)
-                        except:
-                            # Leave value as-is
-                            pass 
-                    elif sensor.type is pyipmi.sdr.SDR_TYPE_COMPACT_SENSOR_RECORD:
-                        (value, states) = self.ipmi.get_sensor_reading(sensor.number)
-                        number = sensor.number
-
-                    if value is not None:
-                        print("Adding sensor %d: %s = %s" % (number, sensor.device_id_string, value))
-                        self.sensors[sensor_name] = { 'id': sensor.id, 'number': number, 'value': value }
-                        count += 1
-
-                except pyipmi.errors.CompletionCodeError as e:
-                    if sensor.type in (pyipmi.sdr.SDR_TYPE_COMPACT_SENSOR_RECORD, pyipmi.sdr.SDR_TYPE_FULL_SENSOR_RECORD):
-                        print("Error %s sensor %d: %s" % (e.cc, sensor.number, sensor.device_id_string))
-                        self.sensors[sensor_name] = { 'id': sensor.id, 'number': sensor.number, 'error': e.cc}
-
-        self.disconnect()
+            except pyipmi.errors.CompletionCodeError as e:
+                # Sensors that can't be read right now are common; the reading carries the error
+                self.sensors[record.name] = { 'id': record.id, 'number': record.number, 'error': e.cc}
 
         return count
-